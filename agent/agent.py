@@ -1,11 +1,22 @@
+import hashlib
 import json
 import streamlit as st
 from dotenv import load_dotenv
-from openai import OpenAI
-from agent.tools import TOOLS, save_memory, web_search
+from concurrent.futures import FIRST_COMPLETED, wait
+from agent.tools import (
+    ANONYMOUS_USER_ID, EMBEDDING_KEY, MAX_RESULTS_PER_QUERY, TOOLS, chat_completion, create_hypothesis,
+    save_memory, search_queries, search_query, web_search
+)
+from agent.rerank import search_and_rerank
+from agent.threads import session_executor
+from agent.hypotheses import HYPOTHESIS_TOOL, Hypothesis, HypothesisParseError, format_hypotheses, parse_hypotheses
+from agent.storage import chunked_urls, load_cached_hypotheses, save_cached_hypotheses
+from agent.documents import retrieve_chunks
+from agent import metrics, profiling
 from agent.prompts import get_system_prompt
 import re
 import os
+import time
 import certifi
 
 os.environ["SSL_CERT_FILE"] = certifi.where()
@@ -14,8 +25,34 @@ os.environ["CURL_CA_BUNDLE"] = certifi.where()
 
 load_dotenv()
 
-def generate_hypotheses_from_documents(selected_docs, user_prompt=None):
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Upper bound on model -> tools -> model round-trips per agent() call
+MAX_TOOL_ITERATIONS = 3
+
+# Alternative hypothesis sets requested per completion (served on "retry")
+HYPOTHESIS_CANDIDATES = 3
+
+# Part of the cache key, so cached free-text hypotheses aren't served as structured ones
+HYPOTHESIS_FORMAT = "structured-v1"
+
+# Full-text chunks added to hypothesis prompts for documents that were read in full
+EXCERPT_QUERY = "spatial trends, relationships and variables relevant to urban planning"
+EXCERPT_COUNT = 6
+EXCERPT_CHARS = 600
+
+# Search topics for each Refinement Lab approach; {topic} is what the user typed
+REFINE_TOPIC_TEMPLATES = {
+    "Focus on a specific aspect": "case studies focusing on {topic} in multiple cities",
+    "Compare specific elements": "comparative analysis of {topic} across multiple cities",
+    "Find connections": "connections and relationships of {topic} in urban case studies",
+    "Extract data/statistics": "data and statistics about {topic} in urban case studies",
+    "Look for data sources": "data sources and datasets about {topic} in urban research",
+    "Look for similar studies": "similar urban case studies about {topic}",
+    "Look for trends": "trends and patterns of {topic} in urban case studies",
+    "Look for case studies": "urban case studies about {topic} in multiple cities",
+}
+DEFAULT_REFINE_TOPIC_TEMPLATE = "urban research about {topic} in multiple cities"
+
+def build_hypothesis_prompt(selected_docs, user_prompt=None, structured=True):
     # Build a prompt using the selected documents
     doc_list = "\n".join([f"- {doc['title']}: {doc.get('content', '')[:200]}" for doc in selected_docs])
     prompt = (
@@ -25,40 +62,172 @@ def generate_hypotheses_from_documents(selected_docs, user_prompt=None):
         "- Be clearly worded (1–2 sentences)\n"
         "- Mention a spatial trend, relationship, or variable (e.g., green space access, density, mobility, land use)\n"
         "- Be relevant to urban planning or geography\n"
-        "Format them as a numbered list (1., 2., 3.).\n"
-        "If you cannot find enough hypotheses, make them up based on the document titles. "
-        "Return only a numbered list of 3 hypotheses, nothing else. Do not include any introduction or summary.\n\n"
     )
+    if structured:
+        prompt += (
+            "For each hypothesis, list the spatial variables involved and datasets that could be used to test it.\n"
+            "If you cannot find enough hypotheses, make them up based on the document titles. "
+            "Return them by calling propose_hypotheses with exactly 3 hypotheses.\n\n"
+        )
+    else:
+        prompt += (
+            "Format them as a numbered list (1., 2., 3.).\n"
+            "If you cannot find enough hypotheses, make them up based on the document titles. "
+            "Return only a numbered list of 3 hypotheses, nothing else. Do not include any introduction or summary.\n\n"
+        )
     if user_prompt:
         prompt += f"User request: {user_prompt}\n"
     prompt += "Selected studies:\n" + doc_list
-    messages = [
+    # Excerpts from the full text of the documents that were read in full
+    excerpts = retrieve_chunks(user_prompt or EXCERPT_QUERY, [doc["url"] for doc in selected_docs], k=EXCERPT_COUNT)
+    if excerpts:
+        titles = {doc["url"]: doc["title"] for doc in selected_docs}
+        prompt += "\n\nRelevant excerpts:\n" + "\n".join(
+            f"- [{titles[e['url']]}, p. {e['page']}] {e['text'][:EXCERPT_CHARS]}" for e in excerpts
+        )
+    return [
         {"role": "system", "content": "You are a helpful assistant for urban research."},
         {"role": "user", "content": prompt}
     ]
-    completion = client.chat.completions.create(
+
+def generate_hypothesis_candidates(selected_docs, user_prompt=None, n=HYPOTHESIS_CANDIDATES, structured=True, cached=True):
+    messages = build_hypothesis_prompt(selected_docs, user_prompt, structured)
+    # A retry asks for new hypotheses, so it must not get the same answer from the semantic cache
+    cache_mode = "hypothesis" if cached else None
+
+    # Ask for several alternative sets at once so a retry can be served locally
+    if not structured:
+        completion = chat_completion(
+            model="gpt-3.5-turbo",
+            messages=messages,
+            n=n,
+            cache_mode=cache_mode
+        )
+        return [choice.message.content for choice in completion.choices]
+
+    completion = chat_completion(
         model="gpt-3.5-turbo",
-        messages=messages
+        messages=messages,
+        n=n,
+        tools=[HYPOTHESIS_TOOL],
+        tool_choice={"type": "function", "function": {"name": "propose_hypotheses"}},
+        cache_mode=cache_mode
+    )
+    candidates = []
+    for choice in completion.choices:
+        tool_calls = choice.message.tool_calls or []
+        try:
+            hypotheses = parse_hypotheses(tool_calls[0].function.arguments if tool_calls else None)
+        except HypothesisParseError as e:
+            metrics.increment("hypotheses.parse_failures")
+            print("Hypothesis parse error:", e)
+            continue
+        metrics.increment("hypotheses.parsed")
+        candidates.append([h.to_dict() for h in hypotheses])
+    return candidates
+
+def hypothesis_fingerprint(selected_docs, user_prompt=None):
+    # Same documents (in any order) and same request -> same hypotheses
+    urls = [doc["url"] for doc in selected_docs]
+    key = "\n".join(sorted(urls)) + "\n" + (user_prompt or "")
+    # Reading more documents in full changes the prompt, so it changes the key too
+    key += "\n" + ",".join(sorted(chunked_urls(urls, EMBEDDING_KEY)))
+    return hashlib.sha256(f"{HYPOTHESIS_FORMAT}\n{key}".encode("utf-8")).hexdigest()
+
+def get_hypothesis_candidates(selected_docs, user_prompt=None, refresh=False):
+    fingerprint = hypothesis_fingerprint(selected_docs, user_prompt)
+    if not refresh:
+        cached = load_cached_hypotheses(fingerprint)
+        if cached:
+            metrics.increment("hypothesis_cache.hits")
+            return cached
+    metrics.increment("hypothesis_cache.misses")
+    candidates = generate_hypothesis_candidates(selected_docs, user_prompt, cached=not refresh)
+    if not candidates:
+        # Every alternative failed validation: retry once, then fall back to free text
+        metrics.increment("hypotheses.retries")
+        candidates = (
+            generate_hypothesis_candidates(selected_docs, user_prompt, cached=False)
+            or generate_hypothesis_candidates(selected_docs, user_prompt, structured=False, cached=not refresh)
+        )
+    save_cached_hypotheses(fingerprint, candidates)
+    return candidates
+
+def candidate_message(candidate):
+    # Structured candidates are lists of hypothesis dicts, free-text ones are strings
+    if isinstance(candidate, list):
+        return format_hypotheses([Hypothesis.from_dict(h) for h in candidate])
+    return candidate
+
+def generate_hypotheses_from_documents(selected_docs, user_prompt=None):
+    return candidate_message(get_hypothesis_candidates(selected_docs, user_prompt)[0])
+
+def current_user_id():
+    # Signed-in users keep their memories across sessions; anonymous ones get the session's own
+    try:
+        if st.user.get("is_logged_in"):
+            return st.user.get("email") or st.user.get("sub")
+    except (AttributeError, KeyError):
+        pass
+    store = st.session_state.get("store")
+    return f"session:{store.session_id}" if store else ANONYMOUS_USER_ID
+
+def run_web_search(tool_args, mode):
+    if not st.session_state.get("rerank_enabled"):
+        return web_search(
+            tool_args["city"],
+            tool_args["topic"],
+            tool_args["timeframe"],
+            tool_args["doc_type"],
+            tool_args.get("num_results", 5)
+        )
+    # Re-rank against the documents the user already picked for this stage
+    if mode == "refine":
+        reference_docs = list(st.session_state.get("selected_for_refinement", {}).values())
+    else:
+        reference_docs = st.session_state.get("selected_results", [])
+    return search_and_rerank(
+        tool_args["city"],
+        tool_args["topic"],
+        tool_args["timeframe"],
+        tool_args["doc_type"],
+        tool_args.get("num_results", 5),
+        reference_docs=reference_docs
     )
-    return completion.choices[0].message.content
 
+@profiling.profiled()
 def agent(messages):
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
     mode = st.session_state.get("mode", "search")
     user_prompt = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
 
     # --- HYPOTHESIS MODE ---
+    # The Hypothesis Lab's refinement chat starts with a system prompt naming the hypothesis
+    if mode == "hypothesis" and messages and messages[0]["role"] == "system":
+        urls = [doc["url"] for doc in st.session_state.get("hypothesis_results", [])]
+        excerpts = retrieve_chunks(user_prompt, urls, k=EXCERPT_COUNT) if user_prompt else []
+        if excerpts:
+            context = "Relevant excerpts from the selected studies:\n" + "\n".join(
+                f"- (p. {e['page']}) {e['text'][:EXCERPT_CHARS]}" for e in excerpts
+            )
+            messages = messages[:-1] + [{"role": "system", "content": context}, messages[-1]]
+        return {"message": create_hypothesis(messages)}
+
     if mode == "hypothesis":
         # Use selected documents from session state
         selected_docs = st.session_state.get("hypothesis_results", [])
         if not selected_docs:
             return {"message": "No documents selected for hypothesis generation."}
-        hypotheses = generate_hypotheses_from_documents(selected_docs, user_prompt)
-        return {"message": hypotheses}
+        candidates = get_hypothesis_candidates(
+            selected_docs,
+            user_prompt,
+            refresh=st.session_state.pop("refresh_hypotheses", False)
+        )
+        return {"message": candidate_message(candidates[0]), "candidates": candidates}
 
     # Inject dynamic system prompt before calling the model
-    system_prompt = get_system_prompt(user_prompt, mode)
+    user_id = current_user_id()
+    system_prompt = get_system_prompt(user_prompt, mode, user_id)
     
     # For refinement mode, add explicit instructions about the selected documents
     if mode == "refine" and hasattr(st.session_state, "selected_for_refinement"):
@@ -71,129 +240,213 @@ def agent(messages):
 
     full_messages = [{"role": "system", "content": system_prompt}] + messages
 
-    completion = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        tools=TOOLS,
-        messages=full_messages
-    )
+    search_results = []
+    searched = False
+    tool_outputs = []
+    timings = []
+
+    for _ in range(MAX_TOOL_ITERATIONS):
+        iteration_start = time.perf_counter()
+        completion = chat_completion(
+            model="gpt-3.5-turbo",
+            tools=TOOLS,
+            messages=full_messages,
+            cache_mode=mode
+        )
+        response = completion.choices[0].message
+
+        if not response.tool_calls:
+            timings.append(time.perf_counter() - iteration_start)
+            metrics.record_timing("agent.iteration", timings[-1])
+            tool_outputs.append(response.content if response.content else str(response))
+            break
 
-    response = completion.choices[0].message
-
-    if response.tool_calls:
-        for tool_call in response.tool_calls:
-            tool_name = tool_call.function.name
-            tool_args = json.loads(tool_call.function.arguments)
-
-            if tool_name == "save_memory":
-                return {
-                    "message": save_memory(tool_args["memory"]),
-                    "results": []
-                }
-
-            elif tool_name == "web_search":
-                # For refinement mode, ensure the search query includes multiple cities
-                if mode == "refine":
-                    if "topic" in tool_args:
-                        # Get the refinement option and topic from session state
-                        refine_option = st.session_state.get("refine_option", "")
-                        refined_topic = st.session_state.get("refined_topic_input", "")
-                        
-                        # Construct a more specific search query based on the refinement option
-                        if refine_option == "Focus on a specific aspect":
-                            tool_args["topic"] = f"case studies focusing on {refined_topic} in multiple cities"
-                        elif refine_option == "Compare specific elements":
-                            tool_args["topic"] = f"comparative analysis of {refined_topic} across multiple cities"
-                        elif refine_option == "Find connections":
-                            tool_args["topic"] = f"connections and relationships of {refined_topic} in urban case studies"
-                        elif refine_option == "Extract data/statistics":
-                            tool_args["topic"] = f"data and statistics about {refined_topic} in urban case studies"
-                        elif refine_option == "Look for data sources":
-                            tool_args["topic"] = f"data sources and datasets about {refined_topic} in urban research"
-                        elif refine_option == "Look for similar studies":
-                            tool_args["topic"] = f"similar urban case studies about {refined_topic}"
-                        elif refine_option == "Look for trends":
-                            tool_args["topic"] = f"trends and patterns of {refined_topic} in urban case studies"
-                        elif refine_option == "Look for case studies":
-                            tool_args["topic"] = f"urban case studies about {refined_topic} in multiple cities"
-                        else:
-                            tool_args["topic"] = f"urban research about {refined_topic} in multiple cities"
-                        
-                        # Add comparative terms to ensure multi-city results
-                        tool_args["topic"] += " comparative analysis multiple cities"
-                        
-                        # Remove single city focus
-                        if "city" in tool_args:
-                            del tool_args["city"]
-                        
-                        # Add default values for required parameters
-                        if "timeframe" not in tool_args:
-                            tool_args["timeframe"] = "recent years"
-                        if "doc_type" not in tool_args:
-                            tool_args["doc_type"] = "case studies and research reports"
-
-                # Ensure all required parameters are present
-                required_params = ["city", "topic", "timeframe", "doc_type"]
-                for param in required_params:
-                    if param not in tool_args:
-                        tool_args[param] = "multiple cities" if param == "city" else "urban planning"
-
-                search_results = web_search(
-                    tool_args["city"],
-                    tool_args["topic"],
-                    tool_args["timeframe"],
-                    tool_args["doc_type"],
-                    tool_args.get("num_results", 5)
-                )
-
-                if isinstance(search_results, str):
-                    assistant_msg = search_results
-                else:
-                    if mode == "refine":
-                        # Verify results have multiple cities
-                        cities = set()
-                        for result in search_results:
-                            # Extract city names from title and content
-                            if "title" in result:
-                                cities.update(extract_cities(result["title"]))
-                            if "content" in result:
-                                cities.update(extract_cities(result["content"]))
-                        
-                        if len(cities) < 3:
-                            # If not enough cities, modify the search to be more specific
-                            tool_args["topic"] = f"comparative case studies of {refined_topic} in multiple cities"
-                            search_results = web_search(
-                                tool_args["city"],
-                                tool_args["topic"],
-                                tool_args["timeframe"],
-                                tool_args["doc_type"],
-                                tool_args.get("num_results", 5)
-                            )
-                        
-                        assistant_msg = f"Here's what I found based on your refinement:\n\n"
-                        assistant_msg += "\n".join(f"- {r['title']} ({r['url']})" for r in search_results)
-                    else:
-                        assistant_msg = (
-                            f"I found {len(search_results)} documents.\n\n"
-                            "📄 Browse them below.\n"
-                            "📌 Save your favorites to your Research Box.\n"
-                            "🔍 Or ask me to search again with a refined topic."
-                        )
-
-                messages.append({
-                    "role": "assistant",
-                    "content": assistant_msg
-                })
-
-                return {
-                    "results": search_results if isinstance(search_results, list) else [],
-                    "message": assistant_msg
-                }
+        # Run every tool call of this turn concurrently
+        with session_executor(len(response.tool_calls)) as pool:
+            outputs = list(pool.map(lambda tc: run_tool(tc, mode, user_id), response.tool_calls))
+
+        full_messages.append({
+            "role": "assistant",
+            "content": response.content,
+            "tool_calls": [tc.model_dump() for tc in response.tool_calls]
+        })
+        for tool_call, output in zip(response.tool_calls, outputs):
+            full_messages.append({
+                "role": "tool",
+                "tool_call_id": tool_call.id,
+                "content": output["message"]
+            })
+            if tool_call.function.name == "web_search":
+                searched = True
+                seen = {r["url"] for r in search_results}
+                search_results += [r for r in output["results"] if r["url"] not in seen]
+            else:
+                tool_outputs.append(output["message"])
+
+        timings.append(time.perf_counter() - iteration_start)
+        metrics.record_timing("agent.iteration", timings[-1])
+
+        # Search results are the answer; only go back to the model after other tools
+        if searched:
+            break
+
+    if searched:
+        tool_outputs.append(search_message(search_results, mode))
 
     return {
-        "results": [],
-        "message": response.content if response.content else str(response)
+        "results": search_results,
+        "message": "\n\n".join(tool_outputs),
+        "timings": timings
     }
 
+@profiling.profiled()
+def structured_search(params, mode="search", refine_option=None, refined_topic=None):
+    """Search straight from form parameters, without asking the model to route the call.
+
+    params holds web_search arguments (city, topic, timeframe, doc_type, num_results).
+    Returns the same {"results", "message", "timings"} as agent().
+    """
+    start = time.perf_counter()
+    results = run_refinable_search(dict(params), mode, refine_option, refined_topic)
+    timings = [time.perf_counter() - start]
+    metrics.record_timing("agent.structured_search", timings[0])
+    if isinstance(results, str):
+        return {"results": [], "message": results, "timings": timings}
+    return {"results": results, "message": search_message(results, mode), "timings": timings}
+
+# Results one search returns before it continues with further queries
+PAGE_SIZE = 10
+# Upper bound on the results of one progressive search
+MAX_SEARCH_RESULTS = 500
+# Further queries in flight at once (Tavily's shared limiter queues anything beyond its quota)
+SEARCH_WINDOW = 4
+
+def stream_search(params, target, mode="search"):
+    """Yield batches of new results for params as each query returns, until target results were found.
+
+    The first batch is the regular search for params; further batches come from
+    search_queries() over each document type in params["doc_types"]. Results whose URL
+    was already yielded are dropped. Closing the generator cancels the queries not yet sent.
+    """
+    first = dict(params, num_results=min(target, PAGE_SIZE))
+    queries = search_queries(params["city"], params["topic"], params["timeframe"],
+                             params.get("doc_types") or [params["doc_type"]])
+    seen = set()
+    pool = session_executor(SEARCH_WINDOW)
+    pending = {pool.submit(run_refinable_search, first, mode)}
+    try:
+        while pending:
+            # Only go past the first page when more results were asked for
+            while target > PAGE_SIZE and len(pending) < SEARCH_WINDOW:
+                query = next(queries, None)
+                if query is None:
+                    break
+                pending.add(pool.submit(search_query, query, max_results=MAX_RESULTS_PER_QUERY))
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results = future.result()
+                if not isinstance(results, list):
+                    continue
+                batch = [r for r in results if r["url"] not in seen][:max(target - len(seen), 0)]
+                seen.update(r["url"] for r in batch)
+                if batch:
+                    metrics.increment("agent.stream_search.batches")
+                    yield batch
+            if len(seen) >= target:
+                break
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def run_tool(tool_call, mode, user_id=ANONYMOUS_USER_ID):
+    # A failing call becomes that call's answer, so the other calls' results and the turn survive
+    try:
+        return call_tool(tool_call, mode, user_id)
+    except Exception as e:
+        metrics.increment("agent.tool_errors")
+        print(f"Tool error ({tool_call.function.name}):", e)
+        return {"message": f"Error running {tool_call.function.name}: {type(e).__name__}: {e}", "results": []}
+
+def call_tool(tool_call, mode, user_id=ANONYMOUS_USER_ID):
+    tool_name = tool_call.function.name
+    tool_args = json.loads(tool_call.function.arguments)
+
+    if tool_name == "save_memory":
+        return {"message": save_memory(tool_args["memory"], user_id), "results": []}
+
+    elif tool_name == "web_search":
+        results = run_refinable_search(tool_args, mode)
+        if isinstance(results, str):
+            return {"message": results, "results": []}
+        return {
+            "message": "\n".join(f"- {r['title']} ({r['url']})" for r in results) or "No results found.",
+            "results": results
+        }
+
+    return {"message": f"Unknown tool: {tool_name}", "results": []}
+
+def run_refinable_search(tool_args, mode, refine_option=None, refined_topic=None):
+    if refine_option is None:
+        refine_option = st.session_state.get("refine_option", "")
+    if refined_topic is None:
+        refined_topic = st.session_state.get("refined_topic_input", "")
+
+    # For refinement mode, ensure the search query includes multiple cities
+    if mode == "refine":
+        if "topic" in tool_args:
+            # Construct a more specific search query based on the refinement option
+            template = REFINE_TOPIC_TEMPLATES.get(refine_option, DEFAULT_REFINE_TOPIC_TEMPLATE)
+            tool_args["topic"] = template.format(topic=refined_topic)
+            
+            # Add comparative terms to ensure multi-city results
+            tool_args["topic"] += " comparative analysis multiple cities"
+            
+            # Remove single city focus
+            if "city" in tool_args:
+                del tool_args["city"]
+            
+            # Add default values for required parameters
+            if "timeframe" not in tool_args:
+                tool_args["timeframe"] = "recent years"
+            if "doc_type" not in tool_args:
+                tool_args["doc_type"] = "case studies and research reports"
+
+    # Ensure all required parameters are present
+    required_params = ["city", "topic", "timeframe", "doc_type"]
+    for param in required_params:
+        if param not in tool_args:
+            tool_args[param] = "multiple cities" if param == "city" else "urban planning"
+
+    search_results = run_web_search(tool_args, mode)
+
+    if mode == "refine" and isinstance(search_results, list):
+        # Verify results have multiple cities
+        cities = set()
+        for result in search_results:
+            # Extract city names from title and content
+            if "title" in result:
+                cities.update(extract_cities(result["title"]))
+            if "content" in result:
+                cities.update(extract_cities(result["content"]))
+        
+        if len(cities) < 3:
+            # If not enough cities, modify the search to be more specific
+            tool_args["topic"] = f"comparative case studies of {refined_topic} in multiple cities"
+            search_results = run_web_search(tool_args, mode)
+
+    return search_results
+
+def search_message(search_results, mode):
+    if mode == "refine":
+        return "Here's what I found based on your refinement:\n\n" + "\n".join(
+            f"- {r['title']} ({r['url']})" for r in search_results
+        )
+    return (
+        f"I found {len(search_results)} documents.\n\n"
+        "📄 Browse them below.\n"
+        "📌 Save your favorites to your Research Box.\n"
+        "🔍 Or ask me to search again with a refined topic."
+    )
+
 def extract_cities(text):
     """Extract city names from text using common patterns and regex."""
     # Common city name patterns
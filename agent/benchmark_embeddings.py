@@ -0,0 +1,91 @@
+"""Compare embedding models on recall quality, latency and storage over a fixed set of memories.
+
+    python -m agent.benchmark_embeddings
+    python -m agent.benchmark_embeddings --model text-embedding-3-small:256 --model text-embedding-3-small:512
+
+Each --model is MODEL or MODEL:DIMENSIONS. Queries are answered with an exact search
+over the embedded memories, the same top_k that load_memories uses.
+"""
+import argparse
+import json
+import os
+import time
+import numpy as np
+from agent.tools import get_embeddings, get_embeddings_batch
+
+DATASET_PATH = os.path.join(os.path.dirname(__file__), "data", "memory_benchmark.json")
+DEFAULT_MODELS = [
+    "text-embedding-ada-002",
+    "text-embedding-3-small",
+    "text-embedding-3-small:512",
+    "text-embedding-3-small:256",
+]
+TOP_K = 3
+
+
+def parse_model(spec):
+    model, _, dimensions = spec.partition(":")
+    return model, int(dimensions) if dimensions else None
+
+
+def _normalize(matrix):
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+
+def benchmark(spec, dataset, top_k=TOP_K):
+    model, dimensions = parse_model(spec)
+    memories = dataset["memories"]
+    ids = [m["id"] for m in memories]
+
+    start = time.perf_counter()
+    matrix = _normalize(np.asarray(get_embeddings_batch([m["text"] for m in memories], model, dimensions), dtype=np.float32))
+    index_seconds = time.perf_counter() - start
+
+    embed_times, search_times, hits, reciprocal_ranks = [], [], 0, []
+    for query in dataset["queries"]:
+        start = time.perf_counter()
+        vector = np.asarray(get_embeddings(query["text"], model, dimensions), dtype=np.float32)
+        embed_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        scores = matrix @ (vector / max(np.linalg.norm(vector), 1e-12))
+        ranking = [ids[i] for i in np.argsort(-scores)]
+        search_times.append(time.perf_counter() - start)
+
+        relevant = set(query["relevant"])
+        hits += len(relevant & set(ranking[:top_k])) / len(relevant)
+        first = next(rank for rank, memory_id in enumerate(ranking, 1) if memory_id in relevant)
+        reciprocal_ranks.append(1 / first)
+
+    return {
+        "model": spec,
+        "dimensions": matrix.shape[1],
+        f"recall@{top_k}": hits / len(dataset["queries"]),
+        "mrr": float(np.mean(reciprocal_ranks)),
+        "query_embed_p50_ms": float(np.median(embed_times)) * 1000,
+        "search_p50_ms": float(np.median(search_times)) * 1000,
+        "index_seconds": index_seconds,
+        # float32 values, as stored in Pinecone and in document_chunks
+        "bytes_per_vector": matrix.shape[1] * 4,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model", action="append", help="MODEL or MODEL:DIMENSIONS (repeatable)")
+    parser.add_argument("--dataset", default=DATASET_PATH)
+    parser.add_argument("--top-k", type=int, default=TOP_K)
+    args = parser.parse_args()
+
+    with open(args.dataset) as f:
+        dataset = json.load(f)
+    rows = [benchmark(spec, dataset, args.top_k) for spec in args.model or DEFAULT_MODELS]
+
+    columns = list(rows[0])
+    print(" | ".join(columns))
+    for row in rows:
+        print(" | ".join(f"{row[c]:.3f}" if isinstance(row[c], float) else str(row[c]) for c in columns))
+
+
+if __name__ == "__main__":
+    main()
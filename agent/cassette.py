@@ -0,0 +1,265 @@
+"""Record every upstream call to a cassette file, or replay a cassette without network access.
+
+    CASSETTE_MODE=record CASSETTE=cassettes/run.jsonl.gz streamlit run streamlit_app.py
+    CASSETTE_MODE=replay CASSETTE=cassettes/run.jsonl.gz streamlit run streamlit_app.py
+    python -m agent.cassette cassettes/run.jsonl.gz
+
+Calls are captured where they leave the app: the rate-limited OpenAI, Tavily and
+Nominatim calls and the Pinecone index. A cassette is gzipped JSON lines, one call
+per line. Replays match calls by a hash of the request (timestamps and UUIDs left
+out); identical requests are answered in the order they were recorded. Replays wait
+CASSETTE_LATENCY per call: "recorded" (the default) for the recorded duration, or a
+fixed number of seconds.
+"""
+import argparse
+import atexit
+import gzip
+import hashlib
+import importlib
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from functools import lru_cache
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+MODE = os.getenv("CASSETTE_MODE", "")
+RECORDING = MODE == "record"
+REPLAYING = MODE == "replay"
+PATH = os.getenv("CASSETTE", "cassettes/session.jsonl.gz")
+LATENCY = os.getenv("CASSETTE_LATENCY", "recorded")
+
+# Values that differ between otherwise identical runs
+_VOLATILE = re.compile(
+    r"\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(?:\.\d+)?(?:[+-]\d{2}:\d{2}|Z)?"
+    r"|[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+)
+
+
+class CassetteMiss(Exception):
+    """Raised in replay mode for a request the cassette has no answer for."""
+
+
+class ReplayedError(Exception):
+    """An upstream error that was recorded, raised again on replay.
+
+    It is raised as a subclass of the recorded exception class whenever that class can be
+    imported, so except clauses catch it exactly like the original.
+    """
+
+    def __init__(self, message):
+        # The recorded class's own __init__ may need arguments that weren't recorded
+        Exception.__init__(self, message)
+
+    def __str__(self):
+        return self.args[0]
+
+
+def _import_class(name):
+    module, qualname = name.split(":")
+    cls = importlib.import_module(module)
+    for part in qualname.split("."):
+        cls = getattr(cls, part)
+    return cls
+
+
+def _qualified_name(cls):
+    return f"{cls.__module__}:{cls.__qualname__}"
+
+
+@lru_cache(maxsize=None)
+def _replayed_class(name):
+    try:
+        cls = _import_class(name)
+        if not issubclass(cls, Exception):
+            return None
+        return type(cls.__name__, (ReplayedError, cls), {"__module__": cls.__module__})
+    except (ImportError, AttributeError, ValueError, TypeError):
+        # The class no longer exists, or cannot be combined with ReplayedError
+        return None
+
+
+def replayed_error(name, message):
+    replayed = _replayed_class(name)
+    if replayed is None:
+        return ReplayedError(f"{name}: {message}")
+    return replayed(message)
+
+
+def request_key(label, request):
+    text = json.dumps([label, request], sort_keys=True, default=str)
+    return hashlib.sha1(_VOLATILE.sub("*", text).encode("utf-8")).hexdigest()
+
+
+def encode(value):
+    if isinstance(value, requests.Response):
+        return {
+            "type": "http",
+            "status": value.status_code,
+            "url": value.url,
+            "headers": dict(value.headers),
+            "body": value.content.decode("utf-8", "replace"),
+        }
+    if hasattr(value, "model_dump") and hasattr(type(value), "model_validate"):
+        # OpenAI responses are pydantic models
+        return {"type": "model", "class": _qualified_name(type(value)), "data": value.model_dump(mode="json")}
+    if hasattr(value, "latitude") and hasattr(value, "raw"):
+        # geopy Location
+        return {"type": "location", "address": value.address, "point": [value.latitude, value.longitude], "raw": value.raw}
+    if hasattr(value, "to_dict"):
+        # Pinecone responses; the app reads them like dicts
+        return {"type": "json", "data": value.to_dict()}
+    return {"type": "json", "data": value}
+
+
+def decode(encoded):
+    kind = encoded["type"]
+    if kind == "http":
+        response = requests.Response()
+        response.status_code = encoded["status"]
+        response.url = encoded["url"]
+        response.headers = CaseInsensitiveDict(encoded["headers"])
+        response._content = encoded["body"].encode("utf-8")
+        response.encoding = "utf-8"
+        return response
+    if kind == "model":
+        return _import_class(encoded["class"]).model_validate(encoded["data"])
+    if kind == "location":
+        from geopy.location import Location
+        return Location(encoded["address"], tuple(encoded["point"]), encoded["raw"])
+    if kind == "error":
+        raise replayed_error(encoded["class"], encoded["message"])
+    return encoded["data"]
+
+
+def read(path):
+    entries = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                if line.endswith("\n"):
+                    entries.append(json.loads(line))
+        except EOFError:
+            # Cassette of a process that didn't exit cleanly: every flushed line is still there
+            pass
+    return entries
+
+
+class Recorder:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = gzip.open(path, "at", encoding="utf-8")
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def add(self, label, key, response, seconds):
+        line = json.dumps({"label": label, "key": key, "seconds": round(seconds, 4), "response": response}, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            # Sync-flushed per call, so a killed process keeps everything recorded so far
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class Player:
+    def __init__(self, path):
+        self._answers = defaultdict(deque)
+        for entry in read(path):
+            self._answers[entry["key"]].append(entry)
+        self._lock = threading.Lock()
+
+    def next(self, label, key):
+        with self._lock:
+            answers = self._answers.get(key)
+            if not answers:
+                raise CassetteMiss(f"no recorded answer for {label} ({key[:12]})")
+            # The last answer is kept for any further repeats of the request
+            return answers.popleft() if len(answers) > 1 else answers[0]
+
+
+_recorder = Recorder(PATH) if RECORDING else None
+_player = Player(PATH) if REPLAYING else None
+
+
+def _replay_delay(recorded_seconds):
+    if LATENCY == "recorded":
+        return recorded_seconds
+    return float(LATENCY)
+
+
+def through(label, request, call):
+    """Run call() for an upstream request, recording or replaying it when a cassette is active."""
+    if not MODE:
+        return call()
+    key = request_key(label, request)
+    if REPLAYING:
+        entry = _player.next(label, key)
+        delay = _replay_delay(entry["seconds"])
+        if delay > 0:
+            time.sleep(delay)
+        return decode(entry["response"])
+    start = time.perf_counter()
+    try:
+        result = call()
+    except Exception as e:
+        _recorder.add(label, key, {"type": "error", "class": _qualified_name(type(e)), "message": str(e)},
+                      time.perf_counter() - start)
+        raise
+    _recorder.add(label, key, encode(result), time.perf_counter() - start)
+    return result
+
+
+class CassetteIndex:
+    """Pinecone index whose query and upsert calls go through the cassette.
+
+    The real index is only opened when a call isn't replayed, so replays never contact Pinecone.
+    """
+
+    def __init__(self, name, open_index):
+        self.name = name
+        self._open_index = open_index
+        self._index = None
+
+    def _real(self):
+        if self._index is None:
+            self._index = self._open_index(self.name)
+        return self._index
+
+    def query(self, **kwargs):
+        return through(f"pinecone:{self.name}:query", kwargs, lambda: self._real().query(**kwargs))
+
+    def upsert(self, vectors, namespace=""):
+        # Upserts carry fresh ids and timestamps, so they are matched by namespace and order only
+        return through(f"pinecone:{self.name}:upsert", namespace,
+                       lambda: self._real().upsert(vectors=vectors, namespace=namespace))
+
+    def __getattr__(self, name):
+        # Maintenance calls (list, fetch, delete...) are not recorded
+        return getattr(self._real(), name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", nargs="?", default=PATH)
+    args = parser.parse_args()
+    entries = read(args.path)
+    calls, seconds, errors = Counter(), Counter(), Counter()
+    for entry in entries:
+        calls[entry["label"]] += 1
+        seconds[entry["label"]] += entry["seconds"]
+        errors[entry["label"]] += entry["response"]["type"] == "error"
+    print("call | count | errors | recorded seconds")
+    for label, count in calls.most_common():
+        print(f"{label} | {count} | {errors[label]} | {seconds[label]:.2f}")
+    print(f"{len(entries)} calls, {sum(seconds.values()):.2f}s upstream time")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import tiktoken
+from agent.tools import chat_completion
+
+# Summaries are produced off the request path, shared by all sessions
+_summarizer_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="conversation-summary")
+
+# Approximate per-message overhead of the chat format, in tokens
+MESSAGE_OVERHEAD = 4
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between an urban researcher and an assistant "
+    "refining a spatial analysis hypothesis. Update the summary with the new messages. Keep decisions, "
+    "constraints, variables, datasets and open questions; drop small talk. Answer with the summary only, "
+    "in at most 200 words."
+)
+
+
+class ConversationMemory:
+    """Keeps the last keep_turns exchanges verbatim and folds older ones into a rolling summary.
+
+    The summary is updated in a background thread after each turn, so the next request
+    never waits for it. build_messages() enforces token_budget on what is sent to the model.
+    """
+
+    def __init__(self, keep_turns=6, token_budget=3000, model="gpt-3.5-turbo"):
+        self.keep_turns = keep_turns
+        self.token_budget = token_budget
+        self.model = model
+        self.summary = ""
+        self.summarized_count = 0  # messages (after the leading system prompt) already in the summary
+        self._lock = threading.Lock()
+        self._pending = None
+        try:
+            self._encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            self._encoding = tiktoken.get_encoding("cl100k_base")
+
+    def count_tokens(self, messages):
+        return sum(len(self._encoding.encode(m["content"] or "")) + MESSAGE_OVERHEAD for m in messages)
+
+    def _split(self, history):
+        # history[0] is the system prompt set up by the Hypothesis Lab
+        if history and history[0]["role"] == "system":
+            return history[0], history[1:]
+        return None, history
+
+    def build_messages(self, history):
+        """Return system prompt + summary + recent turns, trimmed to the token budget."""
+        system, turns = self._split(history)
+        with self._lock:
+            summary, summarized_count = self.summary, self.summarized_count
+        head = [system] if system else []
+        recent = turns[summarized_count:]
+
+        # Drop the oldest unsummarized turns first, but always keep the latest message
+        summary_tokens = len(self._encoding.encode(SUMMARY_PREFIX + summary)) + MESSAGE_OVERHEAD if summary else 0
+        while len(recent) > 1 and self.count_tokens(head + recent) + summary_tokens > self.token_budget:
+            recent = recent[1:]
+
+        # Then shorten the summary to whatever room is left
+        if summary:
+            spare = (self.token_budget - self.count_tokens(head + recent)
+                     - len(self._encoding.encode(SUMMARY_PREFIX)) - MESSAGE_OVERHEAD)
+            if spare > 0:
+                summary = self._encoding.decode(self._encoding.encode(summary)[:spare])
+                head.append({"role": "system", "content": SUMMARY_PREFIX + summary})
+        return head + recent
+
+    def update(self, history):
+        """Fold turns that fell out of the verbatim window into the summary, in the background."""
+        _, turns = self._split(history)
+        foldable = len(turns) - 2 * self.keep_turns
+        with self._lock:
+            if foldable <= self.summarized_count or self._pending is not None:
+                return
+            new_messages = turns[self.summarized_count:foldable]
+            self._pending = _summarizer_pool.submit(self._summarize, self.summary, new_messages, foldable)
+
+    def _summarize(self, summary, new_messages, upto):
+        try:
+            transcript = "\n".join(f"{m['role']}: {m['content']}" for m in new_messages)
+            completion = chat_completion(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": f"Current summary:\n{summary or '(empty)'}\n\nNew messages:\n{transcript}"}
+                ]
+            )
+            with self._lock:
+                self.summary = completion.choices[0].message.content
+                self.summarized_count = upto
+        except Exception as e:
+            print("Conversation summary error:", e)
+        finally:
+            with self._lock:
+                self._pending = None
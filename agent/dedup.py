@@ -0,0 +1,183 @@
+import zlib
+from collections import defaultdict
+from urllib.parse import parse_qsl, urlencode, urlsplit
+import numpy as np
+from agent.text_index import tokenize
+
+# Query parameters that only track where a click came from
+TRACKING_PARAMS = {"fbclid", "gclid", "dclid", "msclkid", "mc_cid", "mc_eid", "igshid", "ref", "ref_src", "_ga", "_gl"}
+TRACKING_PREFIXES = ("utm_", "pk_", "hsa_")
+
+NUM_PERM = 64
+# 16 bands of 4 rows: pairs above ~0.5 estimated Jaccard almost always share a bucket
+BANDS = 16
+SIMILARITY_THRESHOLD = 0.8
+SHINGLE_SIZE = 3
+# Snippets with fewer shingles than this are only matched by URL
+MIN_SHINGLES = 8
+# Shingle hashes permuted per numpy step when signing a batch (x NUM_PERM uint64s, ~16 MB)
+HASH_CHUNK = 32768
+
+# Multiply-shift hashing: bits 32-63 of a * x + b, with odd a; uint64 arithmetic wraps,
+# so there is no modulo to compute
+_rng = np.random.default_rng(20240601)
+_A = _rng.integers(0, 2 ** 63, NUM_PERM, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+_B = _rng.integers(0, 2 ** 63, NUM_PERM, dtype=np.uint64)
+_SHIFT = np.uint64(32)
+
+
+def canonicalize_url(url):
+    """Key under which the same page is recognized: no scheme, "www.", fragment, tracking params or trailing slash."""
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    path = parts.path.rstrip("/")
+    query = [
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k.lower() not in TRACKING_PARAMS and not k.lower().startswith(TRACKING_PREFIXES)
+    ]
+    return f"{host}{path}" + (f"?{urlencode(sorted(query))}" if query else "")
+
+
+def shingles(result):
+    tokens = tokenize(f"{result.get('title', '')} {result.get('content', '')}")
+    return {" ".join(tokens[i:i + SHINGLE_SIZE]) for i in range(len(tokens) - SHINGLE_SIZE + 1)}
+
+
+def _shingle_hashes(shingle_set):
+    return np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingle_set), dtype=np.uint64, count=len(shingle_set))
+
+
+def _permute(hashes):
+    # One row per permutation, so each set's hashes stay a contiguous run of columns
+    permuted = np.empty((NUM_PERM, len(hashes)), dtype=np.uint64)
+    np.multiply(_A[:, None], hashes[None, :], out=permuted)
+    permuted += _B[:, None]
+    permuted >>= _SHIFT
+    return permuted
+
+
+def minhash(shingle_set):
+    """MinHash signature of a shingle set, or None when there are too few shingles to compare."""
+    if len(shingle_set) < MIN_SHINGLES:
+        return None
+    return _permute(_shingle_hashes(shingle_set)).min(axis=1)
+
+
+def minhash_many(shingle_sets):
+    """minhash() of each set, permuting the hashes of many sets in one numpy step."""
+    signatures = [None] * len(shingle_sets)
+    signed = [i for i, shingle_set in enumerate(shingle_sets) if len(shingle_set) >= MIN_SHINGLES]
+    # Sets are grouped up to HASH_CHUNK hashes, which bounds the permuted array's size
+    group, size = [], 0
+    for n, i in enumerate(signed):
+        group.append(i)
+        size += len(shingle_sets[i])
+        if size < HASH_CHUNK and n < len(signed) - 1:
+            continue
+        hashes = np.concatenate([_shingle_hashes(shingle_sets[j]) for j in group])
+        starts = np.cumsum([0] + [len(shingle_sets[j]) for j in group[:-1]])
+        for j, signature in zip(group, np.minimum.reduceat(_permute(hashes), starts, axis=1).T):
+            signatures[j] = signature
+        group, size = [], 0
+    return signatures
+
+
+def richness(result):
+    # The record with more text is the one worth keeping
+    return len(result.get("content") or "") + len(result.get("title") or "")
+
+
+class Deduplicator:
+    """Clusters results that are the same document under different URLs or with near-identical text.
+
+    URLs are canonicalized first; otherwise near-duplicates are found with MinHash
+    signatures and LSH banding, so each lookup only compares a handful of candidates.
+    Each cluster is represented by its richest record. dedupe() signs its whole batch
+    in one numpy step; tokenizing the text for shingles is most of what is left, and a
+    batch runs at a few thousand snippet-sized results a second.
+    """
+
+    def __init__(self):
+        self._by_url = {}  # canonical url -> cluster id
+        self._representatives = {}  # cluster id -> result
+        self._signatures = defaultdict(list)  # cluster id -> member signatures
+        self._buckets = defaultdict(set)  # (band, band bytes) -> cluster ids
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self._representatives)
+
+    def _band_keys(self, signature):
+        raw = signature.tobytes()
+        width = len(raw) // BANDS
+        return [(i, raw[i * width:(i + 1) * width]) for i in range(BANDS)]
+
+    def _similar_cluster(self, signature, band_keys):
+        candidates = set()
+        for key in band_keys:
+            candidates |= self._buckets.get(key, set())
+        best, best_score = None, SIMILARITY_THRESHOLD
+        for cluster in candidates:
+            score = max(float(np.mean(s == signature)) for s in self._signatures[cluster])
+            if score >= best_score:
+                best, best_score = cluster, score
+        return best
+
+    def _needs_signature(self, cluster):
+        return cluster is None or not self._signatures.get(cluster)
+
+    def add(self, result, signature=None):
+        """Assign result to a cluster. Returns (cluster id, record it displaced as representative or None).
+
+        signature is result's minhash() when the caller computed it already.
+        """
+        canonical = canonicalize_url(result["url"])
+        cluster = self._by_url.get(canonical)
+        if not self._needs_signature(cluster):
+            signature = None
+        elif signature is None:
+            signature = minhash(shingles(result))
+        band_keys = self._band_keys(signature) if signature is not None else ()
+        if cluster is None and signature is not None:
+            cluster = self._similar_cluster(signature, band_keys)
+
+        displaced = None
+        if cluster is None:
+            cluster = self._next_id
+            self._next_id += 1
+            self._representatives[cluster] = result
+        elif result is not self._representatives[cluster] and richness(result) > richness(self._representatives[cluster]):
+            displaced = self._representatives[cluster]
+            self._representatives[cluster] = result
+
+        if signature is not None:
+            self._signatures[cluster].append(signature)
+            for key in band_keys:
+                self._buckets[key].add(cluster)
+        self._by_url[canonical] = cluster
+        return cluster, displaced
+
+    def representative(self, result):
+        """Richest record of the cluster result belongs to (result itself if it was never added)."""
+        cluster = self._by_url.get(canonicalize_url(result["url"]))
+        return result if cluster is None else self._representatives[cluster]
+
+    def dedupe(self, results):
+        """Return (unique results in first-seen order, records displaced by richer duplicates)."""
+        results = list(results)
+        # Sign, in one batch, every result not already matched by URL to a signed cluster
+        pending = [i for i, r in enumerate(results) if self._needs_signature(self._by_url.get(canonicalize_url(r["url"])))]
+        signatures = [None] * len(results)
+        for i, signature in zip(pending, minhash_many([shingles(results[i]) for i in pending])):
+            signatures[i] = signature
+        clusters = []
+        displaced = []
+        for result, signature in zip(results, signatures):
+            cluster, old = self.add(result, signature)
+            clusters.append(cluster)
+            if old is not None:
+                displaced.append(old)
+        unique = [self._representatives[c] for c in dict.fromkeys(clusters)]
+        return unique, displaced
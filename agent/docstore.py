@@ -0,0 +1,183 @@
+import hashlib
+import os
+import threading
+import weakref
+import zlib
+from collections.abc import MutableMapping
+
+# Content at least this long is kept zlib-compressed; DOCSTORE_COMPRESS=0 keeps plain strings
+COMPRESS = os.getenv("DOCSTORE_COMPRESS", "1") != "0"
+COMPRESS_MIN_CHARS = 1024
+
+# Fields stored in slots; anything else a result carries goes to Document.extra
+CORE_FIELDS = ("url", "title", "content")
+
+
+def digest(text):
+    # Content hash documents are interned by; SessionStore keeps it with saved documents
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class _Content:
+    """One copy of a content string, shared by every document with identical content."""
+
+    __slots__ = ("data", "compressed", "__weakref__")
+
+    def __init__(self, text):
+        self.compressed = COMPRESS and len(text) >= COMPRESS_MIN_CHARS
+        self.data = zlib.compress(text.encode("utf-8")) if self.compressed else text
+
+    def text(self):
+        return zlib.decompress(self.data).decode("utf-8") if self.compressed else self.data
+
+    def nbytes(self):
+        return len(self.data) if self.compressed else len(self.data.encode("utf-8"))
+
+
+class _StoredContent:
+    """Content of a document saved in SQLite, read from there each time it is needed."""
+
+    __slots__ = ("load", "url", "__weakref__")
+
+    def __init__(self, load, url):
+        self.load = load
+        self.url = url
+
+    def text(self):
+        return self.load(self.url)
+
+    def nbytes(self):
+        return 0
+
+
+class Document(MutableMapping):
+    """Compact, shared search result that reads like the result dict it was made from.
+
+    url, title and content are fixed; other keys (e.g. coordinates added by geotagging)
+    are kept in a small extra dict, created only when needed. key identifies url, title
+    and content together, so it can stand in for the document in caches. Changing an
+    extra key marks the document dirty until SessionStore writes it again.
+    """
+
+    __slots__ = ("key", "url", "title", "_content", "extra", "dirty", "__weakref__")
+
+    def __init__(self, key, url, title, content, extra=None):
+        self.key = key
+        self.url = url
+        self.title = title
+        self._content = content
+        self.extra = extra or None
+        self.dirty = False
+
+    def __getitem__(self, key):
+        if key == "url":
+            return self.url
+        if key == "title":
+            return self.title
+        if key == "content":
+            return self._content.text()
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in CORE_FIELDS:
+            raise TypeError(f"'{key}' of a shared document can't be changed")
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+        self.dirty = True
+
+    def __delitem__(self, key):
+        if key in CORE_FIELDS or not self.extra or key not in self.extra:
+            raise KeyError(key)
+        del self.extra[key]
+        self.dirty = True
+
+    def __iter__(self):
+        yield from CORE_FIELDS
+        yield from self.extra or ()
+
+    def __len__(self):
+        return len(CORE_FIELDS) + len(self.extra or ())
+
+    # Interned: the same document is the same object, so identity is equality
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
+
+    def __repr__(self):
+        return f"Document({self.url!r}, {self.title!r})"
+
+
+class DocumentStore:
+    """Process-wide store that interns search results by content hash.
+
+    Sessions share one Document per distinct result and one content copy per distinct
+    text. Entries are weakly referenced, so a document disappears once no session,
+    index or cache holds it anymore.
+    """
+
+    def __init__(self):
+        self._documents = weakref.WeakValueDictionary()  # url + title + content hash -> Document
+        self._contents = weakref.WeakValueDictionary()  # content hash -> _Content
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._documents)
+
+    def intern(self, result):
+        """Return the shared Document for result (a result dict or a Document)."""
+        if isinstance(result, Document):
+            return result
+        content = result.get("content") or ""
+        extra = {k: v for k, v in result.items() if k not in CORE_FIELDS}
+        return self._intern(result["url"], result.get("title", ""), digest(content), extra, lambda: _Content(content))
+
+    def intern_stored(self, url, title, content_hash, extra, load):
+        """Return the shared Document for a saved result without reading its content.
+
+        Unless another document already holds the same text, the content is read with
+        load(url) whenever it is accessed.
+        """
+        return self._intern(url, title, content_hash, extra, lambda: _StoredContent(load, url))
+
+    def _intern(self, url, title, content_hash, extra, make_content):
+        key = digest(f"{url}\0{title}\0{content_hash}")
+        with self._lock:
+            document = self._documents.get(key)
+            if document is None:
+                shared = self._contents.get(content_hash)
+                if shared is None:
+                    shared = make_content()
+                    # Only text held in memory is shared with later documents
+                    if isinstance(shared, _Content):
+                        self._contents[content_hash] = shared
+                document = Document(key, url, title, shared, extra)
+                self._documents[key] = document
+            else:
+                # Keep what is already known (e.g. coordinates), add what is new
+                for k, v in extra.items():
+                    if document.extra is None or k not in document.extra:
+                        document[k] = v
+        return document
+
+    def get(self, key):
+        """Return the live Document with this key, or None."""
+        return self._documents.get(key)
+
+    def intern_many(self, results):
+        return [self.intern(r) for r in results]
+
+    def stats(self):
+        with self._lock:
+            contents = list(self._contents.values())
+            documents = len(self._documents)
+        return {
+            "documents": documents,
+            "contents": len(contents),
+            "content_bytes": sum(c.nbytes() for c in contents),
+        }
+
+
+# Shared by every session in the process
+documents = DocumentStore()
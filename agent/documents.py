@@ -0,0 +1,118 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from agent.fetch import fetch_pages
+from agent.tools import EMBEDDING_KEY, get_embeddings_batch
+from agent.rerank import embed_texts
+from agent.storage import chunked_urls, load_document_chunks, save_document_chunks
+from agent import metrics
+
+CHUNK_CHARS = 1200
+CHUNK_OVERLAP = 200
+EMBED_BATCH_SIZE = 64
+INGEST_WORKERS = 4
+
+
+def chunk_text(text, size=CHUNK_CHARS, overlap=CHUNK_OVERLAP):
+    """Split text into overlapping chunks of about size characters, breaking on whitespace."""
+    text = re.sub(r"\s+", " ", text).strip()
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            space = text.rfind(" ", start + size // 2, end)
+            end = space if space > 0 else end
+        chunks.append(text[start:end].strip())
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+    return [c for c in chunks if c]
+
+
+def ingest_document(url, force=False):
+    """Download, chunk and embed one document. Returns the number of stored chunks."""
+    if not force and url in chunked_urls([url], EMBEDDING_KEY):
+        return len(load_document_chunks(url))
+    start = time.perf_counter()
+    pieces = [(page, chunk) for page, text in fetch_pages(url) for chunk in chunk_text(text)]
+    metrics.record_timing("documents.fetch", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    stored = []
+    for i in range(0, len(pieces), EMBED_BATCH_SIZE):
+        batch = pieces[i:i + EMBED_BATCH_SIZE]
+        vectors = get_embeddings_batch([text for _, text in batch])
+        stored += [
+            (page, text, np.asarray(vector, dtype=np.float32).tobytes())
+            for (page, text), vector in zip(batch, vectors)
+        ]
+    metrics.record_timing("documents.embed", time.perf_counter() - start)
+
+    save_document_chunks(url, stored, EMBEDDING_KEY)
+    with _chunk_cache_lock:
+        _chunk_cache.pop(url, None)
+    metrics.increment("documents.ingested")
+    return len(stored)
+
+
+def ingest_documents(results, force=False):
+    """Ingest several documents concurrently. Returns {url: chunk count or error message}."""
+    def ingest(result):
+        try:
+            return ingest_document(result["url"], force)
+        except Exception as e:
+            metrics.increment("documents.failed")
+            return f"{type(e).__name__}: {e}"
+
+    with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as pool:
+        return dict(zip([r["url"] for r in results], pool.map(ingest, results)))
+
+
+# Decoded chunk matrices of recently used documents
+CHUNK_CACHE_SIZE = 64
+_chunk_cache = OrderedDict()
+_chunk_cache_lock = threading.Lock()
+
+
+def _document_chunks(url):
+    with _chunk_cache_lock:
+        if url in _chunk_cache:
+            _chunk_cache.move_to_end(url)
+            return _chunk_cache[url]
+    rows = load_document_chunks(url)
+    if not rows:
+        entry = ([], np.zeros((0, 0), dtype=np.float32))
+    else:
+        matrix = np.vstack([np.frombuffer(embedding, dtype=np.float32) for _, _, embedding in rows])
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        entry = ([(page, text) for page, text, _ in rows], matrix)
+    with _chunk_cache_lock:
+        _chunk_cache[url] = entry
+        while len(_chunk_cache) > CHUNK_CACHE_SIZE:
+            _chunk_cache.popitem(last=False)
+    return entry
+
+
+def retrieve_chunks(query, urls, k=6):
+    """Return the k chunks of the given documents most similar to query, best first."""
+    candidates = []
+    matrices = []
+    # Chunks embedded with another model can't be compared with the query
+    for url in chunked_urls(urls, EMBEDDING_KEY):
+        chunks, matrix = _document_chunks(url)
+        candidates += [(url, page, text) for page, text in chunks]
+        matrices.append(matrix)
+    if not candidates:
+        return []
+    query_vec = embed_texts([query])[0]
+    query_vec = query_vec / max(np.linalg.norm(query_vec), 1e-12)
+    scores = np.vstack(matrices) @ query_vec
+    best = np.argsort(-scores)[:k]
+    return [
+        {"url": candidates[i][0], "page": candidates[i][1], "text": candidates[i][2], "score": float(scores[i])}
+        for i in best
+    ]
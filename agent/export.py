@@ -0,0 +1,134 @@
+import json
+import zipfile
+import pyarrow as pa
+import pyarrow.parquet as pq
+from agent.tools import extract_result_city
+
+# Rows per Parquet row group; each group is built and written on its own, so memory stays flat
+ROW_GROUP_SIZE = 2000
+
+DOCUMENT_FIELDS = ("url", "title", "content", "city", "lat", "lon")
+DOCUMENTS_SCHEMA = pa.schema([
+    ("url", pa.string()),
+    ("title", pa.string()),
+    ("content", pa.string()),
+    ("city", pa.string()),
+    ("lat", pa.float64()),
+    ("lon", pa.float64()),
+    ("in_hypothesis_lab", pa.bool_()),
+    ("extra", pa.string()),  # JSON of any other fields the result carried
+])
+HYPOTHESES_SCHEMA = pa.schema([
+    ("candidate", pa.int32()),
+    ("position", pa.int32()),
+    ("statement", pa.string()),
+    ("spatial_variables", pa.list_(pa.string())),
+    ("suggested_datasets", pa.list_(pa.string())),
+    ("text", pa.string()),  # free-text candidates, which have no separate hypotheses
+])
+MEMORIES_SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("payload", pa.string()),
+    ("timestamp", pa.string()),
+])
+
+
+def _document_row(result, hypothesis_urls):
+    extra = {k: v for k, v in result.items() if k not in DOCUMENT_FIELDS}
+    return {
+        "url": result["url"],
+        "title": result.get("title", ""),
+        "content": result.get("content", ""),
+        # Geotagged documents carry their city; for the rest it is detected from the text
+        "city": result.get("city") or extract_result_city(result) or None,
+        "lat": result.get("lat"),
+        "lon": result.get("lon"),
+        "in_hypothesis_lab": result["url"] in hypothesis_urls,
+        "extra": json.dumps(extra, default=str) if extra else None,
+    }
+
+
+def _hypothesis_rows(candidates):
+    for i, candidate in enumerate(candidates):
+        if isinstance(candidate, list):
+            for j, h in enumerate(candidate):
+                yield {"candidate": i, "position": j, "statement": h["statement"],
+                       "spatial_variables": h.get("spatial_variables", []),
+                       "suggested_datasets": h.get("suggested_datasets", []), "text": None}
+        else:
+            yield {"candidate": i, "position": 0, "statement": None,
+                   "spatial_variables": [], "suggested_datasets": [], "text": candidate}
+
+
+def _write_table(archive, name, schema, rows):
+    with archive.open(name, "w") as f:
+        writer = pq.ParquetWriter(f, schema, compression="zstd")
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == ROW_GROUP_SIZE:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                batch = []
+        if batch:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+        writer.close()
+
+
+def export_research(fileobj, documents, hypothesis_urls=(), hypotheses=(), memories=()):
+    """Write documents, hypothesis candidates and memories to fileobj as a zip of Parquet files.
+
+    Each table is streamed in row groups, and the files load directly with
+    pandas.read_parquet or pyarrow once extracted.
+    """
+    hypothesis_urls = set(hypothesis_urls)
+    # Parquet is compressed already, so the zip only bundles the tables
+    with zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_STORED) as archive:
+        _write_table(archive, "documents.parquet", DOCUMENTS_SCHEMA,
+                     (_document_row(r, hypothesis_urls) for r in documents))
+        _write_table(archive, "hypotheses.parquet", HYPOTHESES_SCHEMA, _hypothesis_rows(hypotheses))
+        _write_table(archive, "memories.parquet", MEMORIES_SCHEMA,
+                     ({"id": m["id"], "payload": m["payload"], "timestamp": m.get("timestamp")} for m in memories))
+
+
+def _read_rows(archive, name):
+    if name not in archive.namelist():
+        return
+    with archive.open(name) as f:
+        for batch in pq.ParquetFile(f).iter_batches(batch_size=ROW_GROUP_SIZE):
+            yield from batch.to_pylist()
+
+
+def import_research(fileobj):
+    """Read an export_research() file.
+
+    Returns {"documents", "hypothesis_urls", "hypotheses", "memories"}; documents are
+    result dicts shaped like fresh search results.
+    """
+    documents, hypothesis_urls, candidates = [], set(), {}
+    with zipfile.ZipFile(fileobj) as archive:
+        for row in _read_rows(archive, "documents.parquet"):
+            result = {"url": row["url"], "title": row["title"] or "", "content": row["content"] or ""}
+            # Only coordinates from geotagging are kept; a text-detected city alone is found again on ingest
+            if row["lat"] is not None and row["lon"] is not None:
+                result.update(city=row["city"], lat=row["lat"], lon=row["lon"])
+            if row["extra"]:
+                result.update(json.loads(row["extra"]))
+            documents.append(result)
+            if row["in_hypothesis_lab"]:
+                hypothesis_urls.add(row["url"])
+        for row in _read_rows(archive, "hypotheses.parquet"):
+            if row["text"] is not None:
+                candidates[row["candidate"]] = row["text"]
+            else:
+                candidates.setdefault(row["candidate"], []).append({
+                    "statement": row["statement"],
+                    "spatial_variables": row["spatial_variables"] or [],
+                    "suggested_datasets": row["suggested_datasets"] or [],
+                })
+        memories = list(_read_rows(archive, "memories.parquet"))
+    return {
+        "documents": documents,
+        "hypothesis_urls": hypothesis_urls,
+        "hypotheses": [candidates[i] for i in sorted(candidates)],
+        "memories": memories,
+    }
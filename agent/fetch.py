@@ -0,0 +1,161 @@
+import codecs
+import re
+from html.parser import HTMLParser
+from itertools import chain
+from tempfile import SpooledTemporaryFile
+import requests
+from requests.compat import chardet
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # PDFs are skipped without pypdf
+    PdfReader = None
+
+# Hard ceilings so one huge document can't exhaust the container's memory
+MAX_DOCUMENT_BYTES = 25 * 1024 * 1024
+MAX_TEXT_CHARS = 400_000
+PDF_SPOOL_BYTES = 2 * 1024 * 1024  # larger PDFs are spooled to a temp file
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
+
+HEADERS = {"User-Agent": "Mozilla/5.0 (compatible; urban_lab_app/1.0)"}
+
+# Tags whose text is page furniture rather than document content
+SKIPPED_TAGS = {"script", "style", "noscript", "nav", "header", "footer", "aside", "form", "svg"}
+
+# Browsers look for a <meta> charset in the first 1024 bytes; some pages put it a little later
+META_SCAN_BYTES = 4096
+_HEADER_CHARSET = re.compile(r"charset\s*=\s*[\"']?([\w.:-]+)", re.IGNORECASE)
+_META_CHARSET = re.compile(rb"<meta[^>]+charset\s*=\s*[\"']?\s*([\w.:-]+)", re.IGNORECASE)
+_BOMS = ((codecs.BOM_UTF8, "utf-8-sig"), (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16"))
+
+
+class DocumentTooLarge(ValueError):
+    pass
+
+
+class _TextExtractor(HTMLParser):
+    """Collects visible text from HTML fed in pieces, stopping at max_chars."""
+
+    def __init__(self, max_chars):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.parts = []
+        self.length = 0
+        self._skip_depth = 0
+
+    @property
+    def full(self):
+        return self.length >= self.max_chars
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self._skip_depth += 1
+        self.parts.append(" ")
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+        self.parts.append(" ")
+
+    def handle_data(self, data):
+        # Data can arrive split mid-word across feeds, so it is joined without separators
+        if self._skip_depth or self.full:
+            return
+        self.parts.append(data[:self.max_chars - self.length])
+        self.length += len(self.parts[-1])
+
+    def text(self):
+        return re.sub(r"\s+", " ", "".join(self.parts)).strip()
+
+
+def _codec(name):
+    # Normalized codec name, or None for a charset Python doesn't know
+    if isinstance(name, bytes):
+        name = name.decode("ascii", "ignore")
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return None
+
+
+def _html_encoding(content_type, head):
+    """Encoding of an HTML document, from its Content-Type header and first bytes.
+
+    The header's charset wins, then a byte order mark, then a <meta> declaration.
+    Undeclared pages are read as UTF-8 unless their bytes aren't valid UTF-8, in which
+    case the encoding is detected.
+    """
+    declared = _HEADER_CHARSET.search(content_type)
+    if declared and _codec(declared.group(1)):
+        return _codec(declared.group(1))
+    for bom, encoding in _BOMS:
+        if head.startswith(bom):
+            return encoding
+    meta = _META_CHARSET.search(head[:META_SCAN_BYTES])
+    # A <meta> that could be read at all means an ASCII-compatible encoding, never UTF-16
+    if meta and _codec(meta.group(1)):
+        encoding = _codec(meta.group(1))
+        return "utf-8" if encoding.startswith("utf-16") else encoding
+    try:
+        head.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError as e:
+        # A multibyte character cut off at the end of the first chunk is still UTF-8
+        if e.reason == "unexpected end of data":
+            return "utf-8"
+    detected = chardet.detect(head).get("encoding") if chardet else None
+    return (detected and _codec(detected)) or "utf-8"
+
+
+def _html_pages(chunks, content_type):
+    chunks = iter(chunks)
+    head = next(chunks, b"")
+    decoder = codecs.getincrementaldecoder(_html_encoding(content_type, head))(errors="replace")
+    parser = _TextExtractor(MAX_TEXT_CHARS)
+    received = 0
+    for chunk in chain([head], chunks):
+        received += len(chunk)
+        parser.feed(decoder.decode(chunk))
+        # Stop downloading once there is enough text or the byte ceiling is hit
+        if parser.full or received >= MAX_DOCUMENT_BYTES:
+            break
+    parser.feed(decoder.decode(b"", final=True))
+    parser.close()
+    yield 1, parser.text()
+
+
+def _pdf_pages(chunks):
+    if PdfReader is None:
+        raise ValueError("PDF support requires the pypdf package")
+    with SpooledTemporaryFile(max_size=PDF_SPOOL_BYTES) as spool:
+        received = 0
+        for chunk in chunks:
+            received += len(chunk)
+            if received > MAX_DOCUMENT_BYTES:
+                # A truncated PDF can't be parsed, so refuse it outright
+                raise DocumentTooLarge(f"PDF larger than {MAX_DOCUMENT_BYTES} bytes")
+            spool.write(chunk)
+        spool.seek(0)
+        extracted = 0
+        for number, page in enumerate(PdfReader(spool).pages, 1):
+            text = page.extract_text() or ""
+            yield number, text
+            extracted += len(text)
+            if extracted >= MAX_TEXT_CHARS:
+                break
+
+
+def fetch_pages(url, timeout=20):
+    """Stream a document and yield (page_number, text). HTML is a single page."""
+    with requests.get(url, stream=True, timeout=timeout, headers=HEADERS) as response:
+        response.raise_for_status()
+        declared = int(response.headers.get("Content-Length") or 0)
+        if declared > MAX_DOCUMENT_BYTES:
+            raise DocumentTooLarge(f"{url} is {declared} bytes")
+        content_type = response.headers.get("Content-Type", "").lower()
+        chunks = response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES)
+        if "pdf" in content_type or url.lower().split("?")[0].endswith(".pdf"):
+            yield from _pdf_pages(chunks)
+        else:
+            # Not response.encoding: requests assumes ISO-8859-1 for any text/html without a charset
+            yield from _html_pages(chunks, content_type)
@@ -0,0 +1,98 @@
+import json
+from dataclasses import asdict, dataclass, field
+
+# Function the model is forced to call so hypotheses come back as JSON, not free text
+HYPOTHESIS_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "propose_hypotheses",
+        "description": "Propose researchable spatial analysis hypotheses.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "hypotheses": {
+                    "type": "array",
+                    "minItems": 3,
+                    "maxItems": 3,
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "statement": {
+                                "type": "string",
+                                "description": "The hypothesis, clearly worded in 1-2 sentences."
+                            },
+                            "spatial_variables": {
+                                "type": "array",
+                                "items": {"type": "string"},
+                                "description": "Spatial variables involved, e.g. green space access, density, land use."
+                            },
+                            "suggested_datasets": {
+                                "type": "array",
+                                "items": {"type": "string"},
+                                "description": "Datasets that could be used to test the hypothesis."
+                            }
+                        },
+                        "required": ["statement", "spatial_variables", "suggested_datasets"]
+                    }
+                }
+            },
+            "required": ["hypotheses"]
+        }
+    }
+}
+
+
+class HypothesisParseError(ValueError):
+    pass
+
+
+@dataclass
+class Hypothesis:
+    statement: str
+    spatial_variables: list = field(default_factory=list)
+    suggested_datasets: list = field(default_factory=list)
+
+    def to_dict(self):
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["statement"], list(data.get("spatial_variables", [])), list(data.get("suggested_datasets", [])))
+
+
+def _string_list(value, name):
+    if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+        raise HypothesisParseError(f"'{name}' must be a list of strings")
+    return [v.strip() for v in value if v.strip()]
+
+
+def parse_hypotheses(arguments, expected=3):
+    """Validate the JSON arguments of a propose_hypotheses call and return Hypothesis objects."""
+    try:
+        data = json.loads(arguments)
+    except (TypeError, json.JSONDecodeError) as e:
+        raise HypothesisParseError(f"invalid JSON: {e}")
+    items = data.get("hypotheses") if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        raise HypothesisParseError("missing 'hypotheses' list")
+
+    hypotheses = []
+    for item in items:
+        if not isinstance(item, dict):
+            raise HypothesisParseError("hypothesis must be an object")
+        statement = item.get("statement")
+        if not isinstance(statement, str) or not statement.strip():
+            raise HypothesisParseError("hypothesis without a statement")
+        hypotheses.append(Hypothesis(
+            statement.strip(),
+            _string_list(item.get("spatial_variables", []), "spatial_variables"),
+            _string_list(item.get("suggested_datasets", []), "suggested_datasets"),
+        ))
+    if len(hypotheses) < expected:
+        raise HypothesisParseError(f"expected {expected} hypotheses, got {len(hypotheses)}")
+    return hypotheses[:expected]
+
+
+def format_hypotheses(hypotheses):
+    # Numbered list, the same shape the free-text prompt asks for
+    return "\n".join(f"{i}. {h.statement}" for i, h in enumerate(hypotheses, 1))
@@ -0,0 +1,336 @@
+"""Load and memory soak test: simulated researchers walk through the whole app with stubbed upstreams.
+
+    python -m agent.loadtest --sessions 20 --concurrency 4 --waves 3
+
+Each session is driven with Streamlit's AppTest through search -> refine -> Research Box ->
+Hypothesis Lab. OpenAI, Pinecone, Tavily and Nominatim are replaced by in-process fakes
+(with optional simulated latency), so the numbers measure the app itself. Sessions are
+kept alive across waves, so memory growth per session shows up wave after wave.
+The exit status is non-zero if any simulated session failed to complete its walk.
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import numpy as np
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(ROOT, "streamlit_app.py")
+RUN_TIMEOUT = 60
+# AppTest swaps a process-wide Runtime and config in and out around every run, so script runs
+# from different sessions can't overlap; sessions interleave run by run instead, and the app's
+# own background work (prefetching, hedged searches) still runs concurrently
+APP_TEST_LOCK = threading.Lock()
+
+CITIES = ["Lisbon", "Barcelona", "Berlin", "Paris", "Madrid", "Copenhagen", "Bogota", "Curitiba", "Santiago", "Lima"]
+TOPICS = ["green corridors", "bike lanes", "heat islands", "bus rapid transit", "walkability", "flood risk"]
+FILLER = ("urban planning policy study land use density mobility housing public space accessibility "
+          "transport infrastructure neighbourhood census indicator analysis municipal report").split()
+
+# Session state that grows with the research, measured per session
+STATE_KEYS = [
+    "results", "all_search_results", "selected_results", "refined_results", "refined_search_results",
+    "hypothesis_results", "selected_for_refinement", "messages", "chat_history", "hypothesis_candidates",
+    "text_index", "spatial_index", "deduplicator", "hypothesis_memory", "box_summary",
+]
+
+
+def _seed(text):
+    return zlib.crc32(text.encode("utf-8"))
+
+
+def fake_content(seed, chars):
+    rng = np.random.default_rng(seed)
+    city = CITIES[seed % len(CITIES)]
+    words = [f"{city} {2000 + seed % 24}"]
+    while sum(len(w) + 1 for w in words) < chars:
+        words.append(FILLER[rng.integers(len(FILLER))])
+    return " ".join(words)[:chars]
+
+
+class FakeResponse(requests.Response):
+    def __init__(self, status_code, data):
+        super().__init__()
+        self.status_code = status_code
+        self._content = json.dumps(data).encode("utf-8")
+        self.headers["Content-Type"] = "application/json"
+
+
+class FakeUpstreams:
+    """In-process stand-ins for every external service the app calls."""
+
+    def __init__(self, llm_latency=0.0, search_latency=0.0, content_chars=3000):
+        self.llm_latency = llm_latency
+        self.search_latency = search_latency
+        self.content_chars = content_chars
+
+    # --- Tavily and the Nominatim details endpoint (both go through requests.request) ---
+    def request(self, method, url, **kwargs):
+        if "tavily" in url:
+            time.sleep(self.search_latency)
+            query = kwargs["json"]["query"]
+            results = []
+            for i in range(kwargs["json"].get("max_results") or 5):
+                seed = _seed(f"{query}/{i}")
+                results.append({
+                    "title": f"Study {seed % 10000} on {query[:60]}",
+                    "url": f"https://example.org/studies/{seed}",
+                    "content": fake_content(seed, self.content_chars),
+                    "score": 1 / (i + 1),
+                })
+            return FakeResponse(200, {"results": results})
+        if "nominatim" in url:
+            return FakeResponse(200, {"geometry": {"type": "Point", "coordinates": [-9.14, 38.72]}})
+        return FakeResponse(404, {})
+
+    # --- Nominatim geocoding ---
+    def geocode(self, query, *args, **kwargs):
+        from geopy.location import Location
+        seed = _seed(query)
+        lat, lon = (seed % 12000) / 100 - 60, (seed % 36000) / 100 - 180
+        return Location(query, (lat, lon), {"osm_id": seed, "osm_type": "relation"})
+
+    # --- OpenAI ---
+    def chat(self, **kwargs):
+        from openai.types.chat import ChatCompletion
+        time.sleep(self.llm_latency)
+        messages = kwargs["messages"]
+        last = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+        choices = []
+        for i in range(kwargs.get("n", 1)):
+            message = {"role": "assistant", "content": None}
+            if kwargs.get("tool_choice"):
+                hypotheses = [
+                    {"statement": f"Hypothesis {j} ({i}): access to {TOPICS[j]} varies with income.",
+                     "spatial_variables": ["income", TOPICS[j]], "suggested_datasets": ["census", "OpenStreetMap"]}
+                    for j in range(3)
+                ]
+                message["tool_calls"] = [self._tool_call("propose_hypotheses", {"hypotheses": hypotheses})]
+            elif kwargs.get("tools") and messages[-1]["role"] == "user":
+                message["tool_calls"] = [self._tool_call("web_search", {
+                    "city": CITIES[_seed(last) % len(CITIES)], "topic": last[:80],
+                    "timeframe": "2015-2024", "doc_type": "Reports",
+                })]
+            else:
+                message["content"] = "\n".join(f"{j}. A simulated answer about {last[:40]}." for j in range(1, 4))
+            choices.append({"index": i, "finish_reason": "stop", "message": message})
+        return ChatCompletion.model_validate({
+            "id": "loadtest", "object": "chat.completion", "created": int(time.time()),
+            "model": kwargs["model"], "choices": choices,
+        })
+
+    def _tool_call(self, name, arguments):
+        return {"id": f"call_{name}", "type": "function", "function": {"name": name, "arguments": json.dumps(arguments)}}
+
+    def embeddings(self, input, model, dimensions=None, **kwargs):
+        from openai.types import CreateEmbeddingResponse
+        texts = [input] if isinstance(input, str) else input
+        size = dimensions or 1536
+        data = [
+            {"object": "embedding", "index": i,
+             "embedding": np.random.default_rng(_seed(t)).standard_normal(size).astype(np.float32).tolist()}
+            for i, t in enumerate(texts)
+        ]
+        return CreateEmbeddingResponse.model_validate({
+            "object": "list", "model": model, "data": data, "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        })
+
+
+class FakeIndex:
+    def upsert(self, vectors, namespace=None):
+        return {"upserted_count": len(vectors)}
+
+    def query(self, **kwargs):
+        return {"matches": []}
+
+
+class FakePinecone:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def Index(self, *args, **kwargs):
+        return FakeIndex()
+
+
+def install_stubs(upstreams):
+    # Must run before anything imports agent.tools, which connects to Pinecone at import time
+    for key in ("OPENAI_API_KEY", "PINECONE_API_KEY", "TAVILY_API_KEY", "PINECONE_INDEX_NAME"):
+        os.environ.setdefault(key, "loadtest")
+    os.environ["OMBU_DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="ombu-loadtest-"), "loadtest.db")
+    import pinecone
+    pinecone.Pinecone = FakePinecone
+    requests.request = upstreams.request
+    from geopy.geocoders import Nominatim
+    Nominatim.geocode = lambda self, query, *args, **kwargs: upstreams.geocode(query)
+
+    from agent import ratelimit, tools
+    tools.client = SimpleNamespace(
+        chat=SimpleNamespace(completions=SimpleNamespace(create=upstreams.chat)),
+        embeddings=SimpleNamespace(create=upstreams.embeddings),
+    )
+    tools.index = FakeIndex()
+    # The fakes have no quotas, so the limiters would only measure themselves
+    for name in ratelimit.PROVIDERS:
+        ratelimit.PROVIDERS[name] = ratelimit.ProviderLimiter(name, requests_per_second=10000, concurrency=1000)
+
+
+def deep_size(obj, seen=None):
+    """Approximate bytes held by obj, counting shared objects once."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif type(obj).__module__.startswith("agent."):
+        # The app's own index/memory objects; library objects (locks, connections) are left out
+        if hasattr(obj, "__dict__"):
+            size += deep_size(vars(obj), seen)
+        for slot in getattr(type(obj), "__slots__", ()):
+            if hasattr(obj, slot):
+                size += deep_size(getattr(obj, slot), seen)
+    return size
+
+
+def _by_label(widgets, prefix):
+    return next(w for w in widgets if w.label.startswith(prefix))
+
+
+def _drop_stale_widgets(block, state):
+    # After a step that called st.rerun(), AppTest's element tree still holds the widgets of the
+    # interrupted run past the end of the final one. Their state is gone, and AppTest would fail
+    # looking it up on the next run, so they are dropped (a browser clears them the same way).
+    from streamlit.testing.v1.element_tree import Widget
+    for position, node in list(block.children.items()):
+        if isinstance(node, Widget) and node.id not in state:
+            del block.children[position]
+        elif hasattr(node, "children"):
+            _drop_stale_widgets(node, state)
+
+
+class SimulatedResearcher:
+    def __init__(self, number):
+        from streamlit.testing.v1 import AppTest
+        self.number = number
+        self.app = AppTest.from_file(APP_PATH, default_timeout=RUN_TIMEOUT)
+        self.rerun_times = []
+
+    def _run(self, element=None):
+        with APP_TEST_LOCK:
+            start = time.perf_counter()
+            (element or self.app).run()
+            self.rerun_times.append(time.perf_counter() - start)
+            for block in (self.app.main, self.app.sidebar):
+                _drop_stale_widgets(block, self.app.session_state)
+        if self.app.exception:
+            raise RuntimeError(f"session {self.number}: {self.app.exception[0].message}")
+
+    def walk(self):
+        """search -> select -> refine -> Research Box -> Hypothesis Lab -> refinement chat."""
+        at = self.app
+        city = CITIES[self.number % len(CITIES)]
+        topic = TOPICS[self.number % len(TOPICS)]
+        self._run()
+        self._run(_by_label(at.text_input, "City").input(city))
+        self._run(_by_label(at.text_input, "Topic").input(topic))
+        self._run(_by_label(at.button, "🔍 Start Research").click())
+
+        for i in range(1, min(3, len(at.session_state.results)) + 1):
+            self._run(at.button(key=f"add_refined_{i}").click())
+            self._run(at.button(key=f"refine_refined_{i}").click())
+        self._run(_by_label(at.button, "🕵🏻‍♀️ Start Refinement").click())
+
+        self._run(at.button(key="refine_selected_1").click())
+        self._run(at.text_input(key="refined_topic_input").input(f"{topic} in comparable cities"))
+        self._run(at.button(key="analyze_btn").click())
+        self._run(_by_label(at.button, "✨ Go to my research box").click())
+
+        for i in range(1, min(2, len(at.session_state.selected_results)) + 1):
+            self._run(at.button(key=f"hypothesis_box_{i}").click())
+        self._run(_by_label(at.button, "🔮 Take me now").click())
+        generate = [b for b in at.button if b.label.startswith("✨ Generate Hypotheses")]
+        if generate:
+            self._run(generate[0].click())
+        if at.chat_input:
+            self._run(at.chat_input[0].set_value("Can we focus on low-income neighbourhoods?"))
+
+    def state_bytes(self):
+        state = self.app.session_state
+        seen = set()
+        return sum(deep_size(state[key], seen) for key in STATE_KEYS if key in state)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)] if values else 0.0
+
+
+def run_wave(researchers, concurrency):
+    for r in researchers:
+        r.rerun_times = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(r.walk) for r in researchers]
+        failures = [f.exception() for f in futures if f.exception()]
+    elapsed = time.perf_counter() - start
+    times = [t for r in researchers for t in r.rerun_times]
+    sizes = [r.state_bytes() for r in researchers]
+    return {
+        "sessions": len(researchers),
+        "failures": len(failures),
+        "first_failure": str(failures[0]) if failures else "",
+        "seconds": elapsed,
+        "flows_per_s": (len(researchers) - len(failures)) / elapsed,
+        "reruns_per_s": len(times) / elapsed,
+        "rerun_p50_ms": percentile(times, 0.5) * 1000,
+        "rerun_p95_ms": percentile(times, 0.95) * 1000,
+        "rerun_p99_ms": percentile(times, 0.99) * 1000,
+        "state_kb_mean": float(np.mean(sizes)) / 1024 if sizes else 0.0,
+        "state_kb_max": max(sizes, default=0) / 1024,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=10, help="new simulated sessions per wave")
+    parser.add_argument("--concurrency", type=int, default=4, help="sessions driven at the same time")
+    parser.add_argument("--waves", type=int, default=1, help="waves of new sessions; earlier sessions stay alive")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="simulated seconds per chat completion")
+    parser.add_argument("--search-latency", type=float, default=0.0, help="simulated seconds per web search")
+    parser.add_argument("--content-chars", type=int, default=3000, help="characters of content per search result")
+    args = parser.parse_args()
+
+    os.chdir(ROOT)  # the app loads its logo by relative path
+    install_stubs(FakeUpstreams(args.llm_latency, args.search_latency, args.content_chars))
+
+    alive = []
+    failed = 0
+    for wave in range(1, args.waves + 1):
+        researchers = [SimulatedResearcher(len(alive) + i) for i in range(args.sessions)]
+        report = run_wave(researchers, args.concurrency)
+        alive += researchers
+        report["alive"] = len(alive)
+        print(f"wave {wave}: " + ", ".join(
+            f"{k}={v:.1f}" if isinstance(v, float) else f"{k}={v}" for k, v in report.items() if v != ""
+        ))
+        failed += report["failures"]
+    if failed:
+        sys.exit(f"{failed} simulated sessions failed")
+
+
+if __name__ == "__main__":
+    main()
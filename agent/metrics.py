@@ -0,0 +1,62 @@
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# Process-wide counters and timings, shared by all sessions
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_timings = defaultdict(lambda: deque(maxlen=1000))
+
+
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] += amount
+
+
+def record_timing(name, seconds):
+    with _lock:
+        _timings[name].append(seconds)
+
+
+@contextmanager
+def timed(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(name, time.perf_counter() - start)
+
+
+def _percentile(sorted_values, q):
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def snapshot():
+    """Return counters and per-name timing stats (count, mean, p50, p95 in seconds)."""
+    with _lock:
+        counters = dict(_counters)
+        timings = {name: sorted(values) for name, values in _timings.items() if values}
+    stats = {
+        name: {
+            "count": len(values),
+            "mean": sum(values) / len(values),
+            "p50": _percentile(values, 0.5),
+            "p95": _percentile(values, 0.95),
+        }
+        for name, values in timings.items()
+    }
+    return {"counters": counters, "timings": stats}
+
+
+def percentile(name, q, min_count=1):
+    """q-quantile of the timings recorded for name, or None while there are fewer than min_count."""
+    with _lock:
+        values = sorted(_timings.get(name, ()))
+    return _percentile(values, q) if len(values) >= min_count and values else None
+
+
+def ratio(hits_name, misses_name):
+    with _lock:
+        hits, misses = _counters[hits_name], _counters[misses_name]
+    return hits / (hits + misses) if hits + misses else 0.0
@@ -0,0 +1,62 @@
+"""Move recall memories from the shared Pinecone namespace into per-user namespaces.
+
+    python -m agent.migrate_memories --dry-run
+    python -m agent.migrate_memories --map 1234=someone@example.org --delete
+
+Vectors keep their ids, so an interrupted run can simply be started again.
+"""
+import argparse
+from collections import defaultdict
+from agent.tools import SHARED_MEMORY_NAMESPACE, index, memory_namespace
+
+BATCH_SIZE = 100
+
+
+def migrate(user_map=None, batch_size=BATCH_SIZE, delete=False, dry_run=False):
+    """Copy (and optionally delete) every recall memory of the shared namespace. Returns {user_id: count}."""
+    user_map = user_map or {}
+    moved = defaultdict(int)
+    for ids in index.list(namespace=SHARED_MEMORY_NAMESPACE, limit=batch_size):
+        fetched = index.fetch(ids=list(ids), namespace=SHARED_MEMORY_NAMESPACE).vectors
+        by_user = defaultdict(list)
+        for vector_id, vector in fetched.items():
+            metadata = vector.metadata or {}
+            if metadata.get("type") != "recall" or not metadata.get("user_id"):
+                continue
+            user_id = user_map.get(metadata["user_id"], metadata["user_id"])
+            by_user[user_id].append({
+                "id": vector_id,
+                "values": vector.values,
+                "metadata": {**metadata, "user_id": user_id},
+            })
+
+        for user_id, vectors in by_user.items():
+            if not dry_run:
+                index.upsert(vectors=vectors, namespace=memory_namespace(user_id))
+            moved[user_id] += len(vectors)
+        if delete and not dry_run:
+            # Only what was copied above is removed from the shared namespace
+            copied = [v["id"] for vectors in by_user.values() for v in vectors]
+            if copied:
+                index.delete(ids=copied, namespace=SHARED_MEMORY_NAMESPACE)
+    return dict(moved)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--map", action="append", default=[], metavar="OLD=NEW",
+                        help="store OLD's memories under user NEW (e.g. the legacy id 1234)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--delete", action="store_true", help="delete migrated vectors from the shared namespace")
+    parser.add_argument("--dry-run", action="store_true", help="count what would be moved without writing")
+    args = parser.parse_args()
+
+    user_map = dict(pair.split("=", 1) for pair in args.map)
+    moved = migrate(user_map, args.batch_size, args.delete, args.dry_run)
+    for user_id, count in sorted(moved.items()):
+        print(f"{user_id}: {count} memories -> {memory_namespace(user_id)}")
+    print(f"{sum(moved.values())} memories {'to migrate' if args.dry_run else 'migrated'}")
+
+
+if __name__ == "__main__":
+    main()
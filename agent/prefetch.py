@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from agent import metrics
+
+# PREFETCH=0 turns speculative work off
+ENABLED = os.getenv("PREFETCH", "1") != "0"
+WORKERS = int(os.getenv("PREFETCH_WORKERS", "2"))
+# Speculative tasks one session may start over its lifetime
+SESSION_BUDGET = int(os.getenv("PREFETCH_SESSION_BUDGET", "20"))
+
+
+class _Task:
+    __slots__ = ("key", "fn", "args", "timer", "future", "claimed")
+
+    def __init__(self, key, fn, args):
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.timer = None
+        self.future = None
+        self.claimed = False
+
+
+class Prefetcher:
+    """Runs likely next steps in the background so the click that asks for them finds them done.
+
+    Each session has one slot per kind of work. Scheduling a different key for a slot
+    cancels the task in it; a task only starts once its key has stayed the same for its
+    delay, so work isn't started for a selection the user is still changing.
+    """
+
+    def __init__(self, workers=WORKERS, session_budget=SESSION_BUDGET):
+        self.session_budget = session_budget
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self._slots = {}  # (session id, kind) -> _Task
+        self._started = Counter()  # session id -> tasks started
+        self._lock = threading.Lock()
+
+    def schedule(self, session_id, kind, key, fn, *args, delay=0.0):
+        """Run fn(*args) after delay unless the slot already holds key. Returns False when not scheduled."""
+        if not ENABLED:
+            return False
+        with self._lock:
+            slot = (session_id, kind)
+            task = self._slots.get(slot)
+            if task is not None and task.key == key:
+                return True
+            if self._started[session_id] >= self.session_budget:
+                metrics.increment("prefetch.over_budget")
+                return False
+            if task is not None:
+                self._discard(task)
+            task = _Task(key, fn, args)
+            self._slots[slot] = task
+            task.timer = threading.Timer(delay, self._start, (slot, task))
+            task.timer.daemon = True
+            task.timer.start()
+        return True
+
+    def _start(self, slot, task):
+        with self._lock:
+            # Replaced while waiting, or already started by a claim
+            if self._slots.get(slot) is not task or task.future is not None:
+                return
+            if self._started[slot[0]] >= self.session_budget:
+                metrics.increment("prefetch.over_budget")
+                del self._slots[slot]
+                return
+            self._started[slot[0]] += 1
+            task.future = self._pool.submit(self._run, task)
+        metrics.increment("prefetch.started")
+
+    def _run(self, task):
+        with metrics.timed("prefetch.run"):
+            return task.fn(*task.args)
+
+    def _discard(self, task):
+        task.timer.cancel()
+        if task.future is None or task.future.cancel():
+            return
+        # Already running or finished for a key nobody asked for
+        if not task.claimed:
+            metrics.increment("prefetch.wasted")
+
+    def wait(self, session_id, kind, key, timeout=None):
+        """Wait for the slot's work on key, starting it now if it is still delayed.
+
+        Returns True if prefetched work for key finished (its results are in the caches
+        the caller reads next), False if there was none or it failed.
+        """
+        slot = (session_id, kind)
+        with self._lock:
+            task = self._slots.get(slot)
+        if task is None or task.key != key:
+            metrics.increment("prefetch.misses")
+            return False
+        task.timer.cancel()
+        self._start(slot, task)
+        if task.future is None:
+            # Over budget: the caller does the work itself
+            metrics.increment("prefetch.misses")
+            return False
+        task.claimed = True
+        start = time.perf_counter()
+        try:
+            task.future.result(timeout)
+        except Exception as e:
+            # Cancelled, timed out or failed: the caller does the work itself
+            print("Prefetch not used:", e)
+            metrics.increment("prefetch.misses")
+            return False
+        metrics.record_timing("prefetch.wait", time.perf_counter() - start)
+        metrics.increment("prefetch.hits")
+        return True
+
+
+# Shared by every session in the process
+prefetcher = Prefetcher()
@@ -0,0 +1,183 @@
+"""Opt-in sampling profiler for script runs, fragment runs and agent calls.
+
+    PROFILING=1 streamlit run streamlit_app.py
+
+While enabled, a background thread samples the stacks of threads that are inside a
+profiled section every PROFILE_INTERVAL_MS and attributes each sample to the innermost
+section. Every PROFILE_FLUSH_SECONDS the samples are written to PROFILE_DIR as
+<label>-<timestamp>.folded files (collapsed stacks, readable by flamegraph.pl and
+speedscope); the newest PROFILE_KEEP_FILES per label are kept. When PROFILING is
+unset nothing is started and the hooks return immediately.
+"""
+import glob
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from functools import wraps
+
+PROFILING = os.getenv("PROFILING") == "1"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+SAMPLE_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+FLUSH_SECONDS = float(os.getenv("PROFILE_FLUSH_SECONDS", "60"))
+KEEP_FILES = int(os.getenv("PROFILE_KEEP_FILES", "20"))
+MAX_DEPTH = 128
+
+_lock = threading.Lock()
+_sections = {}  # thread id -> labels of the open sections, innermost last
+_window = defaultdict(Counter)  # label -> folded stack -> samples since the last flush
+_self_samples = defaultdict(Counter)  # label -> function -> samples with it on top
+_total_samples = defaultdict(Counter)  # label -> function -> samples with it anywhere on the stack
+_sample_counts = Counter()  # label -> samples
+_sampled_seconds = Counter()  # label -> wall time covered by its samples
+_sampler = None
+_DISABLED = nullcontext()
+
+
+def _frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _stack(frame):
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        names.append(_frame_name(frame.f_code))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+def _take_sample(elapsed):
+    frames = sys._current_frames()
+    with _lock:
+        for thread_id in list(_sections):
+            frame = frames.get(thread_id)
+            if frame is None:
+                # The thread ended inside a section
+                del _sections[thread_id]
+                continue
+            label = _sections[thread_id][-1]
+            names = _stack(frame)
+            _window[label][";".join(names)] += 1
+            _self_samples[label][names[-1]] += 1
+            _total_samples[label].update(set(names))
+            _sample_counts[label] += 1
+            _sampled_seconds[label] += elapsed
+
+
+def _flush():
+    with _lock:
+        window = {label: stacks for label, stacks in _window.items() if stacks}
+        _window.clear()
+    if not window:
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    for label, stacks in window.items():
+        with open(os.path.join(PROFILE_DIR, f"{label}-{stamp}.folded"), "w") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in stacks.items())
+        # Timestamps sort chronologically, so everything before the newest KEEP_FILES goes
+        for path in sorted(glob.glob(os.path.join(PROFILE_DIR, f"{label}-*.folded")))[:-KEEP_FILES]:
+            os.remove(path)
+
+
+def _run_sampler():
+    last = time.monotonic()
+    next_flush = last + FLUSH_SECONDS
+    while True:
+        time.sleep(SAMPLE_INTERVAL)
+        now = time.monotonic()
+        if _sections:
+            # Sleeps overshoot, so each sample stands for the time since the previous one
+            _take_sample(now - last)
+        last = now
+        if now >= next_flush:
+            _flush()
+            next_flush = time.monotonic() + FLUSH_SECONDS
+
+
+def _ensure_sampler():
+    global _sampler
+    with _lock:
+        if _sampler is None:
+            _sampler = threading.Thread(target=_run_sampler, name="profiler", daemon=True)
+            _sampler.start()
+
+
+def begin(label):
+    """Start a top-level section on this thread, replacing any a previous run left open."""
+    if not PROFILING:
+        return
+    _ensure_sampler()
+    with _lock:
+        _sections[threading.get_ident()] = [label]
+
+
+def end():
+    if not PROFILING:
+        return
+    with _lock:
+        _sections.pop(threading.get_ident(), None)
+
+
+@contextmanager
+def _section(label):
+    _ensure_sampler()
+    thread_id = threading.get_ident()
+    with _lock:
+        _sections.setdefault(thread_id, []).append(label)
+    try:
+        yield
+    finally:
+        with _lock:
+            labels = _sections.get(thread_id)
+            if labels:
+                labels.pop()
+                if not labels:
+                    del _sections[thread_id]
+
+
+def section(label):
+    """Context manager attributing samples taken inside it to label."""
+    return _section(label) if PROFILING else _DISABLED
+
+
+def profiled(label=None):
+    """Decorator form of section(); returns the function unchanged when profiling is off."""
+    def decorate(fn):
+        if not PROFILING:
+            return fn
+        name = label or fn.__name__
+
+        @wraps(fn)
+        def run(*args, **kwargs):
+            with _section(name):
+                return fn(*args, **kwargs)
+        return run
+    return decorate
+
+
+def labels():
+    with _lock:
+        return [label for label, _ in _sample_counts.most_common()]
+
+
+def top_functions(label, n=20):
+    """Hottest functions in label since startup, by samples with the function on top of the stack."""
+    with _lock:
+        samples = _sample_counts[label]
+        seconds = _sampled_seconds[label]
+        hot = _self_samples[label].most_common(n)
+        totals = _total_samples[label]
+        return [
+            {
+                "function": name,
+                "self %": 100 * count / samples,
+                "total %": 100 * totals[name] / samples,
+                "self ms": 1000 * seconds * count / samples,
+            }
+            for name, count in hot
+        ]
@@ -1,10 +1,10 @@
-from agent.tools import load_memories
+from agent.tools import ANONYMOUS_USER_ID, load_memories
 from datetime import datetime
 
 
 
-def get_system_prompt(user_prompt, mode="search"):
-    memories = load_memories(user_prompt)
+def get_system_prompt(user_prompt, mode="search", user_id=ANONYMOUS_USER_ID):
+    memories = load_memories(user_prompt, user_id)
 
     if mode == "search":
         mode_instructions = """
@@ -0,0 +1,207 @@
+import os
+import random
+import threading
+import time
+import requests
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+from agent import cassette, metrics
+
+try:
+    from openai import RateLimitError as OpenAIRateLimitError
+except ImportError:
+    OpenAIRateLimitError = None
+try:
+    from geopy.exc import GeocoderRateLimited
+except ImportError:
+    GeocoderRateLimited = None
+
+# How long a call may wait in the queue before giving up
+MAX_QUEUE_SECONDS = float(os.getenv("RATE_LIMIT_MAX_QUEUE_SECONDS", "60"))
+MAX_ATTEMPTS = 5
+
+
+class RateLimited(Exception):
+    """Raised when an upstream answers 429/503; retry_after is in seconds when the upstream says so."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QueueTimeout(Exception):
+    pass
+
+
+def _parse_retry_after(value):
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after_from(exc):
+    if isinstance(exc, RateLimited):
+        return exc.retry_after
+    if OpenAIRateLimitError and isinstance(exc, OpenAIRateLimitError):
+        return _parse_retry_after(exc.response.headers.get("retry-after"))
+    if GeocoderRateLimited and isinstance(exc, GeocoderRateLimited):
+        return _parse_retry_after(exc.retry_after)
+    return None
+
+
+def is_rate_limited(exc):
+    return (
+        isinstance(exc, RateLimited)
+        or (OpenAIRateLimitError is not None and isinstance(exc, OpenAIRateLimitError))
+        or (GeocoderRateLimited is not None and isinstance(exc, GeocoderRateLimited))
+    )
+
+
+class TokenBucket:
+    """Blocking token bucket: acquire() waits until enough capacity has refilled."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount=1, timeout=MAX_QUEUE_SECONDS):
+        amount = min(amount, self.capacity)
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                wait = (amount - self._tokens) / self.rate
+            if time.monotonic() + wait > deadline:
+                raise QueueTimeout(f"waited more than {timeout}s for capacity")
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Drain the bucket so that every caller waits at least `seconds`
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+class AdaptiveConcurrency:
+    """AIMD limit on in-flight calls: +1/limit per success, halved on every throttle."""
+
+    def __init__(self, initial, minimum=1, maximum=None):
+        self.minimum = minimum
+        self.maximum = maximum or initial
+        self.limit = float(initial)
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=MAX_QUEUE_SECONDS):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.in_flight < int(self.limit), timeout):
+                raise QueueTimeout(f"waited more than {timeout}s for a concurrency slot")
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit / 2)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+class ProviderLimiter:
+    def __init__(self, name, requests_per_second, concurrency, tokens_per_minute=None):
+        self.name = name
+        self.requests = TokenBucket(requests_per_second, max(requests_per_second, 1))
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute) if tokens_per_minute else None
+        self.concurrency = AdaptiveConcurrency(concurrency, maximum=concurrency)
+
+    def _wait(self, retry_state):
+        exc = retry_state.outcome.exception()
+        retry_after = retry_after_from(exc)
+        if retry_after is not None:
+            # Honor the upstream's Retry-After, with jitter so queued callers don't stampede
+            return retry_after + random.uniform(0, 1)
+        return wait_random_exponential(multiplier=0.5, max=20)(retry_state)
+
+    def _attempt(self, fn, args, kwargs, tokens):
+        start = time.perf_counter()
+        self.requests.acquire()
+        if self.tokens and tokens:
+            self.tokens.acquire(tokens)
+        self.concurrency.acquire()
+        metrics.record_timing(f"ratelimit.{self.name}.queued", time.perf_counter() - start)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            throttled = is_rate_limited(e)
+            self.concurrency.release(throttled)
+            if throttled:
+                metrics.increment(f"ratelimit.{self.name}.throttled")
+                retry_after = retry_after_from(e)
+                if retry_after:
+                    self.requests.pause(retry_after)
+            raise
+        self.concurrency.release()
+        return result
+
+    def call(self, fn, *args, tokens=0, **kwargs):
+        for attempt in Retrying(
+            retry=retry_if_exception(is_rate_limited),
+            wait=self._wait,
+            stop=stop_after_attempt(MAX_ATTEMPTS),
+            reraise=True,
+        ):
+            with attempt:
+                return self._attempt(fn, args, kwargs, tokens)
+
+
+# Shared by every session in the process
+PROVIDERS = {
+    "openai": ProviderLimiter(
+        "openai",
+        requests_per_second=float(os.getenv("OPENAI_RPS", "5")),
+        concurrency=int(os.getenv("OPENAI_CONCURRENCY", "8")),
+        tokens_per_minute=int(os.getenv("OPENAI_TPM", "90000")),
+    ),
+    "tavily": ProviderLimiter(
+        "tavily",
+        requests_per_second=float(os.getenv("TAVILY_RPS", "2")),
+        concurrency=int(os.getenv("TAVILY_CONCURRENCY", "4")),
+    ),
+    # Nominatim's usage policy: at most 1 request per second
+    "nominatim": ProviderLimiter("nominatim", requests_per_second=1, concurrency=1),
+}
+
+
+def limited(provider, fn, *args, tokens=0, **kwargs):
+    """Call fn through the provider's rate limiter, retrying (with jitter) when throttled."""
+    return cassette.through(
+        f"{provider}:{getattr(fn, '__qualname__', fn)}", [args, kwargs],
+        lambda: PROVIDERS[provider].call(fn, *args, tokens=tokens, **kwargs)
+    )
+
+
+def limited_request(provider, method, url, **kwargs):
+    """Rate-limited requests call; 429/503 answers are retried, honoring Retry-After."""
+    def send():
+        response = requests.request(method, url, **kwargs)
+        if response.status_code in (429, 503):
+            raise RateLimited(
+                f"{provider} answered HTTP {response.status_code}",
+                _parse_retry_after(response.headers.get("Retry-After"))
+            )
+        return response
+    # Headers carry the API keys, so they are left out of the recorded request
+    request = [method, url, {k: v for k, v in kwargs.items() if k != "headers"}]
+    return cassette.through(f"{provider}:{method}", request, lambda: PROVIDERS[provider].call(send))
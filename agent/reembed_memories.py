@@ -0,0 +1,88 @@
+"""Re-embed every stored memory with the configured embedding model into the new index.
+
+    LEGACY_PINECONE_INDEX_NAME=memories-ada EMBEDDING_MODEL=text-embedding-3-small \
+    EMBEDDING_DIMENSIONS=512 PINECONE_INDEX_NAME=memories-512 python -m agent.reembed_memories
+
+While LEGACY_PINECONE_INDEX_NAME is set the app reads memories from both indexes, so the
+app can switch to the new index before this finishes. Progress is saved after every
+batch; running the command again resumes where it stopped.
+"""
+import argparse
+import json
+import os
+from agent.tools import EMBEDDING_DIMENSIONS, EMBEDDING_MODEL, get_embeddings_batch, index, legacy_index
+
+BATCH_SIZE = 500
+STATE_PATH = "reembed_memories.state.json"
+
+
+def _load_state(path):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def _save_state(path, state):
+    # Written to a temporary file first so an interrupted run never leaves a truncated state
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def reembed_namespace(namespace, state, state_path, batch_size=BATCH_SIZE):
+    """Copy one namespace, resuming from its saved pagination token. Returns the number of memories copied."""
+    copied = 0
+    token = state.get(namespace, {}).get("next")
+    while True:
+        page = legacy_index.list_paginated(namespace=namespace, limit=batch_size, pagination_token=token)
+        ids = [v.id for v in page.vectors]
+        if ids:
+            fetched = legacy_index.fetch(ids=ids, namespace=namespace).vectors
+            vectors = [v for v in fetched.values() if (v.metadata or {}).get("payload")]
+            # One embeddings call for the whole batch
+            embeddings = get_embeddings_batch([v.metadata["payload"] for v in vectors]) if vectors else []
+            if vectors:
+                index.upsert(
+                    vectors=[
+                        {"id": v.id, "values": values, "metadata": v.metadata}
+                        for v, values in zip(vectors, embeddings)
+                    ],
+                    namespace=namespace
+                )
+            copied += len(vectors)
+        token = page.pagination.next if page.pagination else None
+        state[namespace] = {"next": token, "done": token is None}
+        _save_state(state_path, state)
+        if token is None:
+            return copied
+
+
+def reembed(batch_size=BATCH_SIZE, state_path=STATE_PATH):
+    if legacy_index is None:
+        raise SystemExit("Set LEGACY_PINECONE_INDEX_NAME to the index the memories are copied from")
+    state = _load_state(state_path)
+    namespaces = legacy_index.describe_index_stats().namespaces
+    total = 0
+    for namespace in sorted(namespaces):
+        if state.get(namespace, {}).get("done"):
+            continue
+        copied = reembed_namespace(namespace, state, state_path, batch_size)
+        total += copied
+        print(f"{namespace or '(default)'}: {copied} memories re-embedded")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--state", default=STATE_PATH, help="progress file used to resume an interrupted run")
+    args = parser.parse_args()
+    total = reembed(args.batch_size, args.state)
+    print(f"{total} memories re-embedded with {EMBEDDING_MODEL}"
+          + (f" ({EMBEDDING_DIMENSIONS} dimensions)" if EMBEDDING_DIMENSIONS else ""))
+    print("Once every namespace is done, unset LEGACY_PINECONE_INDEX_NAME to stop reading the old index.")
+
+
+if __name__ == "__main__":
+    main()
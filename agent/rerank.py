@@ -0,0 +1,83 @@
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from agent.tools import build_query, get_embeddings_batch, web_search
+
+# Over-fetch factor and Tavily's upper bound on results per search
+OVERFETCH_FACTOR = 3
+MAX_FETCH = 20
+
+# Weight of the similarity to the user's selected documents vs. the query itself
+REFERENCE_WEIGHT = 0.5
+
+EMBEDDING_CACHE_SIZE = 5000
+_embedding_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _text_key(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def result_text(result):
+    return f"{result.get('title', '')}\n{result.get('content', '')[:1000]}"
+
+
+def embed_texts(texts):
+    """Embed texts with one batched API call for everything not already cached."""
+    keys = [_text_key(t) for t in texts]
+    # Hits are taken now: other sessions may evict them before this call is done
+    found = {}
+    with _cache_lock:
+        for k in keys:
+            if k in _embedding_cache:
+                _embedding_cache.move_to_end(k)
+                found[k] = _embedding_cache[k]
+    missing = {k: t for k, t in zip(keys, texts) if k not in found}
+    if missing:
+        vectors = [np.asarray(v, dtype=np.float32) for v in get_embeddings_batch(list(missing.values()))]
+        found.update(zip(missing, vectors))
+        with _cache_lock:
+            for k, v in zip(missing, vectors):
+                _embedding_cache[k] = v
+            while len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+                _embedding_cache.popitem(last=False)
+    return np.vstack([found[k] for k in keys])
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def rerank_results(query, results, reference_docs=None, top_n=5):
+    """Return the top_n results ordered by similarity to the query and the reference documents."""
+    if not results:
+        return []
+    reference_docs = reference_docs or []
+    texts = [query] + [result_text(r) for r in reference_docs] + [result_text(r) for r in results]
+    vectors = _normalize(embed_texts(texts))
+    query_vec = vectors[0]
+    ref_vecs = vectors[1:1 + len(reference_docs)]
+    result_vecs = vectors[1 + len(reference_docs):]
+
+    scores = result_vecs @ query_vec
+    if len(ref_vecs):
+        scores = scores + REFERENCE_WEIGHT * (result_vecs @ ref_vecs.T).mean(axis=1)
+    order = np.argsort(-scores, kind="stable")[:top_n]
+    return [results[i] for i in order]
+
+
+def search_and_rerank(city, topic, timeframe, doc_type, num_results=5, reference_docs=None):
+    # Over-fetch, then keep the num_results most relevant results
+    fetch = min(num_results * OVERFETCH_FACTOR, MAX_FETCH)
+    results = web_search(city, topic, timeframe, doc_type, num_results, max_results=fetch)
+    if not isinstance(results, list) or len(results) <= 1:
+        return results
+    query = build_query(city, topic, timeframe, doc_type)
+    try:
+        return rerank_results(query, results, reference_docs, top_n=num_results)
+    except Exception as e:
+        print("Re-ranking error:", e)
+        return results[:num_results]
@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from agent import cassette, metrics
+from agent.ratelimit import limited_request
+from agent.text_index import TextIndex
+
+# Until the primary has this many timed answers its p95 isn't trusted, and HEDGE_SECONDS is used
+HEDGE_MIN_SAMPLES = 20
+HEDGE_SECONDS = float(os.getenv("SEARCH_HEDGE_SECONDS", "4"))
+LOCAL_INDEX_SIZE = 20000
+# Share of a query's terms a locally known result must contain; BM25 alone matches on any one term
+LOCAL_MIN_COVERAGE = float(os.getenv("LOCAL_SEARCH_MIN_COVERAGE", "0.75"))
+
+
+class TavilySearch:
+    name = "tavily"
+
+    def __init__(self, api_key, on_results=None):
+        self.api_key = api_key
+        self.on_results = on_results
+
+    def search(self, query, max_results=5):
+        """Return Tavily's results, which may be none, or None when the request failed."""
+        url = "https://api.tavily.com/search"
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        payload = {"query": query, "max_results": max_results}
+        try:
+            response = limited_request("tavily", "POST", url, json=payload, headers=headers, timeout=30)
+        except Exception as e:
+            print("Error:", e)
+            return None
+        if response.status_code != 200:
+            print("Error:", response.text)
+            return None
+        results = response.json().get("results", [])
+        if self.on_results and results:
+            self.on_results(results)
+        return results
+
+
+class LocalSearch:
+    """Stand-in provider answering from results other searches in this process already returned."""
+
+    name = "local"
+
+    def __init__(self, max_docs=LOCAL_INDEX_SIZE, min_coverage=LOCAL_MIN_COVERAGE):
+        self._index = TextIndex(max_docs=max_docs)
+        self.min_coverage = min_coverage
+        self._lock = threading.Lock()
+
+    def add(self, results):
+        with self._lock:
+            self._index.add_many(results)
+
+    def search(self, query, max_results=5):
+        with self._lock:
+            hits = self._index.search(query, limit=max_results, min_coverage=self.min_coverage)
+        return [result for result, _ in hits]
+
+
+class HedgedSearch:
+    """Ask the primary provider; if it hasn't answered by its observed p95 latency, ask the
+    secondary too. The primary's answer wins whenever it has one, even an empty one; the
+    secondary's only when it is not empty. A failed primary (None) falls back to the
+    secondary straight away.
+
+    A primary call that loses keeps running in the background, so its results still reach
+    whatever it feeds (e.g. the local index). While a cassette is recording or replaying
+    there is no hedging, so replays take the same path as the recording.
+    """
+
+    def __init__(self, primary, secondary, workers=16):
+        self.primary = primary
+        self.secondary = secondary
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="search")
+
+    def hedge_after(self):
+        if cassette.MODE:
+            return None
+        p95 = metrics.percentile(f"search.{self.primary.name}", 0.95, min_count=HEDGE_MIN_SAMPLES)
+        return HEDGE_SECONDS if p95 is None else p95
+
+    def _timed(self, provider, query, max_results):
+        start = time.perf_counter()
+        try:
+            return provider.search(query, max_results)
+        except Exception as e:
+            print(f"{provider.name} search error:", e)
+            return None
+        finally:
+            metrics.record_timing(f"search.{provider.name}", time.perf_counter() - start)
+
+    def search(self, query, max_results=5):
+        primary = self._pool.submit(self._timed, self.primary, query, max_results)
+        done, _ = wait([primary], timeout=self.hedge_after())
+        if done and primary.result() is not None:
+            return primary.result()
+        metrics.increment("search.fallbacks" if done else "search.hedged")
+        secondary = self._pool.submit(self._timed, self.secondary, query, max_results)
+        pending = {primary, secondary}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            if primary in done and primary.result() is not None:
+                return primary.result()
+            if secondary in done and secondary.result():
+                metrics.increment("search.secondary_answers")
+                return secondary.result()
+        return []
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+import numpy as np
+from agent import metrics
+
+# Opt-in per mode, e.g. SEMANTIC_CACHE_MODES=search,hypothesis,summary; empty disables the cache
+ENABLED_MODES = {m.strip() for m in os.getenv("SEMANTIC_CACHE_MODES", "").split(",") if m.strip()}
+SIMILARITY_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", str(24 * 3600)))
+MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "5000"))
+
+# Characters of the question that are embedded (well under the embedding model's input limit)
+EMBED_CHARS = 16000
+
+# Modes whose question is built from documents: two similar questions can be about different
+# documents, so only an identical request is answered from the cache
+EXACT_MODES = {"hypothesis", "summary"}
+# Every request in an exact partition is the same, so one constant vector stands in for the embedding
+_EXACT_VECTOR = np.ones(1, dtype=np.float32)
+
+# Parts of agent.prompts.get_system_prompt that differ between otherwise identical requests:
+# the timestamp, and the user's query, which is compared by embedding as the last user message
+_VOLATILE_PROMPT = re.compile(r"CURRENT DATETIME: [^\n]*|USER QUERY:\n.*?(?=\n\nCONTEXTUAL MEMORIES)", re.DOTALL)
+
+# Hyphens, en/em dashes and minus signs: "green-space" matches "green space", "2010–2020" matches "2010-2020"
+_DASHES = re.compile(r"[‐-―−-]")
+
+
+def normalize(text):
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = _DASHES.sub(" ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def _stable_content(message):
+    content = message.get("content")
+    if message["role"] == "system" and isinstance(content, str):
+        return _VOLATILE_PROMPT.sub("", content)
+    return content
+
+
+class _Partition:
+    def __init__(self, dimensions):
+        self.vectors = np.zeros((0, dimensions), dtype=np.float32)
+        self.entries = []  # (created, response, latency_seconds), aligned with vectors
+
+    def drop(self, keep):
+        self.vectors = self.vectors[keep]
+        self.entries = [e for e, k in zip(self.entries, keep) if k]
+
+
+class SemanticCache:
+    """In-memory vector store of chat completions, looked up by similarity of the question.
+
+    Only the last user message is compared by embedding. The mode, model, options and
+    every other message must match exactly, apart from the volatile parts of the system
+    prompt, so an answer is never reused for another conversation. In EXACT_MODES the
+    last user message carries the documents, so it must match exactly too.
+    """
+
+    def __init__(self, embed, threshold=SIMILARITY_THRESHOLD, ttl=TTL_SECONDS, max_entries=MAX_ENTRIES):
+        self._embed = embed
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._partitions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(p.entries) for p in self._partitions.values())
+
+    def enabled(self, mode):
+        return mode is not None and mode in ENABLED_MODES
+
+    def _split(self, mode, request):
+        # (exact partition key, normalized question) or None when there is no user message
+        messages = request["messages"]
+        last = next((i for i in range(len(messages) - 1, -1, -1) if messages[i]["role"] == "user"), None)
+        if last is None:
+            return None
+        exact = mode in EXACT_MODES
+        context = [
+            {**m, "content": normalize(_stable_content(m))} for i, m in enumerate(messages) if i != last or exact
+        ]
+        options = {k: v for k, v in request.items() if k != "messages"}
+        key = hashlib.sha256(
+            json.dumps([mode, options, context, last], sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+        # None: looked up by key alone
+        return key, None if exact else normalize(messages[last]["content"])[:EMBED_CHARS]
+
+    def _vector(self, question):
+        if question is None:
+            return _EXACT_VECTOR
+        vector = np.asarray(self._embed([question])[0], dtype=np.float32)
+        return vector / max(np.linalg.norm(vector), 1e-12)
+
+    def _lookup(self, key, vector):
+        with self._lock:
+            partition = self._partitions.get(key)
+            if partition is None or not partition.entries:
+                return None
+            now = time.time()
+            partition.drop([now - created < self.ttl for created, _, _ in partition.entries])
+            if not partition.entries:
+                return None
+            scores = partition.vectors @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                return None
+            return partition.entries[best]
+
+    def _store(self, key, vector, response, latency):
+        with self._lock:
+            partition = self._partitions.setdefault(key, _Partition(len(vector)))
+            partition.vectors = np.vstack([partition.vectors, vector[None, :]])
+            partition.entries.append((time.time(), response, latency))
+            self._evict()
+
+    def _evict(self):
+        # Drop the oldest entries across all partitions once the store is full
+        size = sum(len(p.entries) for p in self._partitions.values())
+        while size > self.max_entries:
+            key = min(
+                (k for k, p in self._partitions.items() if p.entries),
+                key=lambda k: self._partitions[k].entries[0][0]
+            )
+            partition = self._partitions[key]
+            partition.drop([False] + [True] * (len(partition.entries) - 1))
+            if not partition.entries:
+                del self._partitions[key]
+            size -= 1
+
+    def cached(self, mode, request, compute):
+        """Return a cached response to a similar request, or call compute() and cache its result."""
+        split = self._split(mode, request)
+        if split is None:
+            return compute()
+        key, question = split
+
+        start = time.perf_counter()
+        try:
+            vector = self._vector(question)
+        except Exception as e:
+            # The cache must never take down the request it sits in front of
+            print("Semantic cache error:", e)
+            return compute()
+        hit = self._lookup(key, vector)
+        metrics.record_timing("semantic_cache.lookup", time.perf_counter() - start)
+
+        if hit is not None:
+            _, response, latency = hit
+            metrics.increment("semantic_cache.hits")
+            metrics.increment(f"semantic_cache.{mode}.hits")
+            metrics.record_timing("semantic_cache.latency_saved", max(latency - (time.perf_counter() - start), 0.0))
+            return response
+
+        metrics.increment("semantic_cache.misses")
+        metrics.increment(f"semantic_cache.{mode}.misses")
+        start = time.perf_counter()
+        response = compute()
+        self._store(key, vector, response, time.perf_counter() - start)
+        return response
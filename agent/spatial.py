@@ -0,0 +1,171 @@
+from functools import lru_cache
+import numpy as np
+from scipy.spatial import cKDTree
+from geopy.geocoders import Nominatim
+from geopy.exc import GeocoderServiceError, GeocoderTimedOut
+from agent.tools import extract_result_city
+from agent.ratelimit import QueueTimeout, limited
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Rebuild the KD-tree once this many documents were added/removed since the last build
+REBUILD_THRESHOLD = 64
+
+
+def to_unit_vectors(lats, lons):
+    """Convert latitude/longitude arrays (degrees) into 3D points on the unit sphere."""
+    lat = np.radians(np.asarray(lats, dtype=float))
+    lon = np.radians(np.asarray(lons, dtype=float))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def haversine_km(lat, lon, lats, lons):
+    """Vectorized great-circle distance in km from one point to arrays of points."""
+    lat1, lon1 = np.radians(lat), np.radians(lon)
+    lat2 = np.radians(np.asarray(lats, dtype=float))
+    lon2 = np.radians(np.asarray(lons, dtype=float))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def chord_length(radius_km):
+    # Straight-line distance on the unit sphere matching a great-circle distance
+    return 2 * np.sin(min(radius_km / EARTH_RADIUS_KM, np.pi) / 2)
+
+
+@lru_cache(maxsize=1024)
+def _geocode(name):
+    # Raises on service errors, which lru_cache doesn't cache, so a failed lookup is tried again later
+    location = limited("nominatim", Nominatim(user_agent="urban_lab_app", timeout=10).geocode, name)
+    if not location:
+        return None
+    return (location.latitude, location.longitude)
+
+
+def geocode_city(name):
+    """Return (lat, lon) for a city name, or None. Cached so each city is geocoded once per process."""
+    if not name:
+        return None
+    try:
+        return _geocode(name)
+    except (GeocoderTimedOut, GeocoderServiceError, QueueTimeout) as e:
+        print("Geocoding error:", e)
+        return None
+
+
+def geotag_result(result):
+    # Tag a search result with the coordinates of the first city mentioned in it
+    if "lat" in result:
+        return result
+    city = extract_result_city(result)
+    coords = geocode_city(city)
+    if coords:
+        result["city"] = city
+        result["lat"], result["lon"] = coords
+    return result
+
+
+def rank_by_proximity(results, lat, lon):
+    """Sort results by distance to (lat, lon); results without coordinates go last."""
+    tagged = [geotag_result(r) for r in results]
+    located = [r for r in tagged if "lat" in r]
+    unlocated = [r for r in tagged if "lat" not in r]
+    if not located:
+        return unlocated
+    distances = haversine_km(lat, lon, [r["lat"] for r in located], [r["lon"] for r in located])
+    return [located[i] for i in np.argsort(distances, kind="stable")] + unlocated
+
+
+class SpatialIndex:
+    """KD-tree over geotagged documents for radius and nearest-neighbour queries.
+
+    Points are stored as 3D unit-sphere vectors so the euclidean KD-tree matches
+    great-circle ordering. Additions go to a small pending buffer and removals are
+    tombstoned; the tree is only rebuilt once enough changes have accumulated.
+    """
+
+    def __init__(self):
+        self._docs = {}
+        self._tree = None
+        self._tree_urls = []
+        self._pending = set()
+        self._removed = set()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, url):
+        return url in self._docs
+
+    def add(self, result):
+        geotag_result(result)
+        url = result["url"]
+        if "lat" not in result or url in self._docs:
+            return False
+        self._docs[url] = result
+        # A removed URL keeps its tombstone: its tree point is the old record's, which may be elsewhere
+        self._pending.add(url)
+        self._maybe_rebuild()
+        return True
+
+    def remove(self, url):
+        if url not in self._docs:
+            return False
+        del self._docs[url]
+        if url in self._pending:
+            self._pending.discard(url)
+        else:
+            self._removed.add(url)
+        self._maybe_rebuild()
+        return True
+
+    def sync(self, results):
+        # Incrementally add new documents and drop the ones no longer in the collection
+        urls = {r["url"] for r in results}
+        for url in [u for u in self._docs if u not in urls]:
+            self.remove(url)
+        for result in results:
+            if result["url"] not in self._docs:
+                self.add(result)
+
+    def rebuild(self):
+        self._tree_urls = list(self._docs)
+        if self._tree_urls:
+            docs = [self._docs[u] for u in self._tree_urls]
+            self._tree = cKDTree(to_unit_vectors([d["lat"] for d in docs], [d["lon"] for d in docs]))
+        else:
+            self._tree = None
+        self._pending.clear()
+        self._removed.clear()
+
+    def _maybe_rebuild(self):
+        if len(self._pending) + len(self._removed) >= REBUILD_THRESHOLD:
+            self.rebuild()
+
+    def _with_distances(self, urls, lat, lon):
+        if not urls:
+            return []
+        docs = [self._docs[u] for u in urls]
+        distances = haversine_km(lat, lon, [d["lat"] for d in docs], [d["lon"] for d in docs])
+        order = np.argsort(distances, kind="stable")
+        return [(docs[i], float(distances[i])) for i in order]
+
+    def within(self, lat, lon, radius_km):
+        """Return [(document, distance_km)] within radius_km of (lat, lon), nearest first."""
+        candidates = list(self._pending)
+        if self._tree is not None:
+            hits = self._tree.query_ball_point(to_unit_vectors([lat], [lon])[0], chord_length(radius_km))
+            candidates += [self._tree_urls[i] for i in hits if self._tree_urls[i] not in self._removed]
+        return [(d, km) for d, km in self._with_distances(candidates, lat, lon) if km <= radius_km]
+
+    def nearest(self, lat, lon, k=20):
+        """Return the k nearest [(document, distance_km)] to (lat, lon)."""
+        candidates = list(self._pending)
+        if self._tree is not None and k > 0:
+            # Over-query by the number of tombstones so removed points can't crowd out live ones
+            n = min(k + len(self._removed), len(self._tree_urls))
+            _, idx = self._tree.query(to_unit_vectors([lat], [lon])[0], k=n)
+            idx = np.atleast_1d(idx)
+            candidates += [self._tree_urls[i] for i in idx if self._tree_urls[i] not in self._removed]
+        return self._with_distances(candidates, lat, lon)[:k]
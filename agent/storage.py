@@ -0,0 +1,348 @@
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import partial
+from agent.docstore import digest, documents
+
+DB_PATH = os.getenv("OMBU_DB_PATH", "ombu_urban_lab.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS documents (
+    url TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    content TEXT NOT NULL,
+    extra TEXT NOT NULL DEFAULT '{}',
+    content_hash TEXT
+);
+CREATE TABLE IF NOT EXISTS collection_items (
+    session_id TEXT NOT NULL,
+    collection TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    PRIMARY KEY (session_id, collection, position)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    session_id TEXT NOT NULL,
+    thread TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (session_id, thread, position)
+);
+CREATE TABLE IF NOT EXISTS hypothesis_cache (
+    fingerprint TEXT PRIMARY KEY,
+    candidates TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS document_chunks (
+    url TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    page INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    embedding BLOB NOT NULL,
+    embedding_model TEXT NOT NULL DEFAULT 'text-embedding-ada-002:native',
+    PRIMARY KEY (url, position)
+);
+CREATE TABLE IF NOT EXISTS document_summaries (
+    content_hash TEXT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS session_values (
+    session_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (session_id, key)
+);
+"""
+
+# One connection per database shared by all sessions; sqlite3 needs the lock around it
+_connections = {}
+_lock = threading.RLock()
+
+
+def get_connection(db_path=None):
+    """Return the shared connection to the database, creating the schema on first use."""
+    db_path = db_path or DB_PATH
+    with _lock:
+        conn = _connections.get(db_path)
+        if conn is None:
+            conn = sqlite3.connect(db_path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            _migrate(conn)
+            _connections[db_path] = conn
+        return conn
+
+
+def _migrate(conn):
+    # Columns added after the first release; CREATE TABLE IF NOT EXISTS leaves old tables as they were
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(document_chunks)")}
+    if "embedding_model" not in columns:
+        conn.execute(
+            "ALTER TABLE document_chunks ADD COLUMN embedding_model TEXT NOT NULL DEFAULT 'text-embedding-ada-002:native'"
+        )
+    # Filled in by SessionStore.load for documents saved before the column existed
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(documents)")}
+    if "content_hash" not in columns:
+        conn.execute("ALTER TABLE documents ADD COLUMN content_hash TEXT")
+
+
+@contextmanager
+def transaction(db_path=None):
+    conn = get_connection(db_path)
+    with _lock, conn:
+        yield conn
+
+
+def _now():
+    return str(datetime.now(tz=timezone.utc))
+
+
+def load_cached_hypotheses(fingerprint, db_path=None):
+    with _lock:
+        row = get_connection(db_path).execute(
+            "SELECT candidates FROM hypothesis_cache WHERE fingerprint = ?", (fingerprint,)
+        ).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def save_cached_hypotheses(fingerprint, candidates, db_path=None):
+    with transaction(db_path) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO hypothesis_cache (fingerprint, candidates, created_at) VALUES (?, ?, ?)",
+            (fingerprint, json.dumps(candidates), _now())
+        )
+
+
+def save_document_chunks(url, chunks, embedding_model, db_path=None):
+    # chunks: [(page, text, embedding bytes)]; replaces whatever was stored for url
+    with transaction(db_path) as conn:
+        conn.execute("DELETE FROM document_chunks WHERE url = ?", (url,))
+        conn.executemany(
+            "INSERT INTO document_chunks (url, position, page, text, embedding, embedding_model) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            [(url, i, page, text, embedding, embedding_model) for i, (page, text, embedding) in enumerate(chunks)]
+        )
+
+
+def load_document_chunks(url, db_path=None):
+    with _lock:
+        return get_connection(db_path).execute(
+            "SELECT page, text, embedding FROM document_chunks WHERE url = ? ORDER BY position", (url,)
+        ).fetchall()
+
+
+def chunked_urls(urls, embedding_model=None, db_path=None):
+    """Return the subset of urls that already have stored chunks (embedded with embedding_model, if given)."""
+    urls = list(urls)
+    if not urls:
+        return set()
+    query = f"SELECT DISTINCT url FROM document_chunks WHERE url IN ({', '.join('?' * len(urls))})"
+    if embedding_model:
+        query += " AND embedding_model = ?"
+        urls.append(embedding_model)
+    with _lock:
+        rows = get_connection(db_path).execute(query, urls).fetchall()
+    return {row[0] for row in rows}
+
+
+def load_cached_summaries(content_hashes, db_path=None):
+    """Return {content_hash: summary} for the hashes that were summarized before."""
+    content_hashes = list(content_hashes)
+    if not content_hashes:
+        return {}
+    with _lock:
+        rows = get_connection(db_path).execute(
+            f"SELECT content_hash, summary FROM document_summaries WHERE content_hash IN ({', '.join('?' * len(content_hashes))})",
+            content_hashes
+        ).fetchall()
+    return dict(rows)
+
+
+def save_cached_summary(content_hash, summary, db_path=None):
+    with transaction(db_path) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO document_summaries (content_hash, summary, created_at) VALUES (?, ?, ?)",
+            (content_hash, summary, _now())
+        )
+
+
+def load_document_content(url, db_path=None):
+    with _lock:
+        row = get_connection(db_path).execute("SELECT content FROM documents WHERE url = ?", (url,)).fetchone()
+    return row[0] if row else ""
+
+
+class SessionStore:
+    """Persists a session's collections, chat threads and values to SQLite.
+
+    Each save_* call compares against what was last written and only writes
+    the difference, so it is cheap to call on every rerun.
+    """
+
+    def __init__(self, session_id=None, db_path=None):
+        self.session_id = session_id or uuid.uuid4().hex
+        self.db_path = db_path
+        self._collections = {}
+        self._threads = {}
+        self._values = {}
+        with transaction(self.db_path) as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO sessions (session_id, created_at, updated_at) VALUES (?, ?, ?)",
+                (self.session_id, _now(), _now())
+            )
+
+    def _touch(self, conn):
+        conn.execute("UPDATE sessions SET updated_at = ? WHERE session_id = ?", (_now(), self.session_id))
+
+    def save_documents(self, results, conn):
+        rows = []
+        for r in results:
+            # Shared documents (agent.docstore) track their own changes
+            if getattr(r, "dirty", False):
+                r.dirty = False
+            content = r.get("content") or ""
+            extra = {k: v for k, v in r.items() if k not in ("url", "title", "content")}
+            rows.append((r["url"], r.get("title", ""), content, json.dumps(extra, default=str), digest(content)))
+        conn.executemany(
+            "INSERT INTO documents (url, title, content, extra, content_hash) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(url) DO UPDATE SET title = excluded.title, content = excluded.content, "
+            "extra = excluded.extra, content_hash = excluded.content_hash",
+            rows
+        )
+
+    def save_collection(self, name, results):
+        urls = [r["url"] for r in results]
+        previous = self._collections.get(name)
+        changed = [r for r in results if getattr(r, "dirty", False)]
+        if previous == urls and not changed:
+            return False
+        with transaction(self.db_path) as conn:
+            if previous is not None and urls[:len(previous)] == previous:
+                # Only appended: write the new tail
+                new_results = results[len(previous):]
+                start = len(previous)
+            else:
+                conn.execute(
+                    "DELETE FROM collection_items WHERE session_id = ? AND collection = ?",
+                    (self.session_id, name)
+                )
+                known = set(previous or [])
+                new_results = [r for r in results if r["url"] not in known]
+                start = 0
+            # Documents already listed are written again only if they changed since they were saved
+            self.save_documents(new_results + changed, conn)
+            conn.executemany(
+                "INSERT OR REPLACE INTO collection_items (session_id, collection, position, url) VALUES (?, ?, ?, ?)",
+                [(self.session_id, name, i, url) for i, url in enumerate(urls[start:], start)]
+            )
+            self._touch(conn)
+        self._collections[name] = urls
+        return True
+
+    def save_messages(self, thread, messages):
+        snapshot = [(m["role"], str(m["content"])) for m in messages]
+        previous = self._threads.get(thread)
+        if previous == snapshot:
+            return False
+        with transaction(self.db_path) as conn:
+            if previous is not None and snapshot[:len(previous)] == previous:
+                start = len(previous)
+            else:
+                conn.execute(
+                    "DELETE FROM messages WHERE session_id = ? AND thread = ?",
+                    (self.session_id, thread)
+                )
+                start = 0
+            conn.executemany(
+                "INSERT OR REPLACE INTO messages (session_id, thread, position, role, content) VALUES (?, ?, ?, ?, ?)",
+                [(self.session_id, thread, i, role, content) for i, (role, content) in enumerate(snapshot[start:], start)]
+            )
+            self._touch(conn)
+        self._threads[thread] = snapshot
+        return True
+
+    def save_value(self, key, value):
+        encoded = json.dumps(value, default=str)
+        if self._values.get(key) == encoded:
+            return False
+        with transaction(self.db_path) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO session_values (session_id, key, value) VALUES (?, ?, ?)",
+                (self.session_id, key, encoded)
+            )
+            self._touch(conn)
+        self._values[key] = encoded
+        return True
+
+    def load_content(self, url):
+        return load_document_content(url, self.db_path)
+
+    def _backfill_content_hashes(self):
+        # Documents saved before content hashes were stored get theirs once
+        with transaction(self.db_path) as conn:
+            rows = conn.execute(
+                "SELECT d.url, d.content FROM documents d JOIN collection_items c ON d.url = c.url "
+                "WHERE c.session_id = ? AND d.content_hash IS NULL",
+                (self.session_id,)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE documents SET content_hash = ? WHERE url = ?",
+                [(digest(content), url) for url, content in rows]
+            )
+
+    def load(self):
+        """Restore everything saved for this session.
+
+        Documents come back as shared agent.docstore Documents whose content is read
+        from the database only when it is accessed.
+        """
+        self._backfill_content_hashes()
+        with _lock:
+            conn = get_connection(self.db_path)
+            collection_rows = conn.execute(
+                "SELECT c.collection, d.url, d.title, d.extra, d.content_hash FROM collection_items c "
+                "JOIN documents d ON d.url = c.url "
+                "WHERE c.session_id = ? ORDER BY c.collection, c.position",
+                (self.session_id,)
+            ).fetchall()
+            message_rows = conn.execute(
+                "SELECT thread, role, content FROM messages WHERE session_id = ? ORDER BY thread, position",
+                (self.session_id,)
+            ).fetchall()
+            value_rows = conn.execute(
+                "SELECT key, value FROM session_values WHERE session_id = ?",
+                (self.session_id,)
+            ).fetchall()
+
+        collections = {}
+        docs = {}
+        load_content = partial(load_document_content, db_path=self.db_path)
+        for collection, url, title, extra, content_hash in collection_rows:
+            # Collections share one object per URL, like the in-memory session state does
+            if url not in docs:
+                docs[url] = documents.intern_stored(url, title, content_hash, json.loads(extra), load_content)
+            collections.setdefault(collection, []).append(docs[url])
+
+        threads = {}
+        for thread, role, content in message_rows:
+            threads.setdefault(thread, []).append({"role": role, "content": content})
+
+        values = {key: json.loads(value) for key, value in value_rows}
+
+        # What was just loaded is already on disk
+        self._collections = {name: [r["url"] for r in results] for name, results in collections.items()}
+        self._threads = {t: [(m["role"], m["content"]) for m in msgs] for t, msgs in threads.items()}
+        self._values = {k: json.dumps(v, default=str) for k, v in values.items()}
+        return {"collections": collections, "threads": threads, "values": values}
@@ -0,0 +1,111 @@
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from agent.tools import invoke_model
+from agent.storage import chunked_urls, load_cached_summaries, load_document_chunks, save_cached_summary
+from agent import metrics
+
+# Concurrent per-document summaries (map) are capped to stay under API rate limits
+MAX_CONCURRENCY = 4
+# Characters of a document sent to the map step
+MAP_INPUT_CHARS = 12000
+# Partial summaries combined per reduce call; larger boxes are reduced in rounds
+REDUCE_BATCH = 20
+
+# Part of the cache key, so changing the prompt invalidates old summaries
+SUMMARY_PROMPT_VERSION = "v1"
+
+MAP_PROMPT = (
+    "Summarize this urban planning document in 3 bullet points. Focus on the place, the period, "
+    "the spatial variables and the main findings or policies. Return only the bullet points."
+)
+REDUCE_PROMPT = (
+    "You are given summaries of the documents in an urban researcher's Research Box. Write an overview "
+    "of the box: the common themes, how the cities and findings compare, and the gaps worth researching. "
+    "Use at most 5 bullet points."
+)
+
+
+def document_text(result, full_text_urls):
+    # Prefer the full text for documents that were read in full
+    if result["url"] in full_text_urls:
+        text = " ".join(text for _, text, _ in load_document_chunks(result["url"]))
+    else:
+        text = result.get("content", "")
+    return f"{result.get('title', '')}\n\n{text}"[:MAP_INPUT_CHARS]
+
+
+def content_hash(text):
+    return hashlib.sha256(f"{SUMMARY_PROMPT_VERSION}\n{text}".encode("utf-8")).hexdigest()
+
+
+def summarize_document(text):
+    return invoke_model([
+        {"role": "system", "content": MAP_PROMPT},
+        {"role": "user", "content": text}
+    ], cache_mode="summary")
+
+
+def reduce_summaries(titled_summaries):
+    # Reduce in rounds of REDUCE_BATCH until a single overview is left
+    while True:
+        batches = [titled_summaries[i:i + REDUCE_BATCH] for i in range(0, len(titled_summaries), REDUCE_BATCH)]
+        overviews = [
+            invoke_model([
+                {"role": "system", "content": REDUCE_PROMPT},
+                {"role": "user", "content": "\n\n".join(f"## {title}\n{summary}" for title, summary in batch)}
+            ], cache_mode="summary")
+            for batch in batches
+        ]
+        if len(overviews) == 1:
+            return overviews[0]
+        titled_summaries = [(f"Part {i}", overview) for i, overview in enumerate(overviews, 1)]
+
+
+def summarize_research_box(results):
+    """Summarize each document concurrently, then combine them into an overview.
+
+    Document summaries are cached by content hash, so only new or changed
+    documents are summarized again.
+    """
+    if not results:
+        return {"overview": "", "summaries": {}, "timings": {}, "cache_hits": 0, "cache_misses": 0}
+
+    start = time.perf_counter()
+    full_text_urls = chunked_urls(r["url"] for r in results)
+    hashes = {r["url"]: content_hash(document_text(r, full_text_urls)) for r in results}
+    cached = load_cached_summaries(set(hashes.values()))
+    missing = [r for r in results if hashes[r["url"]] not in cached]
+    prepare_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+
+    def summarize(result):
+        summary = summarize_document(document_text(result, full_text_urls))
+        save_cached_summary(hashes[result["url"]], summary)
+        return summary
+
+    # Identical documents under different URLs are summarized once
+    unique_missing = list({hashes[r["url"]]: r for r in missing}.values())
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as pool:
+        fresh = dict(zip([hashes[r["url"]] for r in unique_missing], pool.map(summarize, unique_missing)))
+    map_time = time.perf_counter() - start
+
+    summaries = {r["url"]: cached.get(hashes[r["url"]]) or fresh[hashes[r["url"]]] for r in results}
+
+    start = time.perf_counter()
+    overview = reduce_summaries([(r.get("title", r["url"]), summaries[r["url"]]) for r in results])
+    reduce_time = time.perf_counter() - start
+
+    hits, misses = len(results) - len(missing), len(missing)
+    metrics.increment("summaries.cache_hits", hits)
+    metrics.increment("summaries.cache_misses", misses)
+    metrics.record_timing("summaries.map", map_time)
+    metrics.record_timing("summaries.reduce", reduce_time)
+    return {
+        "overview": overview,
+        "summaries": summaries,
+        "timings": {"prepare": prepare_time, "map": map_time, "reduce": reduce_time},
+        "cache_hits": hits,
+        "cache_misses": misses,
+    }
@@ -0,0 +1,110 @@
+import math
+import re
+import unicodedata
+from collections import Counter, OrderedDict, defaultdict
+
+# Small multilingual stopword list (results are mostly English, Spanish and Portuguese)
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is", "it", "of", "on",
+    "or", "the", "to", "with", "this", "that", "de", "da", "do", "das", "dos", "del", "la", "las",
+    "el", "los", "en", "e", "y", "o", "um", "uma", "para", "por", "con", "com", "no", "na",
+}
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def fold_accents(text):
+    # "São Paulo" -> "Sao Paulo", "Bogotá" -> "Bogota"
+    if text.isascii():
+        return text
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    return [
+        t for t in TOKEN_PATTERN.findall(fold_accents(text).lower())
+        if len(t) > 1 and t not in STOPWORDS
+    ]
+
+
+class TextIndex:
+    """Incremental BM25 inverted index over result titles and content.
+
+    Holds at most max_docs documents; once full, the oldest documents are evicted
+    so memory stays bounded during long sessions.
+    """
+
+    def __init__(self, max_docs=5000, k1=1.5, b=0.75, title_boost=2):
+        self.max_docs = max_docs
+        self.k1 = k1
+        self.b = b
+        self.title_boost = title_boost
+        self._docs = OrderedDict()  # url -> (result, doc_len, term_freqs)
+        self._postings = defaultdict(dict)  # term -> {url: term_freq}
+        self._total_len = 0
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, url):
+        return url in self._docs
+
+    def add(self, result):
+        url = result.get("url")
+        if not url or url in self._docs:
+            return False
+        # Title terms are counted title_boost times so title matches rank higher
+        terms = tokenize(result.get("title", "")) * self.title_boost + tokenize(result.get("content", ""))
+        freqs = Counter(terms)
+        self._docs[url] = (result, len(terms), freqs)
+        self._total_len += len(terms)
+        for term, tf in freqs.items():
+            self._postings[term][url] = tf
+        while len(self._docs) > self.max_docs:
+            self.remove(next(iter(self._docs)))
+        return True
+
+    def add_many(self, results):
+        return sum(self.add(r) for r in results)
+
+    def remove(self, url):
+        entry = self._docs.pop(url, None)
+        if entry is None:
+            return False
+        _, doc_len, freqs = entry
+        self._total_len -= doc_len
+        for term in freqs:
+            postings = self._postings[term]
+            postings.pop(url, None)
+            if not postings:
+                del self._postings[term]
+        return True
+
+    def search(self, query, limit=10, min_coverage=0.0):
+        """Return [(result, score)] for the best BM25 matches of query.
+
+        min_coverage is the share of the query's terms a document must contain to match.
+        """
+        n = len(self._docs)
+        if not n:
+            return []
+        avg_len = self._total_len / n
+        terms = set(tokenize(query))
+        scores = defaultdict(float)
+        matched = Counter()
+        for term in terms:
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for url, tf in postings.items():
+                doc_len = self._docs[url][1]
+                norm = self.k1 * (1 - self.b + self.b * doc_len / avg_len)
+                scores[url] += idf * tf * (self.k1 + 1) / (tf + norm)
+                matched[url] += 1
+        if min_coverage:
+            needed = math.ceil(min_coverage * len(terms))
+            scores = {url: score for url, score in scores.items() if matched[url] >= needed}
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [(self._docs[url][0], score) for url, score in best]
@@ -0,0 +1,18 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except ImportError:  # Streamlit versions without the scriptrunner helpers
+    add_script_run_ctx = get_script_run_ctx = None
+
+
+def session_executor(max_workers):
+    """Thread pool whose workers can read the calling Streamlit session's st.session_state."""
+    ctx = get_script_run_ctx() if get_script_run_ctx else None
+    if ctx is None:
+        return ThreadPoolExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)
+    )
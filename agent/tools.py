@@ -3,26 +3,50 @@ import certifi
 os.environ["SSL_CERT_FILE"] = certifi.where()
 os.environ["REQUESTS_CA_BUNDLE"] = certifi.where()
 os.environ["CURL_CA_BUNDLE"] = certifi.where()
+import hashlib
 import uuid
+from itertools import zip_longest
 from dotenv import load_dotenv
 from pinecone import Pinecone
 from openai import OpenAI
-from tavily import TavilyClient
 from datetime import datetime, timezone
-import requests
 import json
 import re
+from agent import cassette
+from agent.ratelimit import limited
+from agent.search import HedgedSearch, LocalSearch, TavilySearch
+from agent.semantic_cache import SemanticCache
 
 load_dotenv()
 
 TAVILY_API_KEY = os.getenv("TAVILY_API_KEY")
 
+def optional_int(value):
+    return int(value) if value else None
+
+# Embedding model for memories and documents; text-embedding-3 models can be shortened with EMBEDDING_DIMENSIONS
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-ada-002")
+EMBEDDING_DIMENSIONS = optional_int(os.getenv("EMBEDDING_DIMENSIONS"))
+# Identifies vectors that can be compared with each other
+EMBEDDING_KEY = f"{EMBEDDING_MODEL}:{EMBEDDING_DIMENSIONS or 'native'}"
+
 # Initialize Pinecone for vector database
 pc = Pinecone(os.getenv("PINECONE_API_KEY"))
-# Initialize the vector database index
-index = pc.Index(os.getenv("PINECONE_INDEX_NAME"))
-# Initialize OpenAI for embeddings 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+def open_index(name):
+    # With a cassette, index calls are recorded or replayed (replays never connect)
+    return cassette.CassetteIndex(name, pc.Index) if cassette.MODE else pc.Index(name)
+
+# Initialize the vector database index (its dimension must match the embedding model)
+index = open_index(os.getenv("PINECONE_INDEX_NAME"))
+# During a switch of embedding model, memories are still read from the old index until
+# agent.reembed_memories has copied them all; new memories only go to the new index
+LEGACY_INDEX_NAME = os.getenv("LEGACY_PINECONE_INDEX_NAME")
+LEGACY_EMBEDDING_MODEL = os.getenv("LEGACY_EMBEDDING_MODEL", "text-embedding-ada-002")
+LEGACY_EMBEDDING_DIMENSIONS = optional_int(os.getenv("LEGACY_EMBEDDING_DIMENSIONS"))
+legacy_index = open_index(LEGACY_INDEX_NAME) if LEGACY_INDEX_NAME else None
+# Initialize OpenAI for embeddings and completions; retries are handled by the shared rate limiter
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
 
 # Define the tools
 TOOLS = [
@@ -62,92 +86,178 @@ TOOLS = [
 
 
 # Function to get the embeddings of a string
-def get_embeddings(string_to_embed):
-    response = client.embeddings.create(
-        input=string_to_embed,
-        model="text-embedding-ada-002"
+def get_embeddings(string_to_embed, model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS):
+    return get_embeddings_batch([string_to_embed], model, dimensions)[0]
+
+# Function to get the embeddings of several strings in a single API call
+def get_embeddings_batch(strings_to_embed, model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS):
+    # Older models reject the dimensions parameter, so it is only sent when configured
+    options = {"dimensions": dimensions} if dimensions else {}
+    response = limited(
+        "openai",
+        client.embeddings.create,
+        tokens=sum(estimate_tokens(s) for s in strings_to_embed),
+        input=strings_to_embed,
+        model=model,
+        **options
     )
-    return response.data[0].embedding
+    return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
 
-def save_memory(memory):
-    # Step 1: Embed the memory
-    vector = get_embeddings(memory)
-    # Step 2: Build the vector document to be stored
-    user_id = "1234"
+def estimate_tokens(text):
+    # ~4 characters per token is close enough for rate limiting
+    return len(text) // 4 + 1
+
+# Answers to near-identical questions, shared by all sessions (opt-in per mode)
+semantic_cache = SemanticCache(embed=lambda texts: get_embeddings_batch(texts))
+
+# Every chat completion goes through the shared OpenAI rate limiter
+def chat_completion(cache_mode=None, **kwargs):
+    def create():
+        prompt_tokens = sum(estimate_tokens(str(m.get("content") or "")) for m in kwargs["messages"])
+        expected_tokens = prompt_tokens + kwargs.get("n", 1) * kwargs.get("max_tokens", 500)
+        return limited("openai", client.chat.completions.create, tokens=expected_tokens, **kwargs)
+    if semantic_cache.enabled(cache_mode):
+        return semantic_cache.cached(cache_mode, kwargs, create)
+    return create()
+
+# Recall memories live in one namespace per user, so a query only scans that user's vectors
+MEMORY_NAMESPACE_PREFIX = os.getenv("PINECONE_NAMESPACE") or "memories"
+# Namespace every user's memories were stored in before they were partitioned
+SHARED_MEMORY_NAMESPACE = os.getenv("PINECONE_NAMESPACE", "")
+ANONYMOUS_USER_ID = "anonymous"
+
+def memory_namespace(user_id):
+    # Hashed so that e-mail addresses never appear in namespace names
+    digest = hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:24]
+    return f"{MEMORY_NAMESPACE_PREFIX}-user-{digest}"
+
+def memory_vector(memory, vector, user_id, memory_id=None, timestamp=None):
+    # Build the vector document to be stored
     path = "user/{user_id}/recall/{event_id}"
-    current_time = datetime.now(tz=timezone.utc)
+    current_time = timestamp or datetime.now(tz=timezone.utc)
     path = path.format(
         user_id=user_id,
         event_id=str(uuid.uuid4()),
     )
-    documents = [
-        {
-            "id": str(uuid.uuid4()),
-            "values": vector,
-            "metadata": {
-                "payload": memory,
-                "path": path,
-                "timestamp": str(current_time),
-                "type": "recall", # Define the type of document i.e recall memory
-                "user_id": user_id,
-            },
-        }
-    ]
-    # Step 3: Store the vector document in the vector database
+    return {
+        "id": memory_id or str(uuid.uuid4()),
+        "values": vector,
+        "metadata": {
+            "payload": memory,
+            "path": path,
+            "timestamp": str(current_time),
+            "type": "recall", # Define the type of document i.e recall memory
+            "user_id": user_id,
+        },
+    }
+
+def save_memory(memory, user_id=ANONYMOUS_USER_ID):
+    # Step 1: Embed the memory
+    vector = get_embeddings(memory)
+    # Step 2: Build the vector document to be stored
+    documents = [memory_vector(memory, vector, user_id)]
+    # Step 3: Store the vector document in the user's own namespace
     index.upsert(
         vectors=documents,
-        namespace=os.getenv("PINECONE_NAMESPACE")
+        namespace=memory_namespace(user_id)
     )
     return "Memory saved successfully"
 
-def load_memories(prompt):
-    user_id = "1234"
+def save_memories(memories, user_id=ANONYMOUS_USER_ID, batch_size=100):
+    """Store memories ({"payload"} plus optional "id" and "timestamp") with one embeddings call per batch.
+
+    Memories that keep their id overwrite themselves, so importing the same file twice adds nothing.
+    """
+    for start in range(0, len(memories), batch_size):
+        batch = memories[start:start + batch_size]
+        vectors = get_embeddings_batch([m["payload"] for m in batch])
+        index.upsert(
+            vectors=[memory_vector(m["payload"], v, user_id, m.get("id"), m.get("timestamp")) for m, v in zip(batch, vectors)],
+            namespace=memory_namespace(user_id)
+        )
+
+def list_memories(user_id=ANONYMOUS_USER_ID):
+    """Every recall memory of the user as {"id", "payload", "timestamp"}."""
+    namespace = memory_namespace(user_id)
+    memories = []
+    for ids in index.list(namespace=namespace):
+        fetched = index.fetch(ids=ids, namespace=namespace).vectors
+        memories += [
+            {"id": v.id, "payload": v.metadata["payload"], "timestamp": v.metadata.get("timestamp")}
+            for v in fetched.values() if (v.metadata or {}).get("payload")
+        ]
+    return memories
+
+def load_memories(prompt, user_id=ANONYMOUS_USER_ID):
     top_k = 3
     vector = get_embeddings(prompt)
+    # Only recall memories are stored in a user's namespace, so no metadata filter is needed
     response = index.query(
         vector=vector,
-        filter={
-            "user_id": {"$eq": user_id},
-            "type": {"$eq": "recall"},
-        },
-        namespace=os.getenv("PINECONE_NAMESPACE"),
+        namespace=memory_namespace(user_id),
         include_metadata=True,
         top_k=top_k,
     )
-    memories = []
-    if matches := response.get("matches"):
-        memories = [m["metadata"]["payload"] for m in matches]
-        memories
-    return memories
+    matches = list(response.get("matches") or [])
+    if legacy_index is not None:
+        legacy = legacy_index.query(
+            vector=get_embeddings(prompt, LEGACY_EMBEDDING_MODEL, LEGACY_EMBEDDING_DIMENSIONS),
+            namespace=memory_namespace(user_id),
+            include_metadata=True,
+            top_k=top_k,
+        )
+        # Scores of different models aren't comparable, so the two rankings are interleaved;
+        # memories already migrated keep their id and appear once
+        ranked = [m for pair in zip_longest(matches, legacy.get("matches") or []) for m in pair if m is not None]
+        matches = list({m["id"]: m for m in reversed(ranked)}.values())[::-1]
+    return [m["metadata"]["payload"] for m in matches[:top_k]]
 
-def web_search(city, topic, timeframe, doc_type, num_results=5):
+def build_query(city, topic, timeframe, doc_type):
     # Construct a smarter query including the selected document type
-    query = f"{doc_type} about {topic} in {city} during {timeframe}"
+    return f"{doc_type} about {topic} in {city} during {timeframe}"
 
-    url = "https://api.tavily.com/search"
-    headers = {"Authorization": f"Bearer {TAVILY_API_KEY}"}
-    payload = {"query": query, "num_results": num_results}
+# Tavily returns at most this many results for one query
+MAX_RESULTS_PER_QUERY = 20
+# Other angles on the same search; Tavily has no result pages, so further results come from these
+QUERY_FACETS = ["", "case study", "policy", "data and indicators", "evaluation", "planning strategy",
+                "pilot project", "impact assessment", "best practices", "lessons learned"]
 
-    response = requests.post(url, json=payload, headers=headers)
-    if response.status_code == 200:
-        return response.json().get("results", [])
-    else:
-        print("Error:", response.text)
-        return []
+def search_queries(city, topic, timeframe, doc_types):
+    """Queries for a search that continues past one page: every document type, then every facet of each."""
+    for facet in QUERY_FACETS:
+        for doc_type in doc_types:
+            yield build_query(city, f"{topic} {facet}".strip(), timeframe, doc_type)
 
-    
-def invoke_model(messages):
-    # Initialize the OpenAI client
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Every Tavily answer also feeds the local index, which stands in when Tavily is slow or failing
+local_search = LocalSearch()
+search_provider = HedgedSearch(TavilySearch(TAVILY_API_KEY, on_results=local_search.add), local_search)
+
+def web_search(city, topic, timeframe, doc_type, num_results=5, max_results=None):
+    query = build_query(city, topic, timeframe, doc_type)
+    return search_query(query, max_results or num_results)
+
+def search_query(query, max_results=5):
+    return search_provider.search(query, max_results)
 
-    # Make a ChatGPT API call with tool calling
-    completion = client.chat.completions.create(
+    
+def invoke_model(messages, cache_mode=None):
+    # Make a ChatGPT API call
+    completion = chat_completion(
         model="gpt-3.5-turbo",
-        messages=messages
+        messages=messages,
+        cache_mode=cache_mode
     )
 
     return completion.choices[0].message.content
 
+# Common city names pattern
+CITY_PATTERN = r'\b(?:Paris|Bogota|Curitiba|Mexico City|Tokyo|Sydney|Canberra|Orlando|Seattle|New York|Santiago|Lima|London|Berlin|Madrid|Rome|Amsterdam|Barcelona|Vienna|Copenhagen|Stockholm|Munich|Hamburg|Milan|Brussels|Prague|Warsaw|Budapest|Dublin|Lisbon|Helsinki|Oslo|Athens|Rotterdam|Valencia|Frankfurt|Seville|Glasgow|Manchester|Birmingham|Lyon|Turin|Naples|Marseille|Leeds|Krakow|Porto|Riga|Vilnius|Tallinn|Sofia|Bucharest|Zagreb|Ljubljana|Bratislava)\b'
+
+def extract_result_city(result):
+    # Look for cities in the full content and keep the first one found
+    cities = re.findall(CITY_PATTERN, result.get('content', ''), re.IGNORECASE)
+    return cities[0].title() if cities else ""
+
 def format_result_title(result):
     # Extract year from content - look for publication year patterns
     year_pattern = r'(?:published|released|publication date|date of publication|year)[:\s]+(?:19|20)\d{2}|(?:19|20)\d{2}'
@@ -156,13 +266,7 @@ def format_result_title(result):
     year = content_years[0] if content_years else ""
     
     # Extract city name - look in the full content
-    # Common city names pattern
-    city_pattern = r'\b(?:Paris|Bogota|Curitiba|Mexico City|Tokyo|Sydney|Canberra|Orlando|Seattle|New York|Santiago|Lima|London|Berlin|Madrid|Rome|Amsterdam|Barcelona|Vienna|Copenhagen|Stockholm|Munich|Hamburg|Milan|Brussels|Prague|Warsaw|Budapest|Dublin|Lisbon|Helsinki|Oslo|Athens|Rotterdam|Valencia|Frankfurt|Seville|Glasgow|Manchester|Birmingham|Lyon|Turin|Naples|Marseille|Leeds|Krakow|Porto|Riga|Vilnius|Tallinn|Sofia|Bucharest|Zagreb|Ljubljana|Bratislava)\b'
-    
-    # Look for cities in the full content
-    cities = re.findall(city_pattern, result.get('content', ''), re.IGNORECASE)
-    # Get the first city found
-    city = cities[0].title() if cities else ""
+    city = extract_result_city(result)
     
     # Get the base title
     base_title = result['title'] if result['title'].lower() != "pdf" else result['url'].split('/')[-1]
@@ -179,10 +283,10 @@ def format_result_title(result):
 
 # create a function to help the user to create a hypothesis for a spatial analysis by prompting the user with questions and display the hypothesis in a bullet point format 
 def create_hypothesis(messages):
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    completion = client.chat.completions.create(
+    completion = chat_completion(
         model="gpt-3.5-turbo",
-        messages=messages
+        messages=messages,
+        cache_mode="hypothesis"
     )
     return completion.choices[0].message.content
 
@@ -1,20 +1,46 @@
+import io
 import os
+import time
+from functools import lru_cache, wraps
 from dotenv import load_dotenv
 from datetime import datetime
 import streamlit as st
-import requests
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import folium
 from folium.plugins import MarkerCluster
 from streamlit_folium import folium_static
 from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut
-from agent.agent import agent
-from agent.tools import format_result_title
+from geopy.exc import GeocoderRateLimited, GeocoderTimedOut
+from agent.agent import (
+    MAX_SEARCH_RESULTS, agent, current_user_id, get_hypothesis_candidates, hypothesis_fingerprint, search_message,
+    stream_search, structured_search
+)
+from agent.tools import EMBEDDING_KEY, format_result_title, list_memories, save_memories
+from agent.ratelimit import QueueTimeout, limited, limited_request
+from agent.spatial import SpatialIndex, geocode_city, rank_by_proximity
+from agent.text_index import TextIndex
+from agent.dedup import Deduplicator
+from agent.docstore import Document, documents
+from agent.prefetch import prefetcher
+from agent.storage import SessionStore, chunked_urls, save_cached_hypotheses
+from agent.export import export_research, import_research
+from agent.documents import ingest_documents
+from agent.summarize import summarize_research_box
+from agent.conversation import ConversationMemory
+from agent import metrics, profiling
 import re
 
 # Load environment variables
 load_dotenv()
 
+# Stages that are checked outside their own branch of the page below
+RESEARCH_BOX_STAGE = "research_box"
+HYPOTHESIS_STAGE = "hypothesis"
+
+# Every full script run is counted and timed; fragment runs are timed separately
+_run_started = time.perf_counter()
+profiling.begin("rerun")
+
 # Page config and logo
 st.image("images/logo final_website looka.png", width=600)
 st.markdown("""
@@ -62,6 +88,65 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# Session state that survives a browser refresh or a container restart
+PERSISTED_COLLECTIONS = [
+    "results", "all_search_results", "selected_results", "refined_results",
+    "refined_search_results", "hypothesis_results", "selected_for_refinement",
+]
+PERSISTED_THREADS = ["messages", "chat_history"]
+PERSISTED_VALUES = [
+    "stage", "mode", "search_params", "selected_location", "initial_hypotheses",
+    "hypothesis_candidates", "hypothesis_candidate_index", "hypotheses_fingerprint",
+    "box_summary",
+]
+
+def restore_session(store):
+    saved = store.load()
+    for name, docs in saved["collections"].items():
+        if name == "selected_for_refinement":
+            st.session_state[name] = {doc["url"]: doc for doc in docs}
+        else:
+            st.session_state[name] = docs
+    for thread, messages in saved["threads"].items():
+        st.session_state[thread] = messages
+    for key, value in saved["values"].items():
+        st.session_state[key] = value
+    # Deduplicated and indexed on first use (index_restored), so a restore reads no document content
+    st.session_state.unindexed_results = list({
+        id(doc): doc for docs in saved["collections"].values() for doc in docs
+    }.values())
+
+def index_restored():
+    # Restored results become deduplicated and locally searchable, like freshly found ones
+    restored = st.session_state.pop("unindexed_results", None)
+    if restored:
+        with metrics.timed("dedup.restore"):
+            unique, _ = st.session_state.deduplicator.dedupe(restored)
+        st.session_state.text_index.add_many(unique)
+
+def persist_session():
+    # Only what changed since the last call is written
+    store = st.session_state.store
+    for name in PERSISTED_COLLECTIONS:
+        if name in st.session_state:
+            docs = st.session_state[name]
+            store.save_collection(name, list(docs.values()) if isinstance(docs, dict) else docs)
+    for thread in PERSISTED_THREADS:
+        if thread in st.session_state:
+            store.save_messages(thread, st.session_state[thread])
+    for key in PERSISTED_VALUES:
+        if key in st.session_state:
+            store.save_value(key, st.session_state[key])
+
+# The session id lives in the URL, so a refresh restores the same session
+if "store" not in st.session_state:
+    session_id = st.query_params.get("session")
+    st.session_state.store = SessionStore(session_id)
+    if session_id:
+        restore_session(st.session_state.store)
+    else:
+        st.query_params["session"] = st.session_state.store.session_id
+
 # Initialize session state
 if "stage" not in st.session_state:
     st.session_state.stage = "initial"
@@ -85,185 +170,150 @@ if "selected_for_refinement" not in st.session_state:
     st.session_state.selected_for_refinement = {}
 if "all_search_results" not in st.session_state:
     st.session_state.all_search_results = []
+if "spatial_index" not in st.session_state:
+    st.session_state.spatial_index = SpatialIndex()
+if "text_index" not in st.session_state:
+    st.session_state.text_index = TextIndex()
+if "deduplicator" not in st.session_state:
+    st.session_state.deduplicator = Deduplicator()
 
-# Stage: Initial input form
-if st.session_state.stage == "initial":
-    # Show welcome message only on initial page
-    st.markdown("""
-    <div class="dialog-bubble">
-        <strong>👋 Hello, fellow Urbanist!</strong><br>
-        I'm <b>Ombu</b>, an agent to help you research urban trends and build hypotheses for your spatial analysis projects.<br><br>
-        <b>What would you like to explore today?</b>
-        <ul>
-            <li>Evolution of green corridors in Barcelona (2000–2024)</li>
-            <li>Case studies on cycling infrastructure in South America</li>
-            <li>Post-pandemic strategies for accessibility maps in Seoul</li>
-        </ul>
-    </div>
-    <div class="dialog-arrow">⬇️</div>
-    """, unsafe_allow_html=True)
+st.session_state.full_reruns = st.session_state.get("full_reruns", 0) + 1
 
-    st.markdown("""
-    <div class="dialog-bubble">
-        <strong>🌐 What can this tool do?</strong>
-        <ul>
-            <li>Search serious sources (gov reports, NGOs, academic journals)</li>
-            <li>Summarize them in 3 bullets</li>
-            <li>Help you build hypotheses for spatial analysis</li>
-            <li>Let you save and compare documents in your Research Box</li>
-        </ul>
-    </div>
-    """, unsafe_allow_html=True)
-
-    st.markdown("### Start by defining your research parameters:")
+# Save whatever the previous run changed before it called st.rerun()
+persist_session()
 
-    city = st.text_input("City / Region / Country")
-
-    if city:
+def app_fragment(fn):
+    # Widgets inside a fragment only re-run the fragment, not the whole script
+    @st.fragment
+    @wraps(fn)
+    def run(*args, **kwargs):
+        start = time.perf_counter()
         try:
-            geolocator = Nominatim(user_agent="urban_lab_app", timeout=10)
-            location = geolocator.geocode(city)
+            with profiling.section("fragment"):
+                return fn(*args, **kwargs)
+        finally:
+            metrics.record_timing("app.fragment_run", time.perf_counter() - start)
+            metrics.increment(f"app.fragment_runs.{fn.__name__}")
+            # A fragment run never reaches the end of the script, so it saves its own changes
+            persist_session()
+            prefetch_hypotheses()
+    return run
 
-            if location:
-                m = folium.Map(
-                    location=[location.latitude, location.longitude],
-                    zoom_start=12,
-                    tiles='CartoDB positron',  # Light grayscale map
-                    attr='CartoDB'
-                )
+def rerun_fragment():
+    # A fragment's widgets normally re-run only the fragment, but a full run also executes
+    # fragments (and AppTest always runs the whole script), where scope="fragment" is an error
+    ctx = get_script_run_ctx()
+    if ctx is not None and ctx.fragment_ids_this_run:
+        st.rerun(scope="fragment")
+    st.rerun()
 
-                osm_id = location.raw.get('osm_id')
-                osm_type = location.raw.get('osm_type')
-                if osm_id and osm_type:
-                    try:
-                        # Get the boundary data from Nominatim
-                        nominatim_url = f"https://nominatim.openstreetmap.org/details.php?osmtype={osm_type[0].upper()}&osmid={osm_id}&class=boundary&format=json"
-                        headers = {
-                            'User-Agent': 'Mozilla/5.0 (compatible; urban_lab_app/1.0)',
-                            'Accept': 'application/json'
-                        }
-                        response = requests.get(nominatim_url, headers=headers, timeout=15)
-                        
-                        if response.ok:
-                            data = response.json()
-                            if 'geometry' in data and 'coordinates' in data['geometry']:
-                                coords = data['geometry']['coordinates']
-                                boundary_coords = []
-                                
-                                try:
-                                    # Debug the actual values
-                                    st.write("Raw coordinates:", coords)
-                                    
-                                    # Create a circle with 10km radius around the city center
-                                    folium.Circle(
-                                        location=[location.latitude, location.longitude],
-                                        radius=10000,  # 10km in meters
-                                        color='#4A90E2',      # Blue border
-                                        weight=2,             # Border width
-                                        fill=True,
-                                        fill_color='#4A90E2', # Blue fill
-                                        fill_opacity=0.3,     # Semi-transparent
-                                        popup=f'10km radius around {city}'
-                                    ).add_to(m)
-                                    
-                                except Exception as e:
-                                    st.warning(f"Error processing coordinates: {str(e)}")
-                                    st.write("Raw coordinates:", coords)
-                            else:
-                                st.warning("No boundary data found for this location")
-                                st.write("Available data keys:", list(data.keys()))
-                                if 'geometry' in data:
-                                    st.write("Geometry keys:", list(data['geometry'].keys()))
-                        else:
-                            st.warning(f"Failed to fetch boundary data: HTTP {response.status_code}")
-                            st.write("Response:", response.text[:500])
-                    except Exception as e:
-                        st.warning(f"Error fetching boundary data: {str(e)}")
+# How long the 🔮 selection must stay unchanged before hypotheses are generated ahead of the click
+HYPOTHESIS_PREFETCH_DELAY = 2.0
 
-                folium_static(m)
+def prefetch_hypotheses():
+    # The next step after picking 🔮 documents is "✨ Generate Hypotheses"; its answer lands in the hypothesis cache
+    docs = st.session_state.get("hypothesis_results") or []
+    if st.session_state.stage not in (RESEARCH_BOX_STAGE, HYPOTHESIS_STAGE) or not docs:
+        return
+    fingerprint = hypothesis_fingerprint(docs)
+    if st.session_state.get("hypotheses_fingerprint") == fingerprint and "initial_hypotheses" in st.session_state:
+        return
+    prefetcher.schedule(st.session_state.store.session_id, "hypotheses", fingerprint,
+                        get_hypothesis_candidates, list(docs), delay=HYPOTHESIS_PREFETCH_DELAY)
 
-                st.session_state.selected_location = {
-                    "name": city,
-                    "lat": location.latitude,
-                    "lon": location.longitude
-                }
-                st.write(f"Selected location: {location.address}")
-                st.write(f"Coordinates: {location.latitude}, {location.longitude}")
-            else:
-                st.warning("Location not found.")
-        except GeocoderTimedOut:
-            st.error("Geocoding service timed out.")
+@lru_cache(maxsize=4096)
+def _result_title(title, url, content):
+    return format_result_title({"title": title, "url": url, "content": content})
 
-    topic = st.text_input("Topic")
-    current_year = datetime.now().year
-    years = list(range(1900, current_year + 1))[::-1]
-    col1, col2 = st.columns(2)
-    with col1:
-        start_year = st.selectbox("From", years, index=0)
-    with col2:
-        end_year = st.selectbox("To", years, index=0)
-    timeframe = f"{start_year}-{end_year}"
-    st.markdown("**Document Type**")
-    doc_types = ["Reports", "Research Papers", "Urban Strategy Documents", "Technical Reports", "Smart City Projects"]
+@lru_cache(maxsize=4096)
+def _document_title(key):
+    return format_result_title(documents.get(key))
 
-    # Use multiselect to allow checking more than one document type
-    # By default, no document types are selected; user must choose
-    selected_doc_types = st.multiselect(
-        "Select one or more document types:",
-        options=doc_types,
-        default=[]
-    )
+def result_title(result):
+    # Titles are needed on every run, so the regex work is cached per document
+    if isinstance(result, Document):
+        # Keyed on the document key, so the cache holds neither the document nor its content
+        # and evicted sessions' documents can still be freed
+        return _document_title(result.key)
+    return _result_title(result["title"], result["url"], result.get("content", ""))
 
-    # Define doc_type for downstream use
-    if not selected_doc_types:
-        doc_type = "All Types"
-    elif len(selected_doc_types) == 1:
-        doc_type = selected_doc_types[0]
-    else:
-        doc_type = ", ".join(selected_doc_types)
+# Typing in any other field re-runs the script, so lookups are cached instead of repeated
+@st.cache_data(ttl=24 * 3600, show_spinner=False)
+def lookup_location(city):
+    location = limited("nominatim", Nominatim(user_agent="urban_lab_app", timeout=10).geocode, city)
+    if not location:
+        return None
+    return {"lat": location.latitude, "lon": location.longitude, "address": location.address, "raw": location.raw}
 
-    if not selected_doc_types:
-        selected_doc_types.append("All Types")
+@st.cache_data(ttl=24 * 3600, show_spinner=False)
+def fetch_boundary(osm_type, osm_id):
+    # Get the boundary data from Nominatim
+    nominatim_url = f"https://nominatim.openstreetmap.org/details.php?osmtype={osm_type[0].upper()}&osmid={osm_id}&class=boundary&format=json"
+    headers = {
+        'User-Agent': 'Mozilla/5.0 (compatible; urban_lab_app/1.0)',
+        'Accept': 'application/json'
+    }
+    response = limited_request("nominatim", "GET", nominatim_url, headers=headers, timeout=15)
+    return {
+        "ok": response.ok,
+        "status_code": response.status_code,
+        "data": response.json() if response.ok else None,
+        "text": response.text[:500],
+    }
 
-    doc_types_str = ", ".join(selected_doc_types)
-    num_results = st.number_input("Number of results", min_value=1, max_value=10, value=5)
-    if st.button("🔍 Start Research"):
-        if not st.session_state.selected_location:
-            st.warning("Please enter a valid city and wait for the map to load.")
-        else:
-            st.session_state.search_params = {
-                "city": city,
-                "topic": topic,
-                "timeframe": timeframe,
-                "doc_type": doc_type,
-                "num_results": num_results
-            }
-            initial_prompt = f"Find {str(doc_type).lower()} about {str(topic).lower()} in {city} during {timeframe}."
-            st.session_state.messages = [
-                {"role": "system", "content": "You are a helpful research assistant for urban planning."},
-                {"role": "user", "content": initial_prompt}
-            ]
-            with st.spinner("🧠 Thinking..."):
-                response_obj = agent(st.session_state.messages)
-            st.session_state.results = response_obj.get("results", [])
-            st.session_state.all_search_results = response_obj.get("results", []).copy()  # Store original results
-            st.session_state.messages.append({"role": "assistant", "content": response_obj["message"]})
-            st.session_state.stage = "chat"
-            st.session_state.mode = "refine"
-            st.rerun()
+def ingest_results(results):
+    index_restored()
+    # Sessions keep references to one shared copy of each result instead of their own dicts
+    results = documents.intern_many(results)
+    # The same study found again (other URL, mirror, PDF of a landing page) collapses onto its richest record
+    with metrics.timed("dedup.ingest"):
+        unique, displaced = st.session_state.deduplicator.dedupe(results)
+    metrics.increment("dedup.duplicates", len(results) - len(unique))
+    # Keep every result seen this session searchable locally
+    for result in displaced:
+        st.session_state.text_index.remove(result["url"])
+    st.session_state.text_index.add_many(unique)
+    return unique
 
-# Stage: Chat
-elif st.session_state.stage == "chat":
-    # add a back to research parameters button
-    if st.button("← Back to Research Parameters"):
-        st.session_state.stage = "initial"
-        st.rerun()
+def merge_results(current, new):
+    # A later batch can bring a richer copy of a result already listed; it takes that result's place
+    index_restored()
+    merged = {}
+    for result in [*current, *new]:
+        result = st.session_state.deduplicator.representative(result)
+        merged.setdefault(id(result), result)
+    return list(merged.values())
 
-    st.subheader("💬 Research Assistant")
+@app_fragment
+def render_local_search(key):
+    # Instant local search over every result seen in this session
+    query = st.text_input("🔎 Search everything found so far", key=f"local_search_{key}",
+                          placeholder="e.g. bike lanes, Bogotá, green space...")
+    if not query:
+        return
+    index_restored()
+    hits = st.session_state.text_index.search(query, limit=10)
+    if not hits:
+        st.caption(f"No matches among {len(st.session_state.text_index)} results seen this session.")
+        return
+    for idx, (result, _) in enumerate(hits, 1):
+        col1, col2 = st.columns([0.9, 0.1])
+        with col1:
+            with st.expander(f"{idx}. {result_title(result)}"):
+                st.write(result["content"][:300] + "...")
+                st.markdown(f"[🔗 View source]({result['url']})")
+        with col2:
+            is_in_box = any(r["url"] == result["url"] for r in st.session_state.selected_results)
+            if st.button("✅" if is_in_box else "📌", key=f"local_search_add_{key}_{idx}", help="Add to My Box"):
+                if not is_in_box:
+                    st.session_state.selected_results.append(result)
+                st.rerun()
 
+@app_fragment
+def render_search_results():
     # Display search results first
     for idx, result in enumerate(st.session_state.results, 1):
-        display_title = format_result_title(result)
+        display_title = result_title(result)
         
         # Create columns for the result and buttons
         col1, col2, col3 = st.columns([0.8, 0.1, 0.1])
@@ -277,18 +327,18 @@ elif st.session_state.stage == "chat":
         msg_container = st.container()
         
         with col2:
-            is_in_box = result in st.session_state.selected_results
+            is_in_box = any(r["url"] == result["url"] for r in st.session_state.selected_results)
             if st.button("📌", key=f"add_refined_{idx}", help="Add to My Box"):
                 if not is_in_box:
                     st.session_state.selected_results.append(result)
-                st.rerun()
+                rerun_fragment()
         
         with col3:
-            is_in_refinement = result in st.session_state.refined_results
+            is_in_refinement = any(r["url"] == result["url"] for r in st.session_state.refined_results)
             if st.button("🔍", key=f"refine_refined_{idx}", help="Select for refined topic"):
                 if not is_in_refinement:
                     st.session_state.refined_results.append(result)
-                st.rerun()
+                rerun_fragment()
 
     # Show navigation options after results
     st.divider()
@@ -305,10 +355,10 @@ elif st.session_state.stage == "chat":
             with col_clear:
                 if st.button("🗑️", key="clear_box", help="Clear all selections"):
                     st.session_state.selected_results = []
-                    st.rerun()
+                    rerun_fragment()
             
             if st.button(f"✨ Go to my Research Box", use_container_width=True, type="primary"):
-                st.session_state.stage = "research_box"
+                st.session_state.stage = RESEARCH_BOX_STAGE
                 st.rerun()
         else:
             st.info("No items selected yet")
@@ -322,7 +372,7 @@ elif st.session_state.stage == "chat":
             with col_clear:
                 if st.button("🗑️", key="clear_refine", help="Clear all selections"):
                     st.session_state.refined_results = []
-                    st.rerun()
+                    rerun_fragment()
             
             if st.button("🕵🏻‍♀️ Start Refinement", use_container_width=True, type="primary"):
                 st.session_state.stage = "refine_search"
@@ -331,34 +381,45 @@ elif st.session_state.stage == "chat":
         else:
             st.info("No items selected yet")
 
-    # Input field
-    if prompt := st.chat_input("Ask me anything about the research..."):
-        st.session_state.messages.append({"role": "user", "content": prompt})
-        with st.chat_message("user"):
-            st.markdown(prompt)
-
-        with st.spinner("🧠 Thinking..."):
-            response = agent(st.session_state.messages)
-
-        st.session_state.results = response.get("results", st.session_state.results)
-        st.session_state.messages.append({"role": "assistant", "content": response["message"]})
-
-        with st.chat_message("assistant"):
-            st.markdown(response["message"])
-
-# Add new stages
-elif st.session_state.stage == "research_box":
-    st.subheader("My Research Box")
-    if st.button("← Back to Results"):
-        st.session_state.stage = "chat"
-        st.rerun()
-    
+@app_fragment
+def render_research_box():
     # Show count of items selected for refinement
     if st.session_state.refined_results:
         st.write(f"🔎{len(st.session_state.refined_results)} items selected for refinement")
     
-    for idx, result in enumerate(st.session_state.selected_results, 1):
-        display_title = format_result_title(result)
+    # Filter the box by distance to the selected (or any typed) location
+    box_results = st.session_state.selected_results
+    distances = {}
+    if st.session_state.selected_results:
+        with st.expander("📍 Filter by location"):
+            default_place = (st.session_state.selected_location or {}).get("name", "")
+            place = st.text_input("Near", value=default_place, key="spatial_place")
+            filter_mode = st.radio("Show", ["All documents", "Within radius", "Nearest"], horizontal=True, key="spatial_filter_mode")
+            if filter_mode != "All documents" and place:
+                if st.session_state.selected_location and place == default_place:
+                    coords = (st.session_state.selected_location["lat"], st.session_state.selected_location["lon"])
+                else:
+                    coords = geocode_city(place)
+                if coords:
+                    spatial_index = st.session_state.spatial_index
+                    spatial_index.sync(st.session_state.selected_results)
+                    if filter_mode == "Within radius":
+                        radius_km = st.slider("Radius (km)", min_value=10, max_value=5000, value=300, step=10, key="spatial_radius")
+                        hits = spatial_index.within(coords[0], coords[1], radius_km)
+                    else:
+                        k = st.number_input("Number of studies", min_value=1, max_value=100, value=20, key="spatial_k")
+                        hits = spatial_index.nearest(coords[0], coords[1], int(k))
+                    box_results = [doc for doc, _ in hits]
+                    distances = {doc["url"]: km for doc, km in hits}
+                    st.caption(f"{len(box_results)} of {len(st.session_state.selected_results)} documents "
+                               f"({len(spatial_index)} with a known location)")
+                else:
+                    st.warning("Location not found.")
+
+    for idx, result in enumerate(box_results, 1):
+        display_title = result_title(result)
+        if result["url"] in distances:
+            display_title += f" · {distances[result['url']]:.0f} km"
         
         # Create columns for the result and buttons
         col1, col2, col3, col4 = st.columns([0.75, 0.125, 0.125, 0.125])
@@ -378,7 +439,7 @@ elif st.session_state.stage == "research_box":
                 else:
                     st.session_state.refined_results = [r for r in st.session_state.refined_results if r["url"] != result["url"]]
                     st.info(f"Removed from refinement: {display_title}")
-                st.rerun()
+                rerun_fragment()
         
         with col3:
             is_in_hypothesis = any(r["url"] == result["url"] for r in st.session_state.get("hypothesis_results", []))
@@ -392,7 +453,7 @@ elif st.session_state.stage == "research_box":
                 else:
                     st.session_state.hypothesis_results = [r for r in st.session_state.hypothesis_results if r["url"] != result["url"]]
                     st.info(f"Removed from Hypothesis Lab: {display_title}")
-                st.rerun()
+                rerun_fragment()
         
         with col4:
             if st.button("🗑️", key=f"delete_box_{idx}", help="Delete this result"):
@@ -401,7 +462,7 @@ elif st.session_state.stage == "research_box":
                 st.session_state.refined_results = [r for r in st.session_state.refined_results if r["url"] != result["url"]]
                 if "hypothesis_results" in st.session_state:
                     st.session_state.hypothesis_results = [r for r in st.session_state.hypothesis_results if r["url"] != result["url"]]
-                st.rerun()
+                rerun_fragment()
 
     # Add Clear Box button at the bottom
     st.divider()
@@ -417,40 +478,23 @@ elif st.session_state.stage == "research_box":
     with col_hypothesis:
         hypothesis_count = len(st.session_state.get("hypothesis_results", []))
         if st.button(f"🔮 Take me now to the Hypothesis Lab \n\n ({hypothesis_count} studies)", use_container_width=True, type="primary"):
-            st.session_state.stage = "hypothesis"
+            st.session_state.stage = HYPOTHESIS_STAGE
             st.rerun()
 
-elif st.session_state.stage == "refine_search":
-    # Navigation options
-    col1, col2 = st.columns([0.2, 0.8])
-    with col1:
-        if st.button("← Back to Results"):
-            st.session_state.stage = "chat"
-            st.rerun()
-    
-    if st.button(f"✨ Go to my research box\n({len(st.session_state.selected_results)} studies)", use_container_width=True):
-        st.session_state.stage = "research_box"
-        st.rerun()
-    
-    # Show documents first
-    st.markdown("#### Let me help you refine your search. Start by selecting the documents you want to refine:")
-    
-    # Ensure selected_for_refinement is a dictionary
-    if not isinstance(st.session_state.selected_for_refinement, dict):
-        st.session_state.selected_for_refinement = {}
-    
+@app_fragment
+def render_refinement_documents():
     # Show count of selected documents
     if st.session_state.selected_for_refinement:
         st.markdown(f"**Selected {len(st.session_state.selected_for_refinement)} documents for refinement:**")
         # Display selected documents first
         for idx, (url, result) in enumerate(st.session_state.selected_for_refinement.items(), 1):
-            display_title = format_result_title(result)
+            display_title = result_title(result)
             st.markdown(f"{idx}. **{display_title}** ✅")
         st.divider()
     
     # Then show all documents
     for idx, result in enumerate(st.session_state.refined_results, 1):
-        display_title = format_result_title(result)
+        display_title = result_title(result)
         is_selected = result["url"] in st.session_state.selected_for_refinement
         
         # Create columns for the result and buttons
@@ -468,7 +512,7 @@ elif st.session_state.stage == "refine_search":
                     st.session_state.selected_results.append(result)
                 else:
                     st.session_state.selected_results = [r for r in st.session_state.selected_results if r["url"] != result["url"]]
-                st.rerun()
+                rerun_fragment()
         
         with col3:
             button_icon = "✅" if is_selected else "⏹️"
@@ -491,7 +535,7 @@ elif st.session_state.stage == "refine_search":
                 if result["url"] in st.session_state.selected_for_refinement:
                     del st.session_state.selected_for_refinement[result["url"]]
                 
-                st.rerun()
+                rerun_fragment()
 
     # Add a divider between documents and refinement options
     st.divider()
@@ -506,7 +550,402 @@ elif st.session_state.stage == "refine_search":
         st.session_state.refined_search_results = []
         st.session_state.selected_for_refinement = {}
         st.rerun()
+
+@app_fragment
+def render_refined_search_results():
+    if st.session_state.refined_search_results:
+        st.markdown("### 🔍 Refined Search Results")
+        for idx, result in enumerate(st.session_state.refined_search_results, 1):
+            display_title = result_title(result)
+            
+            # Create columns for the result and buttons
+            col1, col2, col3, col4 = st.columns([0.7, 0.1, 0.1, 0.1])
+            
+            with col1:
+                with st.expander(f"{idx}. {display_title}"):
+                    st.write(result["content"][:300] + "...")
+                    st.markdown(f"[🔗 View source]({result['url']})")
+            
+            with col2:
+                is_in_box = any(r["url"] == result["url"] for r in st.session_state.selected_results)
+                if st.button("📌", key=f"add_refined_{idx}", help="I want to send this to my research box"):
+                    if not is_in_box:
+                        st.session_state.selected_results.append(result)
+                        st.success(f"Added to Research Box: {display_title}")
+                    else:
+                        st.session_state.selected_results = [r for r in st.session_state.selected_results if r["url"] != result["url"]]
+                        st.info(f"Removed from Research Box: {display_title}")
+                    rerun_fragment()
+            
+            with col3:
+                is_selected = result["url"] in st.session_state.selected_for_refinement
+                button_icon = "✅" if is_selected else "⏹️"
+                if st.button(button_icon, key=f"refine_refined_{idx}", help="Select this document for refinement"):
+                    if not is_selected:
+                        st.session_state.selected_for_refinement[result["url"]] = result
+                        st.success(f"Selected for refinement: {display_title}")
+                    else:
+                        del st.session_state.selected_for_refinement[result["url"]]
+                        st.info(f"Deselected from refinement: {display_title}")
+                    st.rerun()
+
+            with col4:
+                if st.button("🗑️", key=f"delete_refined_{idx}", help="Remove this document and show a new one"):
+                    # Get a new result that's not currently in refined_search_results
+                    current_urls = {r["url"] for r in st.session_state.refined_search_results}
+                    available_results = [r for r in st.session_state.all_search_results if r["url"] not in current_urls]
+                    
+                    if available_results:
+                        # Get the first available new result
+                        new_result = available_results[0]
+                        
+                        # Replace the current result with the new one
+                        st.session_state.refined_search_results[idx - 1] = new_result
+                        
+                        # Clean up from other lists if needed
+                        st.session_state.selected_results = [r for r in st.session_state.selected_results if r["url"] != result["url"]]
+                        if result["url"] in st.session_state.selected_for_refinement:
+                            del st.session_state.selected_for_refinement[result["url"]]
+                        
+                        st.success(f"Replaced with: {result_title(new_result)}")
+                    else:
+                        # If no new results available, remove the current one
+                        st.session_state.refined_search_results = [r for r in st.session_state.refined_search_results if r["url"] != result["url"]]
+                        st.warning("No more new results available")
+                    
+                    st.rerun()
+
+        # Show counts after the results
+        if st.session_state.selected_for_refinement:
+            st.write(f"Selected {len(st.session_state.selected_for_refinement)} documents for refinement")
+        if st.session_state.selected_results:
+            st.write(f"Added {len(st.session_state.selected_results)} documents to Research Box")
+
+        # Add Clear Refinement Lab button at the bottom
+        st.divider()
+        if st.button("🗑️ Clear Refinement Lab", key="clear_refinement_lab_btn_2", use_container_width=True):
+            st.session_state.refined_results = []
+            st.session_state.refined_search_results = []
+            st.session_state.selected_for_refinement = {}
+            st.rerun()
+
+# Stage: Initial input form
+if st.session_state.stage == "initial":
+    # Show welcome message only on initial page
+    st.markdown("""
+    <div class="dialog-bubble">
+        <strong>👋 Hello, fellow Urbanist!</strong><br>
+        I'm <b>Ombu</b>, an agent to help you research urban trends and build hypotheses for your spatial analysis projects.<br><br>
+        <b>What would you like to explore today?</b>
+        <ul>
+            <li>Evolution of green corridors in Barcelona (2000–2024)</li>
+            <li>Case studies on cycling infrastructure in South America</li>
+            <li>Post-pandemic strategies for accessibility maps in Seoul</li>
+        </ul>
+    </div>
+    <div class="dialog-arrow">⬇️</div>
+    """, unsafe_allow_html=True)
+
+    st.markdown("""
+    <div class="dialog-bubble">
+        <strong>🌐 What can this tool do?</strong>
+        <ul>
+            <li>Search serious sources (gov reports, NGOs, academic journals)</li>
+            <li>Summarize them in 3 bullets</li>
+            <li>Help you build hypotheses for spatial analysis</li>
+            <li>Let you save and compare documents in your Research Box</li>
+        </ul>
+    </div>
+    """, unsafe_allow_html=True)
+
+    st.markdown("### Start by defining your research parameters:")
+
+    city = st.text_input("City / Region / Country")
+
+    if city:
+        try:
+            location = lookup_location(city)
+
+            if location:
+                m = folium.Map(
+                    location=[location["lat"], location["lon"]],
+                    zoom_start=12,
+                    tiles='CartoDB positron',  # Light grayscale map
+                    attr='CartoDB'
+                )
+
+                osm_id = location["raw"].get('osm_id')
+                osm_type = location["raw"].get('osm_type')
+                if osm_id and osm_type:
+                    try:
+                        response = fetch_boundary(osm_type, osm_id)
+                        
+                        if response["ok"]:
+                            data = response["data"]
+                            if 'geometry' in data and 'coordinates' in data['geometry']:
+                                coords = data['geometry']['coordinates']
+                                boundary_coords = []
+                                
+                                try:
+                                    # Debug the actual values
+                                    st.write("Raw coordinates:", coords)
+                                    
+                                    # Create a circle with 10km radius around the city center
+                                    folium.Circle(
+                                        location=[location["lat"], location["lon"]],
+                                        radius=10000,  # 10km in meters
+                                        color='#4A90E2',      # Blue border
+                                        weight=2,             # Border width
+                                        fill=True,
+                                        fill_color='#4A90E2', # Blue fill
+                                        fill_opacity=0.3,     # Semi-transparent
+                                        popup=f'10km radius around {city}'
+                                    ).add_to(m)
+                                    
+                                except Exception as e:
+                                    st.warning(f"Error processing coordinates: {str(e)}")
+                                    st.write("Raw coordinates:", coords)
+                            else:
+                                st.warning("No boundary data found for this location")
+                                st.write("Available data keys:", list(data.keys()))
+                                if 'geometry' in data:
+                                    st.write("Geometry keys:", list(data['geometry'].keys()))
+                        else:
+                            st.warning(f"Failed to fetch boundary data: HTTP {response['status_code']}")
+                            st.write("Response:", response["text"])
+                    except Exception as e:
+                        st.warning(f"Error fetching boundary data: {str(e)}")
+
+                folium_static(m)
+
+                st.session_state.selected_location = {
+                    "name": city,
+                    "lat": location["lat"],
+                    "lon": location["lon"]
+                }
+                st.write(f"Selected location: {location['address']}")
+                st.write(f"Coordinates: {location['lat']}, {location['lon']}")
+            else:
+                st.warning("Location not found.")
+        except GeocoderTimedOut:
+            st.error("Geocoding service timed out.")
+        except (GeocoderRateLimited, QueueTimeout):
+            st.error("Geocoding service is busy, please try again in a moment.")
+
+    topic = st.text_input("Topic")
+    current_year = datetime.now().year
+    years = list(range(1900, current_year + 1))[::-1]
+    col1, col2 = st.columns(2)
+    with col1:
+        start_year = st.selectbox("From", years, index=0)
+    with col2:
+        end_year = st.selectbox("To", years, index=0)
+    timeframe = f"{start_year}-{end_year}"
+    st.markdown("**Document Type**")
+    doc_types = ["Reports", "Research Papers", "Urban Strategy Documents", "Technical Reports", "Smart City Projects"]
+
+    # Use multiselect to allow checking more than one document type
+    # By default, no document types are selected; user must choose
+    selected_doc_types = st.multiselect(
+        "Select one or more document types:",
+        options=doc_types,
+        default=[]
+    )
+
+    # Define doc_type for downstream use
+    if not selected_doc_types:
+        doc_type = "All Types"
+    elif len(selected_doc_types) == 1:
+        doc_type = selected_doc_types[0]
+    else:
+        doc_type = ", ".join(selected_doc_types)
+
+    if not selected_doc_types:
+        selected_doc_types.append("All Types")
+
+    doc_types_str = ", ".join(selected_doc_types)
+    num_results = st.number_input("Number of results", min_value=1, max_value=MAX_SEARCH_RESULTS, value=5)
+    st.session_state.rerank_enabled = st.checkbox(
+        "🧠 Re-rank results by relevance (fetches more results and keeps the best)",
+        value=st.session_state.get("rerank_enabled", False)
+    )
+    if st.button("🔍 Start Research"):
+        if not st.session_state.selected_location:
+            st.warning("Please enter a valid city and wait for the map to load.")
+        else:
+            st.session_state.search_params = {
+                "city": city,
+                "topic": topic,
+                "timeframe": timeframe,
+                "doc_type": doc_type,
+                "doc_types": selected_doc_types if "All Types" not in selected_doc_types else doc_types,
+                "num_results": num_results
+            }
+            initial_prompt = f"Find {str(doc_type).lower()} about {str(topic).lower()} in {city} during {timeframe}."
+            st.session_state.messages = [
+                {"role": "system", "content": "You are a helpful research assistant for urban planning."},
+                {"role": "user", "content": initial_prompt}
+            ]
+            # The chat stage runs the search and lists results as they arrive
+            st.session_state.results = []
+            st.session_state.all_search_results = []
+            st.session_state.search_pending = True
+            st.session_state.stage = "chat"
+            st.session_state.mode = "refine"
+            st.rerun()
+
+# Stage: Chat
+elif st.session_state.stage == "chat":
+    # add a back to research parameters button
+    if st.button("← Back to Research Parameters"):
+        st.session_state.stage = "initial"
+        st.rerun()
+
+    st.subheader("💬 Research Assistant")
+    # Cleared first: a search interrupted by a click keeps what it found instead of starting over
+    if st.session_state.pop("search_pending", False):
+        target = st.session_state.search_params["num_results"]
+        progress = st.empty()
+        found = st.container()
+        listed = set()
+        # The form already holds every search argument, so the model isn't asked to route it
+        for batch in stream_search(st.session_state.search_params, target, mode="search"):
+            st.session_state.results = merge_results(st.session_state.results, ingest_results(batch))
+            st.session_state.all_search_results = st.session_state.results.copy()  # Store original results
+            progress.caption(f"🔍 Found {len(st.session_state.results)} of {target} documents...")
+            with found:
+                for result in st.session_state.results:
+                    if id(result) not in listed:
+                        listed.add(id(result))
+                        st.markdown(f"{len(listed)}. {result_title(result)}")
+        st.session_state.messages.append({"role": "assistant",
+                                          "content": search_message(st.session_state.results, "search")})
+        # Show the full, interactive list
+        st.rerun()
+    render_search_results()
+
+    render_local_search("chat")
+
+    # Input field
+    if prompt := st.chat_input("Ask me anything about the research..."):
+        st.session_state.messages.append({"role": "user", "content": prompt})
+        with st.chat_message("user"):
+            st.markdown(prompt)
+
+        with st.spinner("🧠 Thinking..."):
+            response = agent(st.session_state.messages)
+
+        st.session_state.results = ingest_results(response.get("results", st.session_state.results))
+        st.session_state.messages.append({"role": "assistant", "content": response["message"]})
+
+        with st.chat_message("assistant"):
+            st.markdown(response["message"])
+
+# Add new stages
+elif st.session_state.stage == RESEARCH_BOX_STAGE:
+    st.subheader("My Research Box")
+    if st.button("← Back to Results"):
+        st.session_state.stage = "chat"
+        st.rerun()
+
+    render_research_box()
+
+    # Overview of the whole box, built from cached per-document summaries
+    if st.session_state.selected_results:
+        st.divider()
+        if st.button("🧠 Summarize my Research Box", use_container_width=True):
+            with st.spinner(f"🧠 Summarizing {len(st.session_state.selected_results)} documents..."):
+                st.session_state.box_summary = summarize_research_box(st.session_state.selected_results)
+        if st.session_state.get("box_summary"):
+            box_summary = st.session_state.box_summary
+            st.markdown("#### 🧠 Research Box overview")
+            st.markdown(box_summary["overview"])
+            timings = box_summary["timings"]
+            st.caption(
+                f"{box_summary['cache_hits']} cached / {box_summary['cache_misses']} new summaries · "
+                f"map {timings.get('map', 0):.1f}s · reduce {timings.get('reduce', 0):.1f}s"
+            )
+            titles = {r["url"]: result_title(r) for r in st.session_state.selected_results}
+            for url, summary in box_summary["summaries"].items():
+                with st.expander(f"📄 {titles.get(url, url)}"):
+                    st.markdown(summary)
+
+    # Bulk export/import for analysis in pandas or GIS tools
+    with st.expander("📦 Export or import (Parquet)"):
+        col_export, col_import = st.columns(2)
+        with col_export:
+            if st.button("Prepare export", disabled=not st.session_state.selected_results):
+                try:
+                    memories = list_memories(current_user_id())
+                except Exception as e:
+                    st.warning(f"Memories were left out of the export: {e}")
+                    memories = []
+                buffer = io.BytesIO()
+                with st.spinner(f"📦 Exporting {len(st.session_state.selected_results)} documents..."):
+                    export_research(
+                        buffer,
+                        st.session_state.selected_results,
+                        hypothesis_urls=[r["url"] for r in st.session_state.get("hypothesis_results", [])],
+                        hypotheses=st.session_state.get("hypothesis_candidates", []),
+                        memories=memories
+                    )
+                st.session_state.research_export = buffer.getvalue()
+            if st.session_state.get("research_export"):
+                st.download_button("⬇️ Download research_box.zip", st.session_state.research_export,
+                                   file_name="research_box.zip", mime="application/zip")
+        with col_import:
+            uploaded = st.file_uploader("Import an export file", type="zip", key="research_import")
+            if uploaded and st.button("Import into my Research Box"):
+                with st.spinner("📦 Importing..."):
+                    imported = import_research(uploaded)
+                    # Same path as fresh search results: shared, deduplicated and locally searchable
+                    docs = ingest_results(imported["documents"])
+                    box_urls = {r["url"] for r in st.session_state.selected_results}
+                    st.session_state.selected_results += [r for r in docs if r["url"] not in box_urls]
+                    hypothesis_docs = list({
+                        id(doc): doc for doc in (
+                            st.session_state.deduplicator.representative(r)
+                            for r in imported["documents"] if r["url"] in imported["hypothesis_urls"]
+                        )
+                    }.values())
+                    if hypothesis_docs and not st.session_state.get("hypothesis_results"):
+                        st.session_state.hypothesis_results = hypothesis_docs
+                        if imported["hypotheses"]:
+                            # The Hypothesis Lab then shows the imported hypotheses instead of generating new ones
+                            save_cached_hypotheses(hypothesis_fingerprint(hypothesis_docs), imported["hypotheses"])
+                    if imported["memories"]:
+                        save_memories(imported["memories"], current_user_id())
+                st.session_state.import_message = (f"Imported {len(docs)} documents, {len(imported['hypotheses'])} "
+                                                   f"hypothesis sets and {len(imported['memories'])} memories.")
+                # The box above was drawn before the import
+                st.rerun()
+            if message := st.session_state.pop("import_message", None):
+                st.success(message)
+
+    st.divider()
+    render_local_search("research_box")
+
+elif st.session_state.stage == "refine_search":
+    # Navigation options
+    col1, col2 = st.columns([0.2, 0.8])
+    with col1:
+        if st.button("← Back to Results"):
+            st.session_state.stage = "chat"
+            st.rerun()
+    
+    if st.button(f"✨ Go to my research box\n({len(st.session_state.selected_results)} studies)", use_container_width=True):
+        st.session_state.stage = RESEARCH_BOX_STAGE
+        st.rerun()
     
+    # Show documents first
+    st.markdown("#### Let me help you refine your search. Start by selecting the documents you want to refine:")
+    
+    # Ensure selected_for_refinement is a dictionary
+    if not isinstance(st.session_state.selected_for_refinement, dict):
+        st.session_state.selected_for_refinement = {}
+
+    render_refinement_documents()
+
     # Then show refinement options
     st.markdown("""
         <style>
@@ -578,6 +1017,12 @@ elif st.session_state.stage == "refine_search":
                 refined_topic = st.text_input("What would you like to explore?", key="refined_topic_input")
                 prompt_prefix = f"Explore {refined_topic} in these documents"
 
+            if st.session_state.selected_location:
+                st.checkbox(f"📍 Rank by proximity to {st.session_state.selected_location['name']}", key="rank_by_proximity")
+            st.session_state.rerank_enabled = st.checkbox(
+                "🧠 Re-rank results by relevance to the selected documents",
+                value=st.session_state.get("rerank_enabled", False)
+            )
             analyze_button = st.button("🔍 Analyze", key="analyze_btn")
 
         if analyze_button and refined_topic:
@@ -590,98 +1035,28 @@ elif st.session_state.stage == "refine_search":
             for result in st.session_state.refined_results:
                 refined_prompt += f"\n- {result['title']}"
             
-            # The system prompt from prompts.py will be automatically used by the agent
-            # when mode="refine" is set in session state
+            # Kept as the conversation so follow-up questions to the agent have this context
             st.session_state.messages = [
                 {"role": "user", "content": refined_prompt}
             ]
 
             with st.spinner("🧠 Analyzing..."):
-                response = agent(st.session_state.messages)
+                response = structured_search({"topic": refined_topic}, mode="refine",
+                                             refine_option=refine_option, refined_topic=refined_topic)
                 if response.get("results"):
+                    response["results"] = ingest_results(response["results"])
+                    if st.session_state.get("rank_by_proximity") and st.session_state.selected_location:
+                        location = st.session_state.selected_location
+                        response["results"] = rank_by_proximity(response["results"], location["lat"], location["lon"])
                     # Store all results in both places
                     st.session_state.refined_search_results = response["results"].copy()
                     st.session_state.all_search_results = response["results"].copy()
                 st.session_state.messages.append({"role": "assistant", "content": response["message"]})
 
         # Show refined results outside the analyze button block
-        if st.session_state.refined_search_results:
-            st.markdown("### 🔍 Refined Search Results")
-            for idx, result in enumerate(st.session_state.refined_search_results, 1):
-                display_title = format_result_title(result)
-                
-                # Create columns for the result and buttons
-                col1, col2, col3, col4 = st.columns([0.7, 0.1, 0.1, 0.1])
-                
-                with col1:
-                    with st.expander(f"{idx}. {display_title}"):
-                        st.write(result["content"][:300] + "...")
-                        st.markdown(f"[🔗 View source]({result['url']})")
-                
-                with col2:
-                    is_in_box = any(r["url"] == result["url"] for r in st.session_state.selected_results)
-                    if st.button("📌", key=f"add_refined_{idx}", help="I want to send this to my research box"):
-                        if not is_in_box:
-                            st.session_state.selected_results.append(result)
-                            st.success(f"Added to Research Box: {display_title}")
-                        else:
-                            st.session_state.selected_results = [r for r in st.session_state.selected_results if r["url"] != result["url"]]
-                            st.info(f"Removed from Research Box: {display_title}")
-                        st.rerun()
-                
-                with col3:
-                    is_selected = result["url"] in st.session_state.selected_for_refinement
-                    button_icon = "✅" if is_selected else "⏹️"
-                    if st.button(button_icon, key=f"refine_refined_{idx}", help="Select this document for refinement"):
-                        if not is_selected:
-                            st.session_state.selected_for_refinement[result["url"]] = result
-                            st.success(f"Selected for refinement: {display_title}")
-                        else:
-                            del st.session_state.selected_for_refinement[result["url"]]
-                            st.info(f"Deselected from refinement: {display_title}")
-                        st.rerun()
-
-                with col4:
-                    if st.button("🗑️", key=f"delete_refined_{idx}", help="Remove this document and show a new one"):
-                        # Get a new result that's not currently in refined_search_results
-                        current_urls = {r["url"] for r in st.session_state.refined_search_results}
-                        available_results = [r for r in st.session_state.all_search_results if r["url"] not in current_urls]
-                        
-                        if available_results:
-                            # Get the first available new result
-                            new_result = available_results[0]
-                            
-                            # Replace the current result with the new one
-                            st.session_state.refined_search_results[idx - 1] = new_result
-                            
-                            # Clean up from other lists if needed
-                            st.session_state.selected_results = [r for r in st.session_state.selected_results if r["url"] != result["url"]]
-                            if result["url"] in st.session_state.selected_for_refinement:
-                                del st.session_state.selected_for_refinement[result["url"]]
-                            
-                            st.success(f"Replaced with: {format_result_title(new_result)}")
-                        else:
-                            # If no new results available, remove the current one
-                            st.session_state.refined_search_results = [r for r in st.session_state.refined_search_results if r["url"] != result["url"]]
-                            st.warning("No more new results available")
-                        
-                        st.rerun()
-
-            # Show counts after the results
-            if st.session_state.selected_for_refinement:
-                st.write(f"Selected {len(st.session_state.selected_for_refinement)} documents for refinement")
-            if st.session_state.selected_results:
-                st.write(f"Added {len(st.session_state.selected_results)} documents to Research Box")
-
-            # Add Clear Refinement Lab button at the bottom
-            st.divider()
-            if st.button("🗑️ Clear Refinement Lab", key="clear_refinement_lab_btn_2", use_container_width=True):
-                st.session_state.refined_results = []
-                st.session_state.refined_search_results = []
-                st.session_state.selected_for_refinement = {}
-                st.rerun()
+        render_refined_search_results()
 
-elif st.session_state.stage == "hypothesis":
+elif st.session_state.stage == HYPOTHESIS_STAGE:
     st.markdown("""
     <div class="hypothesis-bubble">
         <span class="emoji">🔮</span> Hypothesis Lab
@@ -689,60 +1064,91 @@ elif st.session_state.stage == "hypothesis":
     """, unsafe_allow_html=True)
 
     if st.button("← Back to Research Box"):
-        st.session_state.stage = "research_box"
+        st.session_state.stage = RESEARCH_BOX_STAGE
         st.rerun()
 
     if "hypothesis_results" in st.session_state and st.session_state.hypothesis_results:
         st.write(f"Based on {len(st.session_state.hypothesis_results)} selected documents:")
 
         for idx, result in enumerate(st.session_state.hypothesis_results, 1):
-            display_title = format_result_title(result)
+            display_title = result_title(result)
             with st.expander(f"{idx}. {display_title}"):
                 st.write(result["content"][:300] + "...")
                 st.markdown(f"[🔗 View source]({result['url']})")
 
+        # Reading the full documents lets hypotheses draw on more than the search snippets
+        read_in_full = chunked_urls((r["url"] for r in st.session_state.hypothesis_results), EMBEDDING_KEY)
+        col_read, col_status = st.columns([0.4, 0.6])
+        with col_read:
+            read_clicked = st.button("📥 Read full documents", disabled=len(read_in_full) == len(st.session_state.hypothesis_results))
+        with col_status:
+            st.caption(f"{len(read_in_full)} of {len(st.session_state.hypothesis_results)} documents read in full")
+        if read_clicked:
+            to_read = [r for r in st.session_state.hypothesis_results if r["url"] not in read_in_full]
+            with st.spinner(f"📥 Reading {len(to_read)} documents..."):
+                outcome = ingest_documents(to_read)
+            failures = {url: error for url, error in outcome.items() if isinstance(error, str)}
+            for url, error in failures.items():
+                st.warning(f"Could not read {url}: {error}")
+            if not failures:
+                st.rerun()
+
         st.markdown("---")
 
+        # Hypotheses generated for a different document selection are stale
+        fingerprint = hypothesis_fingerprint(st.session_state.hypothesis_results)
+        if st.session_state.get("hypotheses_fingerprint") != fingerprint:
+            st.session_state.pop("initial_hypotheses", None)
+            st.session_state.hypothesis_candidates = []
+
         if "initial_hypotheses" not in st.session_state:
             if st.button("✨ Generate Hypotheses"):
-                prompt = (
-                    "You are an urban research assistant helping generate spatial analysis hypotheses.\n"
-                    "Based on the following studies, suggest exactly 3 researchable hypotheses that could be explored using spatial data.\n"
-                    "Each hypothesis should:\n"
-                    "- Be clearly worded (1–2 sentences)\n"
-                    "- Mention a spatial trend, relationship, or variable (e.g., green space access, density, mobility, land use)\n"
-                    "- Be relevant to urban planning or geography\n"
-                    "Format them as a numbered list (1., 2., 3.).\n"
-                    "If you cannot find enough hypotheses, make them up based on the document titles. "
-                    "Return only a numbered list of 3 hypotheses, nothing else. Do not include any introduction or summary.\n\n"
-                )
-                for result in st.session_state.hypothesis_results:
-                    prompt += f"- {result['title']}\n"
-
-                st.session_state.messages = [{"role": "user", "content": prompt}]
+                # The prompt is built from the selected documents by the agent
+                st.session_state.messages = []
                 st.session_state.mode = "hypothesis"
                 st.session_state.trigger_hypothesis_generation = True
                 st.rerun()
 
         if st.session_state.get("trigger_hypothesis_generation"):
             with st.spinner("🧠 Thinking..."):
+                if not st.session_state.get("refresh_hypotheses"):
+                    # Usually already generated in the background; agent() then reads it from the cache
+                    prefetcher.wait(st.session_state.store.session_id, "hypotheses", fingerprint)
                 response = agent(st.session_state.messages)
                 st.session_state.initial_hypotheses = response["message"]
+                st.session_state.hypothesis_candidates = response.get("candidates", [response["message"]])
+                st.session_state.hypothesis_candidate_index = 0
+                st.session_state.hypotheses_fingerprint = fingerprint
             st.session_state.trigger_hypothesis_generation = False
             st.rerun()
 
         if "initial_hypotheses" in st.session_state:
             st.markdown("### ✅ Suggested Hypotheses")
 
-            # Extract numbered hypotheses (1., 2., 3.)
-            hypotheses = re.findall(r"\d+\.\s+(.*?)(?=\n\d+\.|\Z)", st.session_state.initial_hypotheses, re.DOTALL)
-            # Fallback: try bullet points
-            if len(hypotheses) < 3:
-                hypotheses += re.findall(r"^-\s+(.*?)(?=\n-|\\Z)", st.session_state.initial_hypotheses, re.MULTILINE | re.DOTALL)
+            candidates = st.session_state.get("hypothesis_candidates", [])
+            candidate_index = st.session_state.get("hypothesis_candidate_index", 0)
+            candidate = candidates[candidate_index] if candidate_index < len(candidates) else None
+            if isinstance(candidate, list):
+                # Structured output: hypotheses arrive already validated
+                hypothesis_details = {h["statement"]: h for h in candidate}
+                hypotheses = list(hypothesis_details)
+            else:
+                hypothesis_details = {}
+                # Extract numbered hypotheses (1., 2., 3.)
+                hypotheses = re.findall(r"\d+\.\s+(.*?)(?=\n\d+\.|\Z)", st.session_state.initial_hypotheses, re.DOTALL)
+                # Fallback: try bullet points
+                if len(hypotheses) < 3:
+                    hypotheses += re.findall(r"^-\s+(.*?)(?=\n-|\\Z)", st.session_state.initial_hypotheses, re.MULTILINE | re.DOTALL)
 
             if len(hypotheses) >= 3:
                 hypotheses = hypotheses[:3]
                 selected = st.radio("Select one hypothesis to refine:", hypotheses, key="selected_hypothesis")
+                if selected in hypothesis_details:
+                    details = hypothesis_details[selected]
+                    if details["spatial_variables"]:
+                        st.markdown(f"**Spatial variables:** {', '.join(details['spatial_variables'])}")
+                    if details["suggested_datasets"]:
+                        st.markdown(f"**Suggested datasets:** {', '.join(details['suggested_datasets'])}")
                 if selected:
                     st.markdown("---")
                     st.markdown("### 🗣️ Chat to refine this hypothesis")
@@ -750,6 +1156,8 @@ elif st.session_state.stage == "hypothesis":
 
                     if "chat_history" not in st.session_state:
                         st.session_state.chat_history = [{"role": "system", "content": f"You are helping refine this hypothesis: '{selected}'"}]
+                    if "hypothesis_memory" not in st.session_state:
+                        st.session_state.hypothesis_memory = ConversationMemory()
 
                     if prompt := st.chat_input("Refine your hypothesis..."):
                         st.session_state.chat_history.append({"role": "user", "content": prompt})
@@ -757,8 +1165,12 @@ elif st.session_state.stage == "hypothesis":
                             st.markdown(prompt)
 
                         with st.spinner("Thinking..."):
-                            response = agent(st.session_state.chat_history)
+                            # Only the recent turns plus a rolling summary are sent to the model
+                            memory = st.session_state.hypothesis_memory
+                            st.session_state.mode = "hypothesis"
+                            response = agent(memory.build_messages(st.session_state.chat_history))
                             st.session_state.chat_history.append({"role": "assistant", "content": response["message"]})
+                            memory.update(st.session_state.chat_history)
 
                     for msg in st.session_state.chat_history:
                         with st.chat_message(msg["role"]):
@@ -768,11 +1180,48 @@ elif st.session_state.stage == "hypothesis":
                 st.markdown("#### Raw LLM response:")
                 st.code(st.session_state.initial_hypotheses)
                 if st.button("🔄 Retry Hypothesis Generation"):
-                    del st.session_state["initial_hypotheses"]
-                    st.session_state.trigger_hypothesis_generation = True
+                    metrics.increment("hypotheses.retries")
+                    # Serve the next already-generated alternative before asking the model again
+                    next_index = st.session_state.get("hypothesis_candidate_index", 0) + 1
+                    candidates = st.session_state.get("hypothesis_candidates", [])
+                    if next_index < len(candidates):
+                        st.session_state.hypothesis_candidate_index = next_index
+                        st.session_state.initial_hypotheses = candidates[next_index]
+                    else:
+                        del st.session_state["initial_hypotheses"]
+                        st.session_state.refresh_hypotheses = True
+                        st.session_state.trigger_hypothesis_generation = True
                     st.rerun()
 
     else:
         st.info("Select documents to use in our Hypothesis Lab.")
 
+persist_session()
+prefetch_hypotheses()
 
+metrics.record_timing("app.rerun", time.perf_counter() - _run_started)
+profiling.end()
+if st.query_params.get("debug") == "1":
+    timings = metrics.snapshot()["timings"]
+    with st.sidebar:
+        st.caption(f"Full reruns this session: {st.session_state.full_reruns}")
+        for name in ("app.rerun", "app.fragment_run", "search.tavily"):
+            if name in timings:
+                st.caption(f"{name}: {timings[name]['count']} runs · p50 {timings[name]['p50'] * 1000:.0f} ms · "
+                           f"p95 {timings[name]['p95'] * 1000:.0f} ms")
+        if "semantic_cache.lookup" in timings:
+            saved = timings.get("semantic_cache.latency_saved")
+            st.caption(f"Semantic cache: {metrics.ratio('semantic_cache.hits', 'semantic_cache.misses'):.0%} hit rate"
+                       + (f" · {saved['mean'] * saved['count']:.1f}s saved" if saved else ""))
+        counters = metrics.snapshot()["counters"]
+        if counters.get("prefetch.started"):
+            st.caption(f"Prefetch: {metrics.ratio('prefetch.hits', 'prefetch.misses'):.0%} hit rate · "
+                       f"{counters['prefetch.started']} started · {counters.get('prefetch.wasted', 0)} wasted")
+        store_stats = documents.stats()
+        st.caption(f"Document store: {store_stats['documents']} documents · {store_stats['contents']} contents · "
+                   f"{store_stats['content_bytes'] / 1024:.0f} KiB")
+        profiled_labels = profiling.labels()
+        if profiled_labels:
+            with st.expander("Hot functions"):
+                label = st.selectbox("Section", profiled_labels, key="debug_profile_label")
+                st.dataframe(profiling.top_functions(label), hide_index=True)
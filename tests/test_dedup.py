@@ -0,0 +1,74 @@
+import pytest
+
+pytest.importorskip("numpy")
+from agent.dedup import Deduplicator, canonicalize_url, minhash, minhash_many, shingles
+
+
+def text(prefix, n=60):
+    return " ".join(f"{prefix}{i}" for i in range(n))
+
+
+def result(url, content, title="Report"):
+    return {"url": url, "title": title, "content": content}
+
+
+@pytest.mark.parametrize("url", [
+    "https://example.org/parks",
+    "http://www.example.org/parks/",
+    "https://EXAMPLE.org/parks#section-2",
+    "https://example.org/parks?utm_source=newsletter&fbclid=abc",
+])
+def test_canonical_url_ignores_scheme_www_fragment_and_tracking(url):
+    assert canonicalize_url(url) == "example.org/parks"
+
+
+def test_canonical_url_keeps_real_query_params_in_sorted_order():
+    assert canonicalize_url("https://example.org/search?q=parks&page=2&utm_medium=x") == "example.org/search?page=2&q=parks"
+    assert canonicalize_url("https://example.org/a?id=1") != canonicalize_url("https://example.org/a?id=2")
+
+
+def test_same_page_under_another_url_is_one_cluster():
+    dedup = Deduplicator()
+    first = result("https://example.org/parks", text("green"))
+    again = result("https://www.example.org/parks/?utm_source=x", text("green"))
+    unique, displaced = dedup.dedupe([first, again])
+    assert unique == [first]
+    assert displaced == []
+    assert len(dedup) == 1
+
+
+def test_near_duplicate_text_is_clustered_and_richest_record_represents_it():
+    dedup = Deduplicator()
+    short = result("https://a.example/report", text("green"))
+    rich = result("https://b.example/mirror", text("green") + " appendix", title="Report (full text)")
+    other = result("https://c.example/transit", text("transit"))
+    unique, displaced = dedup.dedupe([short, other, rich])
+    assert unique == [rich, other]
+    assert displaced == [short]
+    assert dedup.representative(short) is rich
+
+
+def test_short_snippets_are_only_matched_by_url():
+    dedup = Deduplicator()
+    a = result("https://a.example/x", "green parks")
+    b = result("https://b.example/y", "green parks")
+    unique, _ = dedup.dedupe([a, b])
+    assert unique == [a, b]
+
+
+def test_later_batches_match_earlier_clusters():
+    dedup = Deduplicator()
+    original = result("https://a.example/report", text("green") + " appendix")
+    dedup.dedupe([original])
+    unique, displaced = dedup.dedupe([result("https://b.example/copy", text("green"))])
+    assert unique == [original]
+    assert displaced == []
+
+
+def test_batch_signatures_match_single_ones():
+    sets = [shingles(result("u", text(p, n))) for p, n in [("a", 60), ("b", 4), ("c", 300)]]
+    for single, batched in zip([minhash(s) for s in sets], minhash_many(sets)):
+        if single is None:
+            assert batched is None
+        else:
+            assert (single == batched).all()
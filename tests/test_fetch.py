@@ -0,0 +1,88 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("requests")
+from agent.fetch import fetch_pages
+
+TEXT = "Ciclovías de Bogotá y São Paulo"
+
+
+def minimal_pdf(pages):
+    """A PDF with one line of Helvetica text per page."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>"
+        )
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    pdf += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return pdf
+
+
+def html(body, head=""):
+    return f"<html><head>{head}<title>t</title></head><body><nav>Menu</nav><p>{body}</p></body></html>"
+
+
+# path -> (Content-Type, body)
+FILES = {
+    "/undeclared.html": ("text/html", html(TEXT).encode("utf-8")),
+    "/meta.html": ("text/html", html(TEXT, '<meta charset="windows-1252">').encode("cp1252")),
+    "/http-equiv.html": (
+        "text/html",
+        html(TEXT, '<meta http-equiv="Content-Type" content="text/html; charset=ISO-8859-1">').encode("latin-1"),
+    ),
+    "/header.html": ("text/html; charset=cp1252", html(TEXT).encode("cp1252")),
+    "/report.pdf": ("application/pdf", minimal_pdf(["Green space access", "Transit ridership"])),
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        content_type, body = FILES[self.path]
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.mark.parametrize("path", ["/undeclared.html", "/meta.html", "/http-equiv.html", "/header.html"])
+def test_html_text_is_decoded_with_the_page_encoding(server, path):
+    assert list(fetch_pages(server + path)) == [(1, f"t {TEXT}")]
+
+
+def test_pdf_pages_are_numbered(server):
+    pytest.importorskip("pypdf")
+    pages = list(fetch_pages(server + "/report.pdf"))
+    assert [number for number, _ in pages] == [1, 2]
+    assert "Green space access" in pages[0][1]
+    assert "Transit ridership" in pages[1][1]
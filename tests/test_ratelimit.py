@@ -0,0 +1,93 @@
+import time
+
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("tenacity")
+from agent import ratelimit
+from agent.ratelimit import AdaptiveConcurrency, ProviderLimiter, QueueTimeout, RateLimited, TokenBucket
+
+
+def test_bucket_allows_a_burst_then_paces_at_its_rate():
+    bucket = TokenBucket(rate=20, capacity=5)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.05
+    bucket.acquire(2)
+    assert time.monotonic() - start == pytest.approx(0.1, abs=0.05)
+
+
+def test_bucket_gives_up_after_the_queue_timeout():
+    bucket = TokenBucket(rate=1, capacity=1)
+    bucket.acquire()
+    with pytest.raises(QueueTimeout):
+        bucket.acquire(timeout=0.1)
+
+
+def test_pause_makes_every_caller_wait():
+    bucket = TokenBucket(rate=100, capacity=100)
+    bucket.pause(0.2)
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.19
+
+
+def test_concurrency_limit_grows_additively_and_halves_on_throttle():
+    limit = AdaptiveConcurrency(initial=8, minimum=1)
+    limit.acquire()
+    limit.release(throttled=True)
+    assert limit.limit == 4
+    for _ in range(4):
+        limit.acquire()
+        limit.release()
+    assert limit.limit == pytest.approx(4.93, abs=0.01)
+    for _ in range(100):
+        limit.acquire()
+        limit.release()
+    assert limit.limit == 8
+    for _ in range(10):
+        limit.acquire()
+        limit.release(throttled=True)
+    assert limit.limit == 1
+
+
+def test_concurrency_slots_are_bounded_by_the_limit():
+    limit = AdaptiveConcurrency(initial=2)
+    limit.acquire()
+    limit.acquire()
+    with pytest.raises(QueueTimeout):
+        limit.acquire(timeout=0.05)
+    limit.release()
+    limit.acquire(timeout=0.05)
+    assert limit.in_flight == 2
+
+
+def test_throttled_calls_are_retried_and_shrink_concurrency(monkeypatch):
+    monkeypatch.setattr(ratelimit.random, "uniform", lambda a, b: 0)
+    limiter = ProviderLimiter("test", requests_per_second=1000, concurrency=4)
+    answers = iter([RateLimited("429", retry_after=0), RateLimited("429", retry_after=0), "ok"])
+
+    def call():
+        answer = next(answers)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    assert limiter.call(call) == "ok"
+    assert limiter.concurrency.limit < 4
+    assert limiter.concurrency.in_flight == 0
+
+
+def test_other_errors_are_not_retried():
+    limiter = ProviderLimiter("test", requests_per_second=1000, concurrency=4)
+    calls = []
+
+    def call():
+        calls.append(1)
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        limiter.call(call)
+    assert len(calls) == 1
+    assert limiter.concurrency.limit == 4
@@ -0,0 +1,92 @@
+import pytest
+
+pytest.importorskip("numpy")
+from agent.semantic_cache import SemanticCache
+
+# Questions about the same thing embed to the same vector; everything else is orthogonal
+TOPICS = ["parks", "transit", "housing"]
+
+
+def embed(texts):
+    return [[float(topic in text) for topic in TOPICS] for text in texts]
+
+
+def request(question, system="You are an urban planning assistant."):
+    return {"model": "gpt-4o", "messages": [{"role": "system", "content": system}, {"role": "user", "content": question}]}
+
+
+class Counter:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return f"answer {self.calls}"
+
+
+@pytest.fixture
+def cache():
+    return SemanticCache(embed, threshold=0.95)
+
+
+def test_similar_question_is_answered_from_the_cache(cache):
+    compute = Counter()
+    assert cache.cached("search", request("Green parks in Lisbon"), compute) == "answer 1"
+    assert cache.cached("search", request("green  PARKS of Lisbon?"), compute) == "answer 1"
+    assert cache.cached("search", request("Transit in Lisbon"), compute) == "answer 2"
+    assert compute.calls == 2
+
+
+def test_different_context_or_mode_is_a_different_partition(cache):
+    compute = Counter()
+    cache.cached("search", request("parks"), compute)
+    cache.cached("search", request("parks", system="Answer in Spanish."), compute)
+    cache.cached("chat", request("parks"), compute)
+    assert compute.calls == 3
+    assert len(cache) == 3
+
+
+def test_volatile_prompt_parts_are_ignored(cache):
+    compute = Counter()
+    cache.cached("search", request("parks", system="CURRENT DATETIME: 2024-01-01 10:00\nRules."), compute)
+    cache.cached("search", request("parks", system="CURRENT DATETIME: 2024-03-09 17:45\nRules."), compute)
+    assert compute.calls == 1
+
+
+@pytest.mark.parametrize("mode", ["hypothesis", "summary"])
+def test_exact_modes_only_reuse_identical_requests(cache, mode):
+    compute = Counter()
+    cache.cached(mode, request("Documents: parks study A"), compute)
+    # Would be a hit by similarity, but the documents differ
+    cache.cached(mode, request("Documents: parks study B"), compute)
+    assert compute.calls == 2
+    assert cache.cached(mode, request("Documents: parks study A"), compute) == "answer 1"
+    assert compute.calls == 2
+
+
+def test_exact_modes_never_embed():
+    def failing_embed(texts):
+        raise AssertionError("embedded")
+
+    cache = SemanticCache(failing_embed)
+    compute = Counter()
+    cache.cached("summary", request("Documents: parks"), compute)
+    assert cache.cached("summary", request("Documents: parks"), compute) == "answer 1"
+
+
+def test_expired_entries_are_computed_again():
+    cache = SemanticCache(embed, ttl=0)
+    compute = Counter()
+    cache.cached("search", request("parks"), compute)
+    cache.cached("search", request("parks"), compute)
+    assert compute.calls == 2
+
+
+def test_oldest_entries_are_evicted():
+    cache = SemanticCache(embed, max_entries=2)
+    compute = Counter()
+    for topic in TOPICS:
+        cache.cached("search", request(topic), compute)
+    assert len(cache) == 2
+    cache.cached("search", request("parks"), compute)
+    assert compute.calls == 4
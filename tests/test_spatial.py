@@ -0,0 +1,74 @@
+import os
+from unittest import mock
+
+import pytest
+
+pytest.importorskip("scipy")
+pytest.importorskip("geopy")
+pytest.importorskip("openai")
+pytest.importorskip("pinecone")
+# agent.tools opens the Pinecone index when it is imported; these tests never use it
+for key in ("OPENAI_API_KEY", "PINECONE_API_KEY", "PINECONE_INDEX_NAME"):
+    os.environ.setdefault(key, "test")
+with mock.patch("pinecone.Pinecone.Index"):
+    from agent import spatial
+from agent.spatial import SpatialIndex
+
+LISBON = (38.72, -9.14)
+PORTO = (41.15, -8.61)
+MADRID = (40.42, -3.70)
+BERLIN = (52.52, 13.40)
+POTSDAM = (52.39, 13.06)
+
+
+def place(name, coords):
+    lat, lon = coords
+    return {"url": f"https://example.org/{name}", "title": name, "content": "", "lat": lat, "lon": lon}
+
+
+def urls(hits):
+    return [d["url"].rsplit("/", 1)[1] for d, _ in hits]
+
+
+@pytest.fixture(params=[False, True], ids=["pending", "tree"])
+def index(request):
+    idx = SpatialIndex()
+    for name, coords in [("porto", PORTO), ("madrid", MADRID), ("berlin", BERLIN)]:
+        idx.add(place(name, coords))
+    if request.param:
+        idx.rebuild()
+    return idx
+
+
+def test_within_radius_nearest_first(index):
+    hits = index.within(*LISBON, radius_km=600)
+    assert urls(hits) == ["porto", "madrid"]
+    assert hits[0][1] == pytest.approx(274, abs=5)
+
+
+def test_nearest(index):
+    assert urls(index.nearest(*LISBON, k=2)) == ["porto", "madrid"]
+    assert urls(index.nearest(*LISBON, k=10)) == ["porto", "madrid", "berlin"]
+
+
+def test_removed_documents_are_not_returned(index):
+    index.remove("https://example.org/porto")
+    assert urls(index.within(*LISBON, radius_km=600)) == ["madrid"]
+    assert urls(index.nearest(*LISBON, k=1)) == ["madrid"]
+
+
+def test_readded_url_is_found_at_its_new_location(index):
+    index.remove("https://example.org/porto")
+    index.add(place("porto", POTSDAM))
+    assert urls(index.within(*LISBON, radius_km=600)) == ["madrid"]
+    assert urls(index.nearest(*BERLIN, k=2)) == ["berlin", "porto"]
+    index.rebuild()
+    assert urls(index.nearest(*LISBON, k=1)) == ["madrid"]
+
+
+def test_tree_is_rebuilt_after_enough_changes():
+    idx = SpatialIndex()
+    for i in range(spatial.REBUILD_THRESHOLD):
+        idx.add(place(f"p{i}", (i / 10, 0)))
+    assert idx._tree is not None and not idx._pending
+    assert len(idx.nearest(0, 0, k=5)) == 5
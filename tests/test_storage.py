@@ -0,0 +1,71 @@
+import gc
+
+import pytest
+
+from agent.docstore import Document, documents
+from agent.storage import SessionStore
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "sessions.db")
+
+
+def doc(n, **extra):
+    return documents.intern({"url": f"https://example.org/{n}", "title": f"Study {n}", "content": f"text {n} " * 200, **extra})
+
+
+def test_session_round_trip(db_path):
+    store = SessionStore(db_path=db_path)
+    shared = doc(1, city="Lisbon")
+    store.save_collection("results", [shared, doc(2)])
+    store.save_collection("selected_results", [shared])
+    store.save_messages("chat", [{"role": "user", "content": "Parks?"}, {"role": "assistant", "content": "Yes."}])
+    store.save_value("stage", "results")
+    del shared
+    gc.collect()
+
+    loaded = SessionStore(store.session_id, db_path=db_path).load()
+    results = loaded["collections"]["results"]
+    assert all(isinstance(r, Document) for r in results)
+    assert [r["url"] for r in results] == ["https://example.org/1", "https://example.org/2"]
+    assert results[0]["content"] == "text 1 " * 200
+    assert results[0]["city"] == "Lisbon"
+    # One object per URL across collections
+    assert loaded["collections"]["selected_results"][0] is results[0]
+    assert loaded["threads"]["chat"][1] == {"role": "assistant", "content": "Yes."}
+    assert loaded["values"] == {"stage": "results"}
+
+
+def test_restored_documents_are_the_shared_ones(db_path):
+    store = SessionStore(db_path=db_path)
+    live = doc(3)
+    store.save_collection("results", [live])
+    loaded = SessionStore(store.session_id, db_path=db_path).load()
+    assert loaded["collections"]["results"][0] is live
+
+
+def test_unchanged_collections_are_not_written_again(db_path):
+    store = SessionStore(db_path=db_path)
+    results = [doc(4)]
+    assert store.save_collection("results", results)
+    assert not store.save_collection("results", results)
+    restored = SessionStore(store.session_id, db_path=db_path)
+    restored.load()
+    assert not restored.save_collection("results", results)
+
+
+def test_changed_document_is_saved_again(db_path):
+    store = SessionStore(db_path=db_path)
+    results = [doc(5)]
+    store.save_collection("results", results)
+    results[0]["lat"], results[0]["lon"] = 38.7, -9.1
+    assert results[0].dirty
+    assert store.save_collection("results", results)
+    assert not results[0].dirty
+    del results
+    gc.collect()
+
+    loaded = SessionStore(store.session_id, db_path=db_path).load()
+    restored = loaded["collections"]["results"][0]
+    assert (restored["lat"], restored["lon"]) == (38.7, -9.1)